@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark of the sync state held in memory
+Writes a synthetic JSON state file with a number of file entries
+(1,000,000 by default) and loads it through JSONStateStore in a fresh
+process for each mode: 'dict' reads the entries as plain dicts, the
+default, 'records' reads them as FileRecords, as sync.py does with
+STATE_COMPACT_RECORDS enabled. For each mode
+the memory held by the loaded state, the peak resident memory of the
+process and the load time are reported.
+
+Usage:
+    python3 benchmark_state.py [--entries N] [--state-file PATH]
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from state_store import JSONStateStore
+
+KNOWLEDGE_BASES = ('Documents', 'Engineering', 'Policies', 'Archive')
+SOURCES = (('local', 'Local Files'), ('ssh', 'fileserver'))
+
+
+def build_entry(index, now):
+    """Synthetic state entry of the index-th file, shaped like those of build_upload_state()"""
+    modified = now - timedelta(seconds=random.randrange(86400 * 365), microseconds=random.randrange(1000000))
+    hashed = now - timedelta(seconds=random.randrange(86400 * 7), microseconds=random.randrange(1000000))
+    size = random.randrange(100, 5000000)
+    source_type, source_name = SOURCES[1] if index % 10 == 0 else SOURCES[0]
+    entry = {
+        'hash': '%032x' % random.getrandbits(128),
+        'size': size,
+        'mtime_ns': int(modified.timestamp() * 1e9),
+        'inode': 10000000 + index,
+        'dev': 65024,
+        'hashed_at': hashed.isoformat(),
+        'hash_algorithm': 'md5',
+        'status': 'uploaded',
+        'file_id': '%08x-%04x-%04x-%04x-%012x' % tuple(random.getrandbits(bits) for bits in (32, 16, 16, 16, 48)),
+        'last_attempt': (hashed + timedelta(seconds=1)).isoformat(),
+        'retry_count': 0,
+        'knowledge_base': KNOWLEDGE_BASES[index % len(KNOWLEDGE_BASES)],
+        'source_type': source_type,
+        'source_name': source_name,
+        'file_size': size,
+        'created_at': modified.isoformat(),
+        'modified_at': modified.isoformat(),
+        'filename': f"file{index}.md"
+    }
+    if index % 100 == 0:
+        entry['status'] = 'failed'
+        entry['retry_count'] = 1
+        entry['error'] = 'Upload failed'
+    return entry
+
+
+def write_state_file(path, entries):
+    """Write a synthetic state file entry by entry, without holding the state in memory"""
+    random.seed(0)
+    now = datetime(2026, 1, 1)
+    with open(path, 'w') as f:
+        f.write('{"files": {')
+        for index in range(entries):
+            if index:
+                f.write(', ')
+            file_key = f"local/dir{index // 1000}/file{index}.md"
+            f.write(f"{json.dumps(file_key)}: {json.dumps(build_entry(index, now))}")
+        knowledge_bases = {name: {'id': f"kb-{i}", 'created_at': now.isoformat()} for i, name in enumerate(KNOWLEDGE_BASES)}
+        f.write(f'}}, "knowledge_bases": {json.dumps(knowledge_bases)}}}')
+
+
+def get_rss():
+    """Current resident memory of this process in bytes"""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def measure(mode, path):
+    """Load the state file in this process and print the measurements as JSON"""
+    gc.collect()
+    rss_before = get_rss()
+    started = time.monotonic()
+    store = JSONStateStore(path, records=mode == 'records')
+    state = store.load()
+    elapsed = time.monotonic() - started
+    gc.collect()
+    print(json.dumps({
+        'files': len(state['files']),
+        'held': get_rss() - rss_before,
+        'peak': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'seconds': elapsed
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the memory of the sync state loaded from a state file')
+    parser.add_argument('--entries', type=int, default=1000000, help='Number of file entries (default 1000000)')
+    parser.add_argument('--state-file', help='Use or create this state file instead of a temporary one')
+    parser.add_argument('--measure', choices=('dict', 'records'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.measure, args.state_file)
+        return
+
+    temp_dir = None
+    path = args.state_file
+    if not path:
+        temp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(temp_dir.name, 'sync_state.json')
+    try:
+        if not os.path.exists(path):
+            print(f"Writing {args.entries} synthetic entries to {path}...")
+            write_state_file(path, args.entries)
+        print(f"State file: {os.path.getsize(path) / 1048576:.1f} MB")
+
+        results = {}
+        for mode in ('dict', 'records'):
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure', mode, '--state-file', path],
+                                    capture_output=True, text=True, check=True).stdout
+            results[mode] = json.loads(output)
+            result = results[mode]
+            print(f"{mode:8} {result['files']} entries: {result['held'] / 1048576:8.1f} MB held, "
+                  f"{result['peak'] / 1048576:8.1f} MB peak, loaded in {result['seconds']:.1f}s "
+                  f"({result['held'] / max(result['files'], 1):.0f} bytes per entry)")
+        if results['dict']['held']:
+            print(f"Records hold {results['records']['held'] * 100 / results['dict']['held']:.0f}% of the memory of dicts")
+    finally:
+        if temp_dir:
+            temp_dir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -4,29 +4,57 @@ Configuration manager for Open-WebUI-Local-FileSync
 Handles loading config from file or environment variables
 """
 import os
+import glob
+import re
 import json
 from pathlib import Path
 
 # Default configuration file path
 DEFAULT_CONFIG_FILE = os.getenv('CONFIG_FILE', '/app/config/filesync-config.json')
 
+# Smallest read size used while hashing; a smaller or non-positive setting is raised to it
+MIN_HASH_BUFFER_SIZE = 64 * 1024
+
 def get_default_config():
     """Get default configuration structure"""
     return {
         'openwebui': {
             'url': 'http://localhost:8080',
-            'api_key': ''
+            'api_key': '',
+            'timeout': 30,
+            'max_retries': 3,
+            'pool_size': 16,
+            'kb_cache_seconds': 60,
+            'adaptive_concurrency': True,
+            'latency_target': 20,
+            'max_requests_per_second': 0,
+            'max_mb_per_second': 0,
+            'min_mb_per_second': 1
         },
         'sync': {
             'schedule': 'daily',
             'time': '00:00',
             'day': '0',
-            'timezone': 'UTC'
+            'timezone': 'UTC',
+            'watch_debounce_seconds': 5,
+            'watch_reconcile_hours': 6,
+            'delete_missing_files': False,
+            'delete_max_percent': 50,
+            'delete_workers': 4,
+            'deduplicate_uploads': True,
+            'shard': '',
+            'max_run_seconds': 0,
+            'max_files': 0,
+            'max_bytes': 0
         },
         'files': {
             'directory': '/data',
             'allowed_extensions': ['.md', '.txt', '.pdf', '.doc', '.docx', '.json', '.yaml', '.yml', '.conf'],
-            'state_file': '/app/sync_state.json'
+            'case_insensitive_extensions': False,
+            'state_file': '/app/sync_state.json',
+            'state_backend': 'json',
+            'state_compact_percent': 25,
+            'state_compact_records': False
         },
         'knowledge_bases': {
             'single_kb_mode': False,
@@ -44,6 +72,21 @@ def get_default_config():
             'strict_host_key_checking': False,
             'sources': []
         },
+        'performance': {
+            'rehash_interval_days': 7,
+            'hash_workers': 0,
+            'hash_buffer_size': 1048576,
+            'hash_algorithm': 'md5',
+            'directory_manifest_hours': 0,
+            'upload_workers': 4,
+            'processing_workers': 8,
+            'kb_attach_workers': 4,
+            'kb_attach_batch_size': 100,
+            'upload_large_file_mb': 50,
+            'upload_large_workers': 1,
+            'kb_priorities': {},
+            'upload_spool_mb': 8
+        },
         'volumes': []
     }
 
@@ -72,6 +115,7 @@ def load_config_from_file(config_file=None):
                         for subkey in default[key]:
                             if subkey not in config[key]:
                                 config[key][subkey] = default[key][subkey]
+                config['performance']['hash_buffer_size'] = max(config['performance']['hash_buffer_size'], MIN_HASH_BUFFER_SIZE)
                 return config
         except Exception as e:
             print(f"Error loading config file {config_path}: {e}")
@@ -113,18 +157,41 @@ def load_config_from_env():
     # OpenWebUI settings
     config['openwebui']['url'] = os.getenv('OPENWEBUI_URL', 'http://localhost:8080')
     config['openwebui']['api_key'] = os.getenv('OPENWEBUI_API_KEY', '')
+    config['openwebui']['timeout'] = float(os.getenv('OPENWEBUI_TIMEOUT', '30'))
+    config['openwebui']['max_retries'] = int(os.getenv('OPENWEBUI_MAX_RETRIES', '3'))
+    config['openwebui']['pool_size'] = int(os.getenv('OPENWEBUI_POOL_SIZE', '16'))
+    config['openwebui']['kb_cache_seconds'] = float(os.getenv('OPENWEBUI_KB_CACHE_SECONDS', '60'))
+    config['openwebui']['adaptive_concurrency'] = os.getenv('OPENWEBUI_ADAPTIVE_CONCURRENCY', 'true').lower() == 'true'
+    config['openwebui']['latency_target'] = float(os.getenv('OPENWEBUI_LATENCY_TARGET', '20'))
+    config['openwebui']['max_requests_per_second'] = float(os.getenv('OPENWEBUI_MAX_REQUESTS_PER_SECOND', '0'))
+    config['openwebui']['max_mb_per_second'] = float(os.getenv('OPENWEBUI_MAX_MB_PER_SECOND', '0'))
+    config['openwebui']['min_mb_per_second'] = float(os.getenv('OPENWEBUI_MIN_MB_PER_SECOND', '1'))
     
     # Sync settings
     config['sync']['schedule'] = os.getenv('SYNC_SCHEDULE', 'daily')
     config['sync']['time'] = os.getenv('SYNC_TIME', '00:00')
     config['sync']['day'] = os.getenv('SYNC_DAY', '0')
     config['sync']['timezone'] = os.getenv('TZ', 'UTC')
+    config['sync']['watch_debounce_seconds'] = float(os.getenv('WATCH_DEBOUNCE_SECONDS', '5'))
+    config['sync']['watch_reconcile_hours'] = float(os.getenv('WATCH_RECONCILE_HOURS', '6'))
+    config['sync']['delete_missing_files'] = os.getenv('DELETE_MISSING_FILES', 'false').lower() == 'true'
+    config['sync']['delete_max_percent'] = float(os.getenv('DELETE_MAX_PERCENT', '50'))
+    config['sync']['delete_workers'] = int(os.getenv('DELETE_WORKERS', '4'))
+    config['sync']['deduplicate_uploads'] = os.getenv('DEDUPLICATE_UPLOADS', 'true').lower() == 'true'
+    config['sync']['shard'] = os.getenv('SYNC_SHARD', '').strip()
+    config['sync']['max_run_seconds'] = float(os.getenv('MAX_RUN_SECONDS', '0'))
+    config['sync']['max_files'] = int(os.getenv('MAX_FILES', '0'))
+    config['sync']['max_bytes'] = int(os.getenv('MAX_BYTES', '0'))
     
     # File settings
     config['files']['directory'] = os.getenv('FILES_DIR', '/data')
     allowed_ext = os.getenv('ALLOWED_EXTENSIONS', '.md,.txt,.pdf,.doc,.docx,.json,.yaml,.yml,.conf')
     config['files']['allowed_extensions'] = [ext.strip() for ext in allowed_ext.split(',')]
+    config['files']['case_insensitive_extensions'] = os.getenv('CASE_INSENSITIVE_EXTENSIONS', 'false').lower() == 'true'
     config['files']['state_file'] = os.getenv('STATE_FILE', '/app/sync_state.json')
+    config['files']['state_backend'] = os.getenv('STATE_BACKEND', 'json').strip().lower()
+    config['files']['state_compact_percent'] = float(os.getenv('STATE_COMPACT_PERCENT', '25'))
+    config['files']['state_compact_records'] = os.getenv('STATE_COMPACT_RECORDS', 'false').lower() == 'true'
     
     # Knowledge base settings
     kb_name = os.getenv('KNOWLEDGE_BASE_NAME', '')
@@ -174,8 +241,50 @@ def load_config_from_env():
     config['ssh']['key_path'] = os.getenv('SSH_KEY_PATH', '/app/ssh_keys')
     config['ssh']['strict_host_key_checking'] = os.getenv('SSH_STRICT_HOST_KEY_CHECKING', 'false').lower() == 'true'
     
+    # Performance settings
+    config['performance']['rehash_interval_days'] = float(os.getenv('REHASH_INTERVAL_DAYS', '7'))
+    config['performance']['hash_workers'] = int(os.getenv('HASH_WORKERS', '0'))
+    config['performance']['hash_buffer_size'] = max(int(os.getenv('HASH_BUFFER_SIZE', '1048576')), MIN_HASH_BUFFER_SIZE)
+    config['performance']['hash_algorithm'] = os.getenv('HASH_ALGORITHM', 'md5').strip().lower()
+    config['performance']['directory_manifest_hours'] = float(os.getenv('DIRECTORY_MANIFEST_HOURS', '0'))
+    config['performance']['upload_workers'] = int(os.getenv('UPLOAD_WORKERS', '4'))
+    config['performance']['processing_workers'] = int(os.getenv('PROCESSING_WORKERS', '8'))
+    config['performance']['kb_attach_workers'] = int(os.getenv('KB_ATTACH_WORKERS', '4'))
+    config['performance']['kb_attach_batch_size'] = int(os.getenv('KB_ATTACH_BATCH_SIZE', '100'))
+    config['performance']['upload_large_file_mb'] = float(os.getenv('UPLOAD_LARGE_FILE_MB', '50'))
+    config['performance']['upload_large_workers'] = int(os.getenv('UPLOAD_LARGE_WORKERS', '1'))
+    try:
+        config['performance']['kb_priorities'] = json.loads(os.getenv('KB_PRIORITIES', '') or '{}')
+    except json.JSONDecodeError:
+        config['performance']['kb_priorities'] = {}
+    config['performance']['upload_spool_mb'] = float(os.getenv('UPLOAD_SPOOL_MB', '8'))
+    
     return config
 
+def get_state_files(state_file, shard_count=None):
+    """List the existing state files: the state file itself and the shards written by sharded syncs
+    
+    Shards are named like sync_state.shard-2-of-4.json (see get_shard_state_file in sync.py).
+    Shards left from a different number of shards are ignored.
+    
+    Args:
+        state_file: State file (or database) path
+        shard_count: Number of shards in use; defaults to that of the most recently written shard
+    """
+    path = Path(state_file)
+    state_files = [str(path)] if path.exists() else []
+    pattern = f"{glob.escape(path.stem)}.shard-*-of-*{glob.escape(path.suffix)}"
+    shard_name = re.compile(rf"{re.escape(path.stem)}\.shard-\d+-of-(\d+){re.escape(path.suffix)}$")
+    shards = []
+    for shard in path.parent.glob(pattern):
+        match = shard_name.match(shard.name)
+        if match:
+            shards.append((int(match.group(1)), shard))
+    if shards and not shard_count:
+        shard_count = max(shards, key=lambda item: item[1].stat().st_mtime)[0]
+    state_files.extend(sorted(str(shard) for count, shard in shards if count == shard_count))
+    return state_files
+
 def get_config():
     """Get configuration from file or environment variables
     
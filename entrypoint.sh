@@ -35,13 +35,26 @@ case "$SYNC_SCHEDULE" in
             CRON_SCHEDULE="$MINUTE $HOUR * * 0"
         fi
         ;;
+    watch)
+        # Long-running watch mode, no cron job
+        ;;
     *)
         echo "Invalid SYNC_SCHEDULE: $SYNC_SCHEDULE"
-        echo "Valid options: hourly, daily, weekly"
+        echo "Valid options: hourly, daily, weekly, watch"
         exit 1
         ;;
 esac
 
+if [ "$SYNC_SCHEDULE" = "watch" ]; then
+    # Start web interface in background
+    echo "Starting web interface on port ${WEB_PORT}..."
+    /usr/local/bin/python3 /app/web.py >> /proc/1/fd/1 2>&1 &
+
+    # Sync changed files as they appear, with periodic full syncs
+    echo "Starting sync in watch mode..."
+    exec /usr/local/bin/python3 /app/sync.py --watch
+fi
+
 echo "Configuring sync schedule: $CRON_SCHEDULE ($SYNC_SCHEDULE at $SYNC_TIME)"
 
 # Create cron job
@@ -0,0 +1,610 @@
+#!/usr/bin/env python3
+"""
+Open WebUI API client shared by sync.py and web.py
+Keeps connections alive in a pooled session, retries throttled and failed
+requests, and records per-endpoint latency
+"""
+import io
+import re
+import threading
+import time
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Statuses retried for every method: the request was not processed
+RETRY_STATUSES = (429,)
+
+# Statuses retried for every method only when the response has a Retry-After header
+RETRY_AFTER_STATUSES = (503,)
+
+# Statuses and connection errors retried only for methods that are safe to repeat. A gateway
+# error may come from a proxy that gave up while Open WebUI still processed the request
+IDEMPOTENT_RETRY_STATUSES = (500, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+# Path segments that look like IDs are grouped in the latency counters
+_ID_SEGMENT = re.compile(r'/(?=[^/]*\d)[0-9a-zA-Z_-]{8,}(?=/|$)')
+
+# Filenames are quoted in Content-Disposition headers the way browsers do (HTML5)
+_FILENAME_ESCAPES = {ord('"'): '%22', ord('\\'): '\\\\', **{c: f'%{c:02X}' for c in range(0x20) if c != 0x1B}}
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class OpenWebUIClient:
+    """Client for the Open WebUI API with a pooled keep-alive session
+
+    Responses are returned as requests.Response objects, so callers check
+    status codes as before. Connection errors that are not retried are
+    raised as requests exceptions.
+    """
+
+    def __init__(self, base_url, api_key, timeout=30, max_retries=3, pool_size=16, kb_cache_seconds=60):
+        """Create a client
+
+        Args:
+            base_url: Open WebUI URL, e.g. http://openwebui:8080
+            api_key: Open WebUI API key
+            timeout: Default request timeout in seconds
+            max_retries: Retries for throttled (429) and failed (5xx) requests
+            pool_size: Maximum number of kept-alive connections
+            kb_cache_seconds: Seconds the knowledge base list is cached (0 disables the cache)
+        """
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.kb_cache_seconds = kb_cache_seconds
+
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f'Bearer {api_key}'
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        self._kb_cache = None
+        self._kb_cache_time = 0
+        self._kb_cache_lock = threading.Lock()
+        self._batch_attach = True
+
+    def request(self, method, path, limiter=None, **kwargs):
+        """Send a request, retrying with exponential backoff
+
+        Args:
+            method: HTTP method
+            path: API path, e.g. /api/v1/files/
+            limiter: Optional AdaptiveLimiter each attempt waits for and reports to
+            **kwargs: Passed to requests (json, files, data, params, timeout...)
+
+        Returns:
+            requests.Response
+        """
+        method = method.upper()
+        url = f"{self.base_url}{path}"
+        kwargs.setdefault('timeout', self.timeout)
+        idempotent = method in IDEMPOTENT_METHODS
+        endpoint = f"{method} {_ID_SEGMENT.sub('/{id}', path)}"
+        body = kwargs.get('data') if isinstance(kwargs.get('data'), MultipartUpload) else None
+        if body is not None:
+            size = len(body)
+        else:
+            size = _files_size(kwargs['files']) if 'files' in kwargs else 0
+
+        attempt = 0
+        while True:
+            if attempt and body is not None:
+                body.seek(0)
+            elif attempt and 'files' in kwargs:
+                _rewind_files(kwargs['files'])
+
+            started = limiter.acquire(size) if limiter else None
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._record(endpoint, time.monotonic() - start, attempt, error=True)
+                if limiter:
+                    limiter.release(started, time.monotonic() - start, None)
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+                time.sleep(_backoff(attempt))
+                attempt += 1
+                continue
+            except Exception:
+                if limiter:
+                    limiter.release(started, time.monotonic() - start, None)
+                raise
+
+            elapsed = time.monotonic() - start
+            if limiter:
+                # The time spent sending a streamed body depends on its size, not on how busy Open WebUI is
+                latency = time.monotonic() - body.finished_at if body is not None and body.finished_at else elapsed
+                limiter.release(started, latency, response.status_code)
+            retry = (response.status_code in RETRY_STATUSES
+                     or (response.status_code in RETRY_AFTER_STATUSES and 'Retry-After' in response.headers)
+                     or (idempotent and response.status_code in IDEMPOTENT_RETRY_STATUSES))
+            if not retry or attempt >= self.max_retries:
+                self._record(endpoint, elapsed, attempt, error=response.status_code >= 400)
+                return response
+
+            self._record(endpoint, elapsed, attempt, error=True)
+            time.sleep(_retry_after(response) or _backoff(attempt))
+            attempt += 1
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+    def find_uploaded_file(self, filename, size, since):
+        """Find a file Open WebUI stored from an upload whose response was lost
+
+        Args:
+            filename: Filename of the upload
+            size: Size in bytes of the uploaded content
+            since: Unix time the upload started
+
+        Returns:
+            File ID, or None if no matching file was found
+        """
+        response = self.get('/api/v1/files/', params={'content': 'false'})
+        if response.status_code != 200:
+            return None
+        try:
+            files = response.json()
+        except ValueError:
+            return None
+        if isinstance(files, dict):
+            files = files.get('items') or files.get('files') or []
+
+        matches = []
+        for file_data in files if isinstance(files, list) else []:
+            meta = file_data.get('meta') or {}
+            if (file_data.get('filename') or meta.get('name')) != filename or meta.get('size') != size:
+                continue
+            # Allow for clock differences between this host and Open WebUI
+            if file_data.get('created_at') and file_data['created_at'] < since - 300:
+                continue
+            matches.append(file_data)
+        if not matches:
+            return None
+        # The most recent copy if the file was uploaded more than once
+        return max(matches, key=lambda file_data: file_data.get('created_at') or 0).get('id')
+
+    def list_knowledge_bases(self):
+        """List knowledge bases, cached for kb_cache_seconds
+
+        Returns:
+            List of knowledge base dicts
+
+        Raises:
+            requests.HTTPError: If Open WebUI does not return the list
+        """
+        with self._kb_cache_lock:
+            if self._kb_cache is not None and time.monotonic() - self._kb_cache_time < self.kb_cache_seconds:
+                return self._kb_cache
+
+        response = self.get('/api/v1/knowledge/')
+        response.raise_for_status()
+        kbs = response.json()
+        if not isinstance(kbs, list):
+            kbs = []
+
+        with self._kb_cache_lock:
+            self._kb_cache = kbs
+            self._kb_cache_time = time.monotonic()
+        return kbs
+
+    def create_knowledge_base(self, name, description):
+        """Create a knowledge base and drop the cached knowledge base list
+
+        Returns:
+            requests.Response
+        """
+        response = self.post('/api/v1/knowledge/', json={'name': name, 'description': description})
+        self.invalidate_knowledge_bases()
+        return response
+
+    def add_files_to_knowledge_base(self, kb_id, file_ids, batch_size=100):
+        """Add files to a knowledge base, in batches where Open WebUI supports it
+
+        Batches go to /files/batch/add. Files of a batch the server rejects,
+        and all files once the batch endpoint turns out to be missing, are
+        added one at a time with /file/add. A batch whose request failed
+        (e.g. timed out) may have been added anyway, so the knowledge base
+        is read again and only its missing files are added one at a time.
+
+        Args:
+            kb_id: Knowledge base ID
+            file_ids: IDs of processed files
+            batch_size: Maximum number of files per batch request
+
+        Returns:
+            Dict of file ID -> None if added, or an error message
+        """
+        file_ids = list(dict.fromkeys(file_ids))
+        results = {}
+        unconfirmed = []
+        batch_error = None
+
+        if len(file_ids) > 1 and self._batch_attach:
+            for start in range(0, len(file_ids), max(1, batch_size)):
+                batch = file_ids[start:start + max(1, batch_size)]
+                try:
+                    response = self.post(
+                        f'/api/v1/knowledge/{kb_id}/files/batch/add',
+                        json=[{'file_id': file_id} for file_id in batch]
+                    )
+                except requests.RequestException as e:
+                    unconfirmed.extend(batch)
+                    batch_error = e
+                    continue
+                if response.status_code == 405 or (response.status_code == 404 and _detail(response) == 'Not Found'):
+                    # Open WebUI without batch support
+                    self._batch_attach = False
+                    break
+                if response.status_code not in (200, 201):
+                    continue
+                results.update(dict.fromkeys(batch))
+                results.update(_batch_errors(response, batch))
+
+        if unconfirmed:
+            attached = self.get_knowledge_base_file_ids(kb_id)
+            for file_id in unconfirmed:
+                if attached is None:
+                    # Adding them again could attach them twice; the next sync retries them
+                    results[file_id] = str(batch_error)
+                elif file_id in attached:
+                    results[file_id] = None
+
+        for file_id in file_ids:
+            if file_id in results:
+                continue
+            try:
+                response = self.post(f'/api/v1/knowledge/{kb_id}/file/add', json={'file_id': file_id})
+            except requests.RequestException as e:
+                results[file_id] = str(e)
+                continue
+            results[file_id] = None if response.status_code in (200, 201) else f"{response.status_code} - {response.text}"
+
+        return results
+
+    def get_knowledge_base_file_ids(self, kb_id):
+        """Get the IDs of the files in a knowledge base
+
+        Args:
+            kb_id: Knowledge base ID
+
+        Returns:
+            Set of file IDs, or None if the knowledge base could not be read
+        """
+        try:
+            response = self.get(f'/api/v1/knowledge/{kb_id}')
+        except requests.RequestException:
+            return None
+        if response.status_code != 200:
+            return None
+        try:
+            result = response.json()
+        except ValueError:
+            return None
+        files = result.get('files') if isinstance(result, dict) else None
+        if not isinstance(files, list):
+            return None
+        return {file.get('id') for file in files if isinstance(file, dict)}
+
+    def invalidate_knowledge_bases(self):
+        """Drop the cached knowledge base list"""
+        with self._kb_cache_lock:
+            self._kb_cache = None
+
+    def get_stats(self):
+        """Get per-endpoint request counters
+
+        Returns:
+            Dict of 'METHOD /path' -> dict with 'requests', 'retries', 'errors',
+            'total_seconds' and 'max_seconds'
+        """
+        with self._stats_lock:
+            return {endpoint: dict(stats) for endpoint, stats in self._stats.items()}
+
+    def reset_stats(self):
+        """Clear the per-endpoint request counters"""
+        with self._stats_lock:
+            self._stats.clear()
+
+    def _record(self, endpoint, elapsed, attempt, error=False):
+        with self._stats_lock:
+            stats = self._stats.setdefault(endpoint, {
+                'requests': 0, 'retries': 0, 'errors': 0, 'total_seconds': 0.0, 'max_seconds': 0.0
+            })
+            stats['requests'] += 1
+            if attempt:
+                stats['retries'] += 1
+            if error:
+                stats['errors'] += 1
+            stats['total_seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+
+
+class MultipartUpload:
+    """Streamed multipart/form-data body of a file upload
+
+    Passed to requests as data=, the file is sent in small blocks as it is
+    read instead of being encoded into memory as a whole, so large files
+    need no more memory than small ones. Progress is recorded as the body
+    is read.
+    """
+
+    def __init__(self, fileobj, filename, content_type='application/octet-stream', field='file', progress=None):
+        """Create an upload body
+
+        Args:
+            fileobj: Binary file object positioned at the start of the content
+            filename: Filename sent to the server
+            content_type: Content type of the file part
+            field: Form field name of the file part
+            progress: Optional callable(sent, total) called as the body is read
+        """
+        boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        head = (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; '
+                f'filename="{filename.translate(_FILENAME_ESCAPES)}"\r\nContent-Type: {content_type}\r\n\r\n').encode('utf-8')
+        tail = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+        self._start = fileobj.tell()
+        self.size = fileobj.seek(0, 2) - self._start
+        fileobj.seek(self._start)
+        self._parts = [io.BytesIO(head), fileobj, io.BytesIO(tail)]
+        self._total = len(head) + self.size + len(tail)
+        self._progress = progress
+        self.seek(0)
+
+    def __len__(self):
+        return self._total
+
+    def tell(self):
+        return self.sent
+
+    def seek(self, offset, whence=0):
+        """Rewind the body before it is sent again; only the start is supported"""
+        if offset != 0 or whence != 0:
+            raise io.UnsupportedOperation('MultipartUpload can only be rewound to the start')
+        for part in self._parts:
+            part.seek(0)
+        self._parts[1].seek(self._start)
+        self._part = 0
+        self.sent = 0
+        self.finished_at = None
+        return 0
+
+    def read(self, size=-1):
+        """Read the next block of the body"""
+        chunks = []
+        while self._part < len(self._parts) and size != 0:
+            chunk = self._parts[self._part].read(size)
+            if not chunk:
+                self._part += 1
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        data = b''.join(chunks)
+        self.sent += len(data)
+        if self.sent >= self._total and self.finished_at is None:
+            self.finished_at = time.monotonic()
+        if self._progress and data:
+            self._progress(self.sent, self._total)
+        return data
+
+
+class AdaptiveLimiter:
+    """Concurrency and rate limit for requests that load Open WebUI
+
+    The concurrency limit follows AIMD (additive increase, multiplicative
+    decrease): it grows by about one request per window of healthy requests
+    and is halved when a request is throttled (429), fails (5xx), times out
+    or takes longer than latency_target. Only one cut is made per window of
+    requests, since requests already in flight see the same overload. Token
+    buckets additionally cap requests and bytes per second.
+    """
+
+    def __init__(self, max_concurrency, adaptive=True, latency_target=30, requests_per_second=0, bytes_per_second=0):
+        """Create a limiter
+
+        Args:
+            max_concurrency: Upper bound (and starting value) of the concurrency limit
+            adaptive: Adjust the concurrency limit to the observed health of Open WebUI
+            latency_target: Seconds after which a request counts as a sign of overload
+            requests_per_second: Maximum request rate (0 for no limit)
+            bytes_per_second: Maximum upload rate (0 for no limit)
+        """
+        self.max_concurrency = max(1, max_concurrency)
+        self.adaptive = adaptive
+        self.latency_target = latency_target
+        self.requests_per_second = requests_per_second
+        self.bytes_per_second = bytes_per_second
+
+        self.limit = float(self.max_concurrency)
+        self._in_flight = 0
+        self._last_cut = 0
+        # Buckets hold up to one second of requests and bytes
+        self._request_tokens = max(1.0, requests_per_second)
+        self._byte_tokens = float(bytes_per_second)
+        self._refilled_at = time.monotonic()
+        self._condition = threading.Condition()
+        self.reset_stats()
+
+    def acquire(self, size=0):
+        """Wait until a request of size bytes may start
+
+        Returns:
+            Start time to pass to release()
+        """
+        with self._condition:
+            waited_from = time.monotonic()
+            while True:
+                wait = self._refill_wait(size)
+                if self._in_flight < int(self.limit) and wait == 0:
+                    break
+                self._condition.wait(timeout=wait or None)
+
+            if self.requests_per_second:
+                self._request_tokens -= 1
+            if self.bytes_per_second:
+                self._byte_tokens -= size
+            self._in_flight += 1
+            started = time.monotonic()
+            self._stats['wait_seconds'] += started - waited_from
+            return started
+
+    def release(self, started, elapsed, status):
+        """Report the outcome of a request started with acquire()
+
+        Args:
+            started: Value returned by acquire()
+            elapsed: Seconds the request took
+            status: HTTP status code, or None if the request failed without a response
+        """
+        with self._condition:
+            self._in_flight -= 1
+            overloaded = (status is None or status == 429 or status >= 500
+                          or (self.latency_target and elapsed > self.latency_target))
+            if self.adaptive and overloaded:
+                if started > self._last_cut and self.limit > 1:
+                    self.limit = max(1.0, self.limit / 2)
+                    self._last_cut = time.monotonic()
+                    self._stats['reductions'] += 1
+                    self._stats['lowest'] = min(self._stats['lowest'], self.limit)
+            elif self.adaptive:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def get_stats(self):
+        """Get the current limits and the adjustments since reset_stats()
+
+        Returns:
+            Dict with 'limit', 'max_concurrency', 'lowest', 'reductions',
+            'wait_seconds', 'requests_per_second' and 'bytes_per_second'
+        """
+        with self._condition:
+            return {
+                **self._stats,
+                'limit': self.limit,
+                'max_concurrency': self.max_concurrency,
+                'requests_per_second': self.requests_per_second,
+                'bytes_per_second': self.bytes_per_second
+            }
+
+    def reset_stats(self):
+        """Clear the adjustment counters (the learned limit is kept)"""
+        self._stats = {'lowest': self.limit, 'reductions': 0, 'wait_seconds': 0.0}
+
+    def _refill_wait(self, size):
+        """Refill the token buckets; seconds until a request of size bytes may start"""
+        now = time.monotonic()
+        elapsed = now - self._refilled_at
+        self._refilled_at = now
+        wait = 0
+        if self.requests_per_second:
+            self._request_tokens = min(max(1.0, self.requests_per_second), self._request_tokens + elapsed * self.requests_per_second)
+            if self._request_tokens < 1:
+                wait = max(wait, (1 - self._request_tokens) / self.requests_per_second)
+        if self.bytes_per_second:
+            self._byte_tokens = min(float(self.bytes_per_second), self._byte_tokens + elapsed * self.bytes_per_second)
+            # Files larger than the bucket wait for a full bucket and leave it in debt
+            needed = min(size, self.bytes_per_second)
+            if self._byte_tokens < needed:
+                wait = max(wait, (needed - self._byte_tokens) / self.bytes_per_second)
+        return wait
+
+
+def _backoff(attempt):
+    """Exponential backoff: 1, 2, 4... seconds, capped at 30"""
+    return min(30, 2 ** attempt)
+
+
+def _retry_after(response):
+    """Seconds from a Retry-After header, or None"""
+    try:
+        return min(60, max(0, float(response.headers.get('Retry-After', ''))))
+    except ValueError:
+        return None
+
+
+def _detail(response):
+    """The 'detail' message of an error response, or None"""
+    try:
+        return response.json().get('detail')
+    except (ValueError, AttributeError):
+        return None
+
+
+def _batch_errors(response, file_ids):
+    """Per-file errors reported in the warnings of a batch attach response
+
+    Open WebUI reports files it could not add as "<file id>: <error>".
+    """
+    try:
+        warnings = response.json().get('warnings') or {}
+    except (ValueError, AttributeError):
+        return {}
+    errors = {}
+    for error in warnings.get('errors') or []:
+        file_id, _, message = str(error).partition(':')
+        if file_id.strip() in file_ids:
+            errors[file_id.strip()] = message.strip() or warnings.get('message') or 'Failed to add file'
+    return errors
+
+
+def _files_size(files):
+    """Total size in bytes of the file objects of a multipart upload"""
+    size = 0
+    for value in (files.values() if isinstance(files, dict) else files):
+        if isinstance(value, tuple):
+            value = value[1] if len(value) > 1 else value[0]
+        if hasattr(value, 'seek') and hasattr(value, 'tell'):
+            position = value.tell()
+            size += value.seek(0, 2) - position
+            value.seek(position)
+        elif isinstance(value, (bytes, str)):
+            size += len(value)
+    return size
+
+
+def _rewind_files(files):
+    """Seek file objects of a multipart upload back to the start before a retry"""
+    for value in (files.values() if isinstance(files, dict) else files):
+        if isinstance(value, tuple):
+            value = value[1] if len(value) > 1 else value[0]
+        if hasattr(value, 'seek'):
+            value.seek(0)
+
+
+def get_client(base_url, api_key, **options):
+    """Get the shared client for an Open WebUI instance
+
+    Clients are kept per URL, API key and options, so connections and the
+    knowledge base cache are reused between calls.
+
+    Args:
+        base_url: Open WebUI URL
+        api_key: Open WebUI API key
+        **options: Passed to OpenWebUIClient
+
+    Returns:
+        OpenWebUIClient
+    """
+    key = (base_url.rstrip('/'), api_key, tuple(sorted(options.items())))
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = OpenWebUIClient(base_url, api_key, **options)
+        return _clients[key]
@@ -0,0 +1,1164 @@
+#!/usr/bin/env python3
+"""
+Durable storage of the sync state shared by sync.py and web.py
+JSON state file with a journal of changed entries, compacted into the
+file atomically once the journal has grown, and the SQLite state backend
+with one row per file. Writers take an fcntl lock next to the state; edits
+made by the web interface are recorded so that a running sync merges them
+into its state before saving. File entries are held in memory as entry
+dicts, or as compact FileRecords when the store is created with records=True.
+"""
+import fcntl
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections.abc import Mapping, MutableMapping
+from datetime import datetime, timedelta
+from operator import attrgetter
+from pathlib import Path
+
+# Journal records are fsynced in groups of this many records, or after this many seconds
+JOURNAL_GROUP_RECORDS = 32
+JOURNAL_GROUP_SECONDS = 1.0
+
+# The journal is compacted into the state file once it is this large compared to the file
+JOURNAL_COMPACT_PERCENT = 25
+
+# Columns of the files table that are indexed for lookups, taken from the entry of the same name
+FILE_COLUMNS = ('status', 'knowledge_base', 'file_id', 'hash', 'source_name')
+
+# Extensions converted to Markdown before upload, counted as conversions in summaries
+CONVERTED_EXTENSIONS = ('.json', '.yaml', '.yml', '.conf')
+
+# Fields of file entries kept in the slots of a FileRecord, in the order they are written
+RECORD_FIELDS = ('hash', 'size', 'mtime_ns', 'inode', 'dev', 'hashed_at', 'hash_algorithm', 'status', 'file_id',
+                 'last_attempt', 'retry_count', 'knowledge_base', 'source_type', 'source_name', 'file_size',
+                 'created_at', 'modified_at', 'filename')
+
+# Record fields whose few distinct values are shared by all records
+SHARED_FIELDS = frozenset(('dev', 'hash_algorithm', 'status', 'knowledge_base', 'source_type', 'source_name'))
+
+# Record fields holding ISO timestamps, kept as integer microseconds since 1970
+TIMESTAMP_FIELDS = frozenset(('hashed_at', 'last_attempt', 'created_at', 'modified_at'))
+
+_RECORD_SLOTS = frozenset(RECORD_FIELDS)
+# How the value of each record field is stored: as it is, shared, or as a timestamp
+_PLAIN, _SHARED, _TIMESTAMP = range(3)
+_FIELD_KINDS = {field: _TIMESTAMP if field in TIMESTAMP_FIELDS else _SHARED if field in SHARED_FIELDS else _PLAIN
+                for field in RECORD_FIELDS}
+_get_record_values = attrgetter(*RECORD_FIELDS)
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+_SHARED_VALUES = {}
+_MISSING = object()
+
+
+class FileRecord(MutableMapping):
+    """State entry of one file, kept compactly in memory
+
+    Used in place of an entry dict in state['files'] and behaves like one
+    (get, [], in, pop, update, items, ==), and is written as the same JSON
+    object (see json_default). With a million files the entries dominate
+    the memory of a sync, so instead of a dict per file the RECORD_FIELDS
+    are kept in slots, the values of SHARED_FIELDS (status, knowledge base,
+    source, ...) are shared by all records, and timestamps are kept as
+    integers. Other fields, such as an error message, are kept in a dict
+    created only for the records that have them.
+    """
+
+    __slots__ = RECORD_FIELDS + ('_extra',)
+
+    def __init__(self, fields=()):
+        """Create a record
+
+        Args:
+            fields: Entry dict, or iterable of (field, value) pairs
+        """
+        self._extra = None
+        for field, value in (fields.items() if isinstance(fields, Mapping) else fields):
+            # Same as self[field] = value, which is slower, for a record without the field yet
+            kind = _FIELD_KINDS.get(field)
+            if kind == _PLAIN:
+                setattr(self, field, value)
+            elif kind == _SHARED:
+                setattr(self, field, _share(value))
+            elif kind == _TIMESTAMP and type(value) is str:
+                setattr(self, field, _parse_timestamp(value))
+            else:
+                self[field] = value
+
+    def __getitem__(self, field):
+        if field in _RECORD_SLOTS:
+            value = getattr(self, field, _MISSING)
+            if value is not _MISSING:
+                if type(value) is int and field in TIMESTAMP_FIELDS:
+                    return _format_timestamp(value)
+                return value
+        if self._extra is not None and field in self._extra:
+            return self._extra[field]
+        raise KeyError(field)
+
+    def __setitem__(self, field, value):
+        kind = _FIELD_KINDS.get(field)
+        # Timestamps that are not strings are kept as they are, with the other fields
+        if kind is not None and (kind != _TIMESTAMP or type(value) is str):
+            if kind == _TIMESTAMP:
+                value = _parse_timestamp(value)
+            elif kind == _SHARED:
+                value = _share(value)
+            setattr(self, field, value)
+            if self._extra is not None and field in self._extra:
+                self._delete_extra(field)
+            return
+        if kind is not None and hasattr(self, field):
+            delattr(self, field)
+        if self._extra is None:
+            self._extra = {}
+        self._extra[field] = value
+
+    def __delitem__(self, field):
+        if field in _RECORD_SLOTS and hasattr(self, field):
+            delattr(self, field)
+        elif self._extra is not None and field in self._extra:
+            self._delete_extra(field)
+        else:
+            raise KeyError(field)
+
+    def __contains__(self, field):
+        if field in _RECORD_SLOTS and hasattr(self, field):
+            return True
+        return self._extra is not None and field in self._extra
+
+    def __iter__(self):
+        for field in RECORD_FIELDS:
+            if hasattr(self, field):
+                yield field
+        if self._extra is not None:
+            yield from list(self._extra)
+
+    def __len__(self):
+        count = sum(1 for field in RECORD_FIELDS if hasattr(self, field))
+        return count + (len(self._extra) if self._extra is not None else 0)
+
+    def __repr__(self):
+        return f"FileRecord({self.to_dict()!r})"
+
+    def copy(self):
+        """Independent copy of the record"""
+        return FileRecord(self.to_dict())
+
+    def to_dict(self):
+        """The entry as a dict, in the format of the JSON state file"""
+        entry = {}
+        for field in RECORD_FIELDS:
+            value = getattr(self, field, _MISSING)
+            if value is not _MISSING:
+                entry[field] = _format_timestamp(value) if type(value) is int and field in TIMESTAMP_FIELDS else value
+        if self._extra is not None:
+            entry.update(self._extra)
+        return entry
+
+    def fingerprint(self):
+        """Tuple of the stored values, equal for records with the same fields (used to find changed entries)"""
+        try:
+            values = _get_record_values(self)
+        except AttributeError:
+            values = tuple(getattr(self, field, _MISSING) for field in RECORD_FIELDS)
+        if self._extra is None:
+            return values
+        return values, tuple(self._extra.items())
+
+    def _delete_extra(self, field):
+        del self._extra[field]
+        if not self._extra:
+            self._extra = None
+
+
+def _share(value):
+    """The instance of a value shared by all records"""
+    try:
+        # Keyed by type as well, so that e.g. a dev of 1 is not replaced with True
+        return _SHARED_VALUES.setdefault((type(value), value), value)
+    except TypeError:
+        return value
+
+
+def _parse_timestamp(value):
+    """Microseconds since 1970 of an ISO timestamp, or the string itself if it would not be written back the same"""
+    # Only the layouts isoformat() writes, YYYY-MM-DDTHH:MM:SS with or without .ffffff, are converted
+    length = len(value)
+    if not (length == 26 and value[4:20:3] == '--T::.' or length == 19 and value[4:17:3] == '--T::'):
+        return value
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        return value
+    # isoformat() leaves out a zero microsecond, and an offset would be lost
+    if moment.tzinfo is not None or (moment.microsecond != 0) != (length == 26):
+        return value
+    return (moment - _EPOCH) // _MICROSECOND
+
+
+def _format_timestamp(micros):
+    return (_EPOCH + timedelta(microseconds=micros)).isoformat()
+
+
+def get_entry_datetime(entry, field):
+    """Timestamp field of a file entry as a datetime, without formatting it as a string first
+
+    Args:
+        entry: FileRecord or entry dict
+        field: Field name, e.g. 'hashed_at'
+
+    Returns:
+        Naive datetime, or None if the entry has no such field
+
+    Raises:
+        ValueError: If the field is not an ISO timestamp
+    """
+    if field in TIMESTAMP_FIELDS and isinstance(entry, FileRecord):
+        value = getattr(entry, field, None)
+        if type(value) is int:
+            return _EPOCH + timedelta(microseconds=value)
+    value = entry.get(field)
+    return datetime.fromisoformat(value) if value else None
+
+
+def json_default(value):
+    """default= hook of json.dump() that writes FileRecords as entry objects"""
+    if isinstance(value, FileRecord):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def compact_file_entries(state):
+    """Replace the entry dicts in state['files'] with FileRecords, in place"""
+    files = state.get('files')
+    if not isinstance(files, dict):
+        return
+    for file_key, entry in files.items():
+        if type(entry) is dict:
+            files[file_key] = FileRecord(entry)
+
+
+def _decode_object(pairs):
+    """object_pairs_hook of json.load() that reads file entries straight into FileRecords"""
+    # Entries are written with 'hash' first (see RECORD_FIELDS), so most need no dict
+    if pairs and pairs[0][0] == 'hash':
+        record = FileRecord(pairs)
+        if hasattr(record, 'status'):
+            return record
+    entry = dict(pairs)
+    if 'hash' in entry and 'status' in entry:
+        return FileRecord(entry)
+    return entry
+
+
+def _digest(value):
+    """Hash of an entry or section, compared with the one last written to find changes"""
+    try:
+        if isinstance(value, FileRecord):
+            return hash(value.fingerprint())
+        if type(value) is dict:
+            # Flat entries are hashed by their items; nested values raise TypeError
+            return hash(tuple(value.items()))
+    except TypeError:
+        pass
+    return hash(json.dumps(value, separators=(',', ':'), default=json_default))
+
+
+def get_journal_file(state_file):
+    """Path of the journal kept next to a state file, e.g. sync_state.json.journal"""
+    return f"{state_file}.journal"
+
+
+def get_lock_file(path):
+    """Path of the writer lock of a state file or database, e.g. sync_state.json.lock"""
+    return f"{path}.lock"
+
+
+def get_edits_file(path):
+    """Path of the pending edits of a state file or database, e.g. sync_state.json.edits"""
+    return f"{path}.edits"
+
+
+class StateLock:
+    """Exclusive fcntl lock taken by the writers of a state file or database
+
+    The sync holds it only while it saves or writes an entry, and the web
+    interface while it applies an edit, so neither waits for long; readers
+    never take it. The
+    lock file also holds the version of the state, a counter increased by
+    every write, which readers get with read_state_version().
+    """
+
+    def __init__(self, path):
+        """Create the lock of a state file or database (taken with a with statement)
+
+        Args:
+            path: State file or database path
+        """
+        self.path = get_lock_file(path)
+        self._fd = None
+
+    def __enter__(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+        return self
+
+    def __exit__(self, *exc_info):
+        fd, self._fd = self._fd, None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def bump_version(self):
+        """Increase the version of the state; call while holding the lock
+
+        Returns:
+            The new version
+        """
+        version = _parse_version(os.pread(self._fd, 32, 0)) + 1
+        os.pwrite(self._fd, f"{version:020d}\n".encode('ascii'), 0)
+        return version
+
+
+def read_state_version(path):
+    """Version of a state file or database, read without taking the lock
+
+    Returns:
+        Number of writes made since the lock file was created, 0 if there is none
+    """
+    try:
+        with open(get_lock_file(path), 'rb') as f:
+            return _parse_version(f.read(32))
+    except FileNotFoundError:
+        return 0
+
+
+def get_state_stamp(path):
+    """Stamp of a state file or database that changes whenever its state does
+
+    Made of the state version (see StateLock) and the inode, modification
+    time and size of the state file and of its journal or write-ahead log,
+    so it is taken without reading them.
+
+    Args:
+        path: State file or database path
+
+    Returns:
+        Tuple that compares equal as long as the state is unchanged
+    """
+    stamp = [read_state_version(path)]
+    for file_path in (path, get_journal_file(path), f"{path}-wal"):
+        try:
+            stat = os.stat(file_path)
+            stamp.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+def _parse_version(data):
+    try:
+        return int(data)
+    except ValueError:
+        return 0
+
+
+def apply_state_edits(state, edits):
+    """Apply edits made in the web interface to the files of a state
+
+    An edit {"key": file key, "op": "remove"} removes the entry of a file,
+    unless it has a "file_id" that the entry no longer has (the file was
+    uploaded again since). {"key": file key, "op": "update", "fields": {...}}
+    sets fields of the entry. Edits of files without an entry are ignored.
+
+    Args:
+        state: State dict, changed in place
+        edits: List of edits, in the order they were made
+
+    Returns:
+        List of the file keys whose entries changed
+    """
+    files = state.get('files', {})
+    changed = []
+    for edit in edits:
+        entry = files.get(edit['key'])
+        if entry is None:
+            continue
+        if edit['op'] == 'remove':
+            if 'file_id' in edit and edit['file_id'] != entry.get('file_id'):
+                continue
+            del files[edit['key']]
+        elif all(entry.get(field) == value for field, value in edit['fields'].items()):
+            continue
+        else:
+            entry.update(edit['fields'])
+        changed.append(edit['key'])
+    return changed
+
+
+def read_state_edits(path, after_version=0):
+    """Read the pending edits of a state file or database
+
+    Args:
+        path: State file or database path
+        after_version: Only edits recorded after this state version are returned
+
+    Returns:
+        List of edits, in the order they were made
+    """
+    edits = []
+    try:
+        with open(get_edits_file(path), 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    edit = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if edit['version'] > after_version:
+                    edits.append(edit)
+    except FileNotFoundError:
+        pass
+    return edits
+
+
+def merge_state_edits(path, state, after_version=0):
+    """Apply the pending edits of a state file or database to a state held in memory
+
+    Args:
+        path: State file or database path
+        state: State dict, changed in place
+        after_version: Version of the last edit already merged into the state
+
+    Returns:
+        Tuple of (version of the last edit merged, or after_version if there
+        were none, number of entries changed)
+    """
+    edits = read_state_edits(path, after_version)
+    if not edits:
+        return after_version, 0
+    return edits[-1]['version'], len(apply_state_edits(state, edits))
+
+
+def record_state_edits(lock, path, edits):
+    """Record edits that were applied to a state file or database as pending edits
+
+    Args:
+        lock: StateLock of the path, held by the caller
+        path: State file or database path
+        edits: List of edits (see apply_state_edits)
+    """
+    version = lock.bump_version()
+    with open(get_edits_file(path), 'a', encoding='utf-8') as f:
+        for edit in edits:
+            f.write(json.dumps({'version': version, **edit}, separators=(',', ':')) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def clear_state_edits(path):
+    """Remove the pending edits once a save of the sync contains them; call while holding the lock"""
+    try:
+        os.unlink(get_edits_file(path))
+    except FileNotFoundError:
+        pass
+
+
+def _pin_file_ids(files, edits):
+    """Add the file_id of the entry to remove edits, so a file uploaded again since is kept"""
+    pinned = []
+    for edit in edits:
+        entry = files.get(edit['key'])
+        if edit['op'] == 'remove' and entry and 'file_id' not in edit:
+            edit = {**edit, 'file_id': entry.get('file_id')}
+        pinned.append(edit)
+    return pinned
+
+
+class StateJournal:
+    """Append-only journal of state changes made since the state file was last compacted
+
+    Each line is a JSON record {"section": ..., "key": ..., "entry": ...};
+    an entry of null removes the key, and a key of null replaces a whole
+    section (such as the directory manifest). Each record is appended with
+    a single write, so the sync and the web interface can append to the
+    same journal. Records are fsynced in small groups, so an interrupted
+    sync loses at most the last group.
+    """
+
+    def __init__(self, path, group_records=JOURNAL_GROUP_RECORDS, group_seconds=JOURNAL_GROUP_SECONDS):
+        """Open a journal for appending
+
+        Args:
+            path: Journal file path (see get_journal_file)
+            group_records: Records written before they are fsynced
+            group_seconds: Seconds after which written records are fsynced
+        """
+        self.path = path
+        self.group_records = group_records
+        self.group_seconds = group_seconds
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def append(self, section, key, entry):
+        """Record the new value of a state entry
+
+        Args:
+            section: State section, e.g. 'files' or 'knowledge_bases'
+            key: Key of the entry in the section, or None for the whole section
+            entry: New entry dict, or None if the entry was removed
+        """
+        record = json.dumps({'section': section, 'key': key, 'entry': entry}, separators=(',', ':'), default=json_default)
+        with self._lock:
+            os.write(self._fd, (record + '\n').encode('utf-8'))
+            self._unsynced += 1
+            if self._unsynced >= self.group_records or time.monotonic() - self._synced_at >= self.group_seconds:
+                self._sync()
+
+    def sync(self):
+        """Flush and fsync the records written so far"""
+        with self._lock:
+            self._sync()
+
+    def size(self):
+        """Size in bytes of the records written so far"""
+        with self._lock:
+            return os.fstat(self._fd).st_size
+
+    def truncate(self):
+        """Drop all records, once the state file containing them is saved"""
+        with self._lock:
+            os.ftruncate(self._fd, 0)
+            self._unsynced = 1
+            self._sync()
+
+    def close(self):
+        """Sync and close the journal"""
+        with self._lock:
+            if self._fd is not None:
+                self._sync()
+                os.close(self._fd)
+                self._fd = None
+
+    def _sync(self):
+        if self._unsynced:
+            os.fsync(self._fd)
+            self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+
+def replay_journal(path, state, offset=0, records=False):
+    """Apply the records of a journal to a state loaded from the state file
+
+    A partly written last record (the sync stopped while appending it, or
+    is appending it) is ignored.
+
+    Args:
+        path: Journal file path
+        state: State dict, changed in place
+        offset: Byte offset to start at, to apply only the records appended
+            since an earlier replay returned this offset
+        records: Read file entries as FileRecords instead of dicts
+
+    Returns:
+        Tuple of (number of records applied, offset after the last complete record)
+    """
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return 0, 0
+
+    applied = 0
+    with f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            try:
+                record = json.loads(line, object_pairs_hook=_decode_object if records else None)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                continue
+            if record['key'] is None:
+                if record['entry'] is None:
+                    state.pop(record['section'], None)
+                else:
+                    state[record['section']] = record['entry']
+                applied += 1
+                continue
+            section = state.setdefault(record['section'], {})
+            if record['entry'] is None:
+                section.pop(record['key'], None)
+            else:
+                section[record['key']] = record['entry']
+            applied += 1
+    return applied, offset
+
+
+def remove_journal(path):
+    """Remove a journal whose records are contained in the saved state file"""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def write_json_atomic(path, data):
+    """Write a JSON file so that it is either completely old or completely new
+
+    The data is written to a temporary file in the same directory, fsynced,
+    and renamed over the file.
+
+    Args:
+        path: File path
+        data: Data to write (indented for readability)
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2, default=json_default)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.chmod(temp_path, os.stat(path).st_mode & 0o777)
+        except FileNotFoundError:
+            os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+    # Make the rename itself durable
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+class JSONStateStore:
+    """Sync state kept in a JSON state file and its journal
+
+    save() appends the entries that changed since the state was loaded or
+    last saved to the journal (see StateJournal), so a save costs as much
+    as the changes rather than the whole state. Once the journal has grown
+    to compact_percent of the state file, the state is written to the state
+    file atomically (see write_json_atomic) and the journal is emptied.
+
+    The web interface changes the state with apply_edits(), which also
+    records the edits as pending; load() and save() merge them into the
+    state held by the sync, so its save does not undo them.
+    """
+
+    def __init__(self, path, compact_percent=JOURNAL_COMPACT_PERCENT, records=False):
+        """Create a store for a state file
+
+        Args:
+            path: State file path
+            compact_percent: Journal size, in percent of the state file
+                size, at which the journal is compacted (0 compacts on every save)
+            records: Load file entries as FileRecords, which hold about 45%
+                less memory than dicts but take about 3x as long to load
+        """
+        self.path = path
+        self.journal_path = get_journal_file(path)
+        self.compact_percent = compact_percent
+        self.records = records
+        # Number of journal records applied by the last load(), and offset after the last of them
+        self.replayed = 0
+        self.journal_offset = 0
+        # Version of the last pending edit merged, and number of entries changed by the last merge
+        self.edits_version = 0
+        self.merged_edits = 0
+        self.lock = StateLock(path)
+        self.journal = None
+        # (section, key) -> hash of the JSON last written, to find changed entries
+        self._saved = {}
+        self._file_size = 0
+        self._lock = threading.Lock()
+
+    def load(self, normalize=None):
+        """Read the state file, apply its journal and merge the pending edits
+
+        Does not wait for the writer lock.
+
+        Args:
+            normalize: Optional function applied to the state read from the
+                file before the journal, e.g. to migrate an old format
+
+        Returns:
+            State dict
+        """
+        with self._lock:
+            state = self._load(normalize)
+            self.edits_version, self.merged_edits = merge_state_edits(self.path, state, self.edits_version)
+        return state
+
+    def save(self, state):
+        """Merge the pending edits, then journal the entries that changed
+
+        The journal is compacted once it is large. The writer lock is held
+        throughout, so no edit is recorded between the merge and the save.
+
+        Args:
+            state: State dict, changed in place by the merged edits
+
+        Returns:
+            Number of entries written or removed
+        """
+        with self._lock, self.lock:
+            self.edits_version, self.merged_edits = merge_state_edits(self.path, state, self.edits_version)
+            changes = self._diff(state)
+            if changes:
+                journal = self._open_journal()
+                for section, key in changes:
+                    journal.append(section, key, _get_entry(state, section, key))
+                journal.sync()
+                self.lock.bump_version()
+            # Entries journaled with put() count as well
+            journal_size = self.journal.size() if self.journal else _file_size(self.journal_path)
+            if journal_size and journal_size * 100 >= self._file_size * self.compact_percent:
+                self._compact(state)
+            clear_state_edits(self.path)
+        return len(changes)
+
+    def apply_edits(self, edits):
+        """Apply edits to the files and record them for a running sync to merge
+
+        The changed entries are journaled right away, without compacting the
+        journal, which a running sync may be appending to.
+
+        Args:
+            edits: List of edits (see apply_state_edits)
+
+        Returns:
+            List of the file keys whose entries changed
+        """
+        with self._lock, self.lock:
+            state = self._load()
+            edits = _pin_file_ids(state.get('files', {}), edits)
+            changed = apply_state_edits(state, edits)
+            if changed:
+                journal = StateJournal(self.journal_path)
+                for file_key in changed:
+                    journal.append('files', file_key, state['files'].get(file_key))
+                journal.close()
+                record_state_edits(self.lock, self.path, [edit for edit in edits if edit['key'] in changed])
+        return changed
+
+    def put(self, section, key, entry):
+        """Journal one entry right away
+
+        The writer lock is held, so the entry is not journaled between the
+        load and the journaling of an edit (see apply_edits).
+
+        Args:
+            section: 'files' or 'knowledge_bases'
+            key: File key or knowledge base name
+            entry: New entry, or None to remove it
+        """
+        with self._lock, self.lock:
+            if entry is None:
+                self._saved.pop((section, key), None)
+            else:
+                self._saved[(section, key)] = _digest(entry)
+            self._open_journal().append(section, key, entry)
+
+    def compact(self, state):
+        """Write the whole state to the state file and empty the journal"""
+        with self._lock, self.lock:
+            for section_key, digest in _iter_digests(state):
+                self._saved[section_key] = digest
+            self._compact(state)
+            self.lock.bump_version()
+
+    def close(self):
+        """Sync and close the journal, removing it if it is empty"""
+        with self._lock:
+            if self.journal:
+                self.journal.close()
+                self.journal = None
+                # The web interface appends to the journal while holding the lock
+                with self.lock:
+                    if not _file_size(self.journal_path):
+                        remove_journal(self.journal_path)
+
+    def _load(self, normalize=None):
+        self._saved = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                state = json.load(f, object_pairs_hook=_decode_object if self.records else None)
+            self._file_size = os.path.getsize(self.path)
+        else:
+            state = {}
+            self._file_size = 0
+        if normalize:
+            state = normalize(state)
+        self.replayed, self.journal_offset = replay_journal(self.journal_path, state, records=self.records)
+        if self.records:
+            compact_file_entries(state)
+        for section_key, digest in _iter_digests(state):
+            self._saved[section_key] = digest
+        return state
+
+    def _diff(self, state):
+        """(section, key) of the entries that changed since they were last written"""
+        changes = []
+        seen = set()
+        for section_key, digest in _iter_digests(state):
+            seen.add(section_key)
+            if self._saved.get(section_key) != digest:
+                self._saved[section_key] = digest
+                changes.append(section_key)
+        for section_key in self._saved.keys() - seen:
+            del self._saved[section_key]
+            changes.append(section_key)
+        return changes
+
+    def _open_journal(self):
+        if self.journal is None:
+            self.journal = StateJournal(self.journal_path)
+        return self.journal
+
+    def _compact(self, state):
+        write_json_atomic(self.path, state)
+        self._file_size = os.path.getsize(self.path)
+        if self.journal:
+            self.journal.truncate()
+        else:
+            remove_journal(self.journal_path)
+
+
+def _file_size(path):
+    """Size of a file in bytes, 0 if it does not exist"""
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+def _iter_digests(state):
+    """Yield ((section, key), digest) for the entries of a state (see _digest)
+
+    Files and knowledge bases are compared entry by entry; the other
+    sections as a whole, with a key of None.
+    """
+    for name, value in state.items():
+        if name in ('files', 'knowledge_bases') and isinstance(value, dict):
+            for key, entry in value.items():
+                yield (name, key), _digest(entry)
+        else:
+            yield (name, None), _digest(value)
+
+
+def _get_entry(state, section, key):
+    """Current value of an entry yielded by _iter_digests, or None if it was removed"""
+    if key is None:
+        return state.get(section)
+    return state.get(section, {}).get(key)
+
+
+def get_state_db_file(state_file):
+    """Path of the SQLite database kept instead of a state file, e.g. sync_state.db"""
+    return str(Path(state_file).with_suffix('.db'))
+
+
+def summarize_files(files, max_retries):
+    """Count state entries by status, knowledge base and source
+
+    Args:
+        files: Dict of file key -> entry (the 'files' section of a state)
+        max_retries: Attempts after which a failed file is no longer retried
+
+    Returns:
+        Dict of (status, knowledge base, source name) -> dict with 'files',
+        'conversions', 'pending_retries' and 'last_attempt' (the latest)
+    """
+    summary = {}
+    for file_key, entry in files.items():
+        status = entry.get('status', 'unknown')
+        group = summary.setdefault((status, entry.get('knowledge_base', ''), entry.get('source_name', 'Unknown')),
+                                   {'files': 0, 'conversions': 0, 'pending_retries': 0, 'last_attempt': None})
+        group['files'] += 1
+        if os.path.splitext(file_key)[1].lower() in CONVERTED_EXTENSIONS:
+            group['conversions'] += 1
+        if status == 'failed' and entry.get('retry_count', 0) < max_retries:
+            group['pending_retries'] += 1
+        last_attempt = entry.get('last_attempt')
+        if last_attempt and (not group['last_attempt'] or last_attempt > group['last_attempt']):
+            group['last_attempt'] = last_attempt
+    return summary
+
+
+class SQLiteStateStore:
+    """Sync state kept in a SQLite database in WAL mode
+
+    Files and knowledge bases are stored one row per entry, with the entry
+    as JSON and the FILE_COLUMNS copied into indexed columns. The other
+    sections of the state (directory manifest, backlog) are stored as one
+    JSON value each. save() writes only the entries that changed since the
+    state was loaded or last saved, and readers such as the web interface
+    are not blocked while a sync writes. Edits of the web interface are
+    recorded and merged like those of JSONStateStore.
+    """
+
+    def __init__(self, path, records=False):
+        """Open a database, creating it if it does not exist
+
+        Args:
+            path: Database file path (see get_state_db_file)
+            records: Load file entries as FileRecords instead of dicts
+        """
+        self.path = path
+        self.records = records
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        # True until mark_initialized() is called, so the caller can import a JSON state file
+        self.created = self.conn.execute('PRAGMA user_version').fetchone()[0] == 0
+        if self.created:
+            with self.conn:
+                self.conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS files (file_key TEXT PRIMARY KEY, "
+                    f"{', '.join(f'{column} TEXT' for column in FILE_COLUMNS)}, entry TEXT NOT NULL)"
+                )
+                for column in FILE_COLUMNS:
+                    self.conn.execute(f"CREATE INDEX IF NOT EXISTS files_{column} ON files ({column})")
+                self.conn.execute('CREATE TABLE IF NOT EXISTS knowledge_bases (name TEXT PRIMARY KEY, entry TEXT NOT NULL)')
+                self.conn.execute('CREATE TABLE IF NOT EXISTS sections (name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        # (section, key) -> hash of the JSON last written, to find changed entries
+        self._saved = {}
+        self._lock = threading.Lock()
+        # Version of the last pending edit merged, and number of entries changed by the last merge
+        self.edits_version = 0
+        self.merged_edits = 0
+        self.lock = StateLock(path)
+
+    def mark_initialized(self):
+        """Record that the database holds its initial state, e.g. an imported JSON state file
+
+        Until then the database counts as created on every open, so an
+        import that failed is tried again instead of leaving an empty state.
+        """
+        with self._lock, self.conn:
+            self.conn.execute('PRAGMA user_version=1')
+        self.created = False
+
+    def load(self):
+        """Read the whole state and merge the pending edits
+
+        Returns:
+            State dict in the format of the JSON state file
+        """
+        state = {'files': {}, 'knowledge_bases': {}}
+        with self._lock:
+            self._saved = {}
+            for file_key, text in self.conn.execute('SELECT file_key, entry FROM files'):
+                entry = state['files'][file_key] = self._file_entry(text)
+                self._saved[('files', file_key)] = _digest(entry)
+            for name, text in self.conn.execute('SELECT name, entry FROM knowledge_bases'):
+                entry = state['knowledge_bases'][name] = json.loads(text)
+                self._saved[('knowledge_bases', name)] = _digest(entry)
+            for name, text in self.conn.execute('SELECT name, value FROM sections'):
+                state[name] = json.loads(text)
+                self._saved[('sections', name)] = _digest(state[name])
+            self.edits_version, self.merged_edits = merge_state_edits(self.path, state, self.edits_version)
+        return state
+
+    def save(self, state):
+        """Merge the pending edits, then write the entries that changed since the last load() or save()
+
+        Args:
+            state: State dict, changed in place by the merged edits
+
+        Returns:
+            Number of rows written or removed
+        """
+        changes = []
+        with self._lock, self.lock:
+            self.edits_version, self.merged_edits = merge_state_edits(self.path, state, self.edits_version)
+            seen = set()
+            for section in ('files', 'knowledge_bases'):
+                for key, entry in state.get(section, {}).items():
+                    self._collect(changes, seen, section, key, entry)
+            for name, value in state.items():
+                if name not in ('files', 'knowledge_bases'):
+                    self._collect(changes, seen, 'sections', name, value)
+            for section_key in self._saved.keys() - seen:
+                changes.append((section_key[0], section_key[1], None, None))
+                del self._saved[section_key]
+            self._write(changes)
+            if changes:
+                self.lock.bump_version()
+            clear_state_edits(self.path)
+        return len(changes)
+
+    def put(self, section, key, entry):
+        """Write one entry right away
+
+        Args:
+            section: 'files' or 'knowledge_bases'
+            key: File key or knowledge base name
+            entry: New entry, or None to remove it
+        """
+        self.put_many(section, {key: entry})
+
+    def put_many(self, section, entries):
+        """Write several entries of a section in one transaction
+
+        Args:
+            section: 'files' or 'knowledge_bases'
+            entries: Dict of key -> new entry, or None to remove the entry
+        """
+        with self._lock, self.lock:
+            self._put_many(section, entries)
+
+    def apply_edits(self, edits):
+        """Apply edits to the files and record them for a running sync to merge
+
+        Args:
+            edits: List of edits (see apply_state_edits)
+
+        Returns:
+            List of the file keys whose entries changed
+        """
+        with self._lock, self.lock:
+            state = {'files': self.get_files([edit['key'] for edit in edits])}
+            edits = _pin_file_ids(state['files'], edits)
+            changed = apply_state_edits(state, edits)
+            if changed:
+                self._put_many('files', {file_key: state['files'].get(file_key) for file_key in changed})
+                record_state_edits(self.lock, self.path, [edit for edit in edits if edit['key'] in changed])
+        return changed
+
+    def get_files(self, file_keys):
+        """Get the entries of some files
+
+        Returns:
+            Dict of file key -> entry for the keys that exist
+        """
+        files = {}
+        for file_key in file_keys:
+            row = self.conn.execute('SELECT entry FROM files WHERE file_key = ?', (file_key,)).fetchone()
+            if row:
+                files[file_key] = self._file_entry(row[0])
+        return files
+
+    def find_file_keys(self, column, value):
+        """Keys of the files whose indexed column has a value
+
+        Args:
+            column: One of FILE_COLUMNS
+            value: Value to look up
+
+        Returns:
+            List of file keys
+        """
+        if column not in FILE_COLUMNS:
+            raise ValueError(f"Not an indexed column: {column}")
+        return [row[0] for row in self.conn.execute(f"SELECT file_key FROM files WHERE {column} = ?", (value,))]
+
+    def get_knowledge_base_names(self):
+        """Distinct knowledge base names of the files"""
+        return [row[0] for row in self.conn.execute(
+            "SELECT DISTINCT knowledge_base FROM files WHERE knowledge_base IS NOT NULL AND knowledge_base != ''"
+        )]
+
+    def get_knowledge_bases(self):
+        """The knowledge_bases section: dict of name -> entry"""
+        return {name: json.loads(text) for name, text in self.conn.execute('SELECT name, entry FROM knowledge_bases')}
+
+    def summarize_files(self, max_retries):
+        """Count files by status, knowledge base and source without reading the entries
+
+        Returns:
+            Dict in the format of summarize_files()
+        """
+        conversion = ' OR '.join(f"file_key LIKE '%{extension}'" for extension in CONVERTED_EXTENSIONS)
+        summary = {}
+        rows = self.conn.execute(
+            f"SELECT COALESCE(status, 'unknown'), COALESCE(knowledge_base, ''), COALESCE(source_name, 'Unknown'), COUNT(*), "
+            f"SUM(CASE WHEN {conversion} THEN 1 ELSE 0 END), "
+            f"SUM(CASE WHEN status = 'failed' AND COALESCE(json_extract(entry, '$.retry_count'), 0) < ? THEN 1 ELSE 0 END), "
+            f"MAX(json_extract(entry, '$.last_attempt')) "
+            f"FROM files GROUP BY 1, 2, 3",
+            (max_retries,)
+        )
+        for status, kb_name, source_name, files, conversions, pending_retries, last_attempt in rows:
+            summary[(status, kb_name, source_name)] = {
+                'files': files,
+                'conversions': conversions,
+                'pending_retries': pending_retries,
+                'last_attempt': last_attempt
+            }
+        return summary
+
+    def close(self):
+        """Close the database"""
+        with self._lock:
+            self.conn.close()
+
+    def _file_entry(self, text):
+        entry = json.loads(text)
+        return FileRecord(entry) if self.records else entry
+
+    def _put_many(self, section, entries):
+        changes = []
+        for key, entry in entries.items():
+            if entry is None:
+                changes.append((section, key, None, None))
+                self._saved.pop((section, key), None)
+            else:
+                self._collect(changes, set(), section, key, entry)
+        self._write(changes)
+
+    def _collect(self, changes, seen, section, key, entry):
+        """Add an entry to changes if it differs from the one last written"""
+        seen.add((section, key))
+        digest = _digest(entry)
+        if self._saved.get((section, key)) != digest:
+            self._saved[(section, key)] = digest
+            changes.append((section, key, json.dumps(entry, separators=(',', ':'), default=json_default), entry))
+
+    def _write(self, changes):
+        """Write (section, key, JSON text, entry) changes in one transaction; a text of None removes the entry"""
+        if not changes:
+            return
+        with self.conn:
+            for section, key, text, entry in changes:
+                if section == 'files':
+                    if text is None:
+                        self.conn.execute('DELETE FROM files WHERE file_key = ?', (key,))
+                    else:
+                        values = [entry.get(column) if isinstance(entry, Mapping) else None for column in FILE_COLUMNS]
+                        self.conn.execute(
+                            f"INSERT OR REPLACE INTO files (file_key, {', '.join(FILE_COLUMNS)}, entry) "
+                            f"VALUES (?, {', '.join('?' * len(FILE_COLUMNS))}, ?)",
+                            (key, *values, text)
+                        )
+                elif section == 'knowledge_bases':
+                    if text is None:
+                        self.conn.execute('DELETE FROM knowledge_bases WHERE name = ?', (key,))
+                    else:
+                        self.conn.execute('INSERT OR REPLACE INTO knowledge_bases (name, entry) VALUES (?, ?)', (key, text))
+                elif text is None:
+                    self.conn.execute('DELETE FROM sections WHERE name = ?', (key,))
+                else:
+                    self.conn.execute('INSERT OR REPLACE INTO sections (name, value) VALUES (?, ?)', (key, text))
@@ -6,11 +6,17 @@ import os
 import sys
 import glob
 import hashlib
+import heapq
 import json
 import requests
 import time
 import re
+import sqlite3
 import tempfile
+import threading
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 from pathlib import Path
 from datetime import datetime
 
@@ -29,6 +35,15 @@ try:
 except ImportError:
     paramiko = None
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+from openwebui_client import AdaptiveLimiter, MultipartUpload, get_client
+from state_store import (FileRecord, JSONStateStore, SQLiteStateStore, get_entry_datetime, get_journal_file,
+                         get_state_db_file, json_default)
+
 # Import config management module
 try:
     from config import get_config
@@ -43,7 +58,11 @@ if USE_CONFIG_FILE:
     OPENWEBUI_API_KEY = _CONFIG['openwebui']['api_key']
     FILES_DIR = _CONFIG['files']['directory']
     ALLOWED_EXTENSIONS = _CONFIG['files']['allowed_extensions']
+    CASE_INSENSITIVE_EXTENSIONS = _CONFIG['files']['case_insensitive_extensions']
     STATE_FILE = _CONFIG['files']['state_file']
+    STATE_BACKEND = _CONFIG['files']['state_backend']
+    STATE_COMPACT_PERCENT = _CONFIG['files']['state_compact_percent']
+    STATE_COMPACT_RECORDS = _CONFIG['files']['state_compact_records']
     KNOWLEDGE_BASE_NAME = _CONFIG['knowledge_bases']['single_kb_name'] if _CONFIG['knowledge_bases']['single_kb_mode'] else ''
     KNOWLEDGE_BASE_MAPPINGS = json.dumps(_CONFIG['knowledge_bases']['mappings']) if _CONFIG['knowledge_bases']['mappings'] else ''
     KNOWLEDGE_BASE_MAPPING = ''  # Legacy format, not used with config file
@@ -53,13 +72,49 @@ if USE_CONFIG_FILE:
     SSH_REMOTE_SOURCES = json.dumps(_CONFIG['ssh']['sources']) if _CONFIG['ssh']['enabled'] and _CONFIG['ssh']['sources'] else ''
     SSH_KEY_PATH = _CONFIG['ssh']['key_path']
     SSH_STRICT_HOST_KEY_CHECKING = _CONFIG['ssh']['strict_host_key_checking']
+    REHASH_INTERVAL_DAYS = _CONFIG['performance']['rehash_interval_days']
+    HASH_WORKERS = _CONFIG['performance']['hash_workers']
+    HASH_BUFFER_SIZE = _CONFIG['performance']['hash_buffer_size']
+    HASH_ALGORITHM = _CONFIG['performance']['hash_algorithm']
+    WATCH_DEBOUNCE_SECONDS = _CONFIG['sync']['watch_debounce_seconds']
+    WATCH_RECONCILE_HOURS = _CONFIG['sync']['watch_reconcile_hours']
+    DIRECTORY_MANIFEST_HOURS = _CONFIG['performance']['directory_manifest_hours']
+    DELETE_MISSING_FILES = _CONFIG['sync']['delete_missing_files']
+    DELETE_MAX_PERCENT = _CONFIG['sync']['delete_max_percent']
+    DELETE_WORKERS = _CONFIG['sync']['delete_workers']
+    DEDUPLICATE_UPLOADS = _CONFIG['sync']['deduplicate_uploads']
+    SYNC_SHARD = _CONFIG['sync']['shard']
+    MAX_RUN_SECONDS = _CONFIG['sync']['max_run_seconds']
+    MAX_FILES = _CONFIG['sync']['max_files']
+    MAX_BYTES = _CONFIG['sync']['max_bytes']
+    UPLOAD_WORKERS = _CONFIG['performance']['upload_workers']
+    PROCESSING_WORKERS = _CONFIG['performance']['processing_workers']
+    KB_ATTACH_WORKERS = _CONFIG['performance']['kb_attach_workers']
+    KB_ATTACH_BATCH_SIZE = _CONFIG['performance']['kb_attach_batch_size']
+    UPLOAD_LARGE_FILE_MB = _CONFIG['performance']['upload_large_file_mb']
+    UPLOAD_LARGE_WORKERS = _CONFIG['performance']['upload_large_workers']
+    KB_PRIORITIES = _CONFIG['performance']['kb_priorities']
+    UPLOAD_SPOOL_MB = _CONFIG['performance']['upload_spool_mb']
+    OPENWEBUI_TIMEOUT = _CONFIG['openwebui']['timeout']
+    OPENWEBUI_MAX_RETRIES = _CONFIG['openwebui']['max_retries']
+    OPENWEBUI_POOL_SIZE = _CONFIG['openwebui']['pool_size']
+    OPENWEBUI_KB_CACHE_SECONDS = _CONFIG['openwebui']['kb_cache_seconds']
+    OPENWEBUI_ADAPTIVE_CONCURRENCY = _CONFIG['openwebui']['adaptive_concurrency']
+    OPENWEBUI_LATENCY_TARGET = _CONFIG['openwebui']['latency_target']
+    OPENWEBUI_MAX_REQUESTS_PER_SECOND = _CONFIG['openwebui']['max_requests_per_second']
+    OPENWEBUI_MAX_MB_PER_SECOND = _CONFIG['openwebui']['max_mb_per_second']
+    OPENWEBUI_MIN_MB_PER_SECOND = _CONFIG['openwebui']['min_mb_per_second']
 else:
     # Fallback to environment variables
     OPENWEBUI_URL = os.getenv('OPENWEBUI_URL', 'http://localhost:8080')
     OPENWEBUI_API_KEY = os.getenv('OPENWEBUI_API_KEY', '')
     FILES_DIR = os.getenv('FILES_DIR', '/data')
     ALLOWED_EXTENSIONS = os.getenv('ALLOWED_EXTENSIONS', '.md,.txt,.pdf,.doc,.docx,.json,.yaml,.yml,.conf,.toml').split(',')
+    CASE_INSENSITIVE_EXTENSIONS = os.getenv('CASE_INSENSITIVE_EXTENSIONS', 'false').lower() == 'true'
     STATE_FILE = os.getenv('STATE_FILE', '/app/sync_state.json')
+    STATE_BACKEND = os.getenv('STATE_BACKEND', 'json').strip().lower()
+    STATE_COMPACT_PERCENT = float(os.getenv('STATE_COMPACT_PERCENT', '25'))
+    STATE_COMPACT_RECORDS = os.getenv('STATE_COMPACT_RECORDS', 'false').lower() == 'true'
     KNOWLEDGE_BASE_MAPPING = os.getenv('KNOWLEDGE_BASE_MAPPING', '')
     KNOWLEDGE_BASE_NAME = os.getenv('KNOWLEDGE_BASE_NAME', '')
     KNOWLEDGE_BASE_MAPPINGS = os.getenv('KNOWLEDGE_BASE_MAPPINGS', '')
@@ -69,11 +124,71 @@ else:
     SSH_REMOTE_SOURCES = os.getenv('SSH_REMOTE_SOURCES', '')
     SSH_KEY_PATH = os.getenv('SSH_KEY_PATH', '/app/ssh_keys')
     SSH_STRICT_HOST_KEY_CHECKING = os.getenv('SSH_STRICT_HOST_KEY_CHECKING', 'false').lower() == 'true'
+    REHASH_INTERVAL_DAYS = float(os.getenv('REHASH_INTERVAL_DAYS', '7'))
+    HASH_WORKERS = int(os.getenv('HASH_WORKERS', '0'))
+    HASH_BUFFER_SIZE = max(int(os.getenv('HASH_BUFFER_SIZE', str(1024 * 1024))), 64 * 1024)
+    HASH_ALGORITHM = os.getenv('HASH_ALGORITHM', 'md5').strip().lower()
+    WATCH_DEBOUNCE_SECONDS = float(os.getenv('WATCH_DEBOUNCE_SECONDS', '5'))
+    WATCH_RECONCILE_HOURS = float(os.getenv('WATCH_RECONCILE_HOURS', '6'))
+    DIRECTORY_MANIFEST_HOURS = float(os.getenv('DIRECTORY_MANIFEST_HOURS', '0'))
+    DELETE_MISSING_FILES = os.getenv('DELETE_MISSING_FILES', 'false').lower() == 'true'
+    DELETE_MAX_PERCENT = float(os.getenv('DELETE_MAX_PERCENT', '50'))
+    DELETE_WORKERS = int(os.getenv('DELETE_WORKERS', '4'))
+    DEDUPLICATE_UPLOADS = os.getenv('DEDUPLICATE_UPLOADS', 'true').lower() == 'true'
+    SYNC_SHARD = os.getenv('SYNC_SHARD', '').strip()
+    MAX_RUN_SECONDS = float(os.getenv('MAX_RUN_SECONDS', '0'))
+    MAX_FILES = int(os.getenv('MAX_FILES', '0'))
+    MAX_BYTES = int(os.getenv('MAX_BYTES', '0'))
+    UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', '4'))
+    PROCESSING_WORKERS = int(os.getenv('PROCESSING_WORKERS', '8'))
+    KB_ATTACH_WORKERS = int(os.getenv('KB_ATTACH_WORKERS', '4'))
+    KB_ATTACH_BATCH_SIZE = int(os.getenv('KB_ATTACH_BATCH_SIZE', '100'))
+    UPLOAD_LARGE_FILE_MB = float(os.getenv('UPLOAD_LARGE_FILE_MB', '50'))
+    UPLOAD_LARGE_WORKERS = int(os.getenv('UPLOAD_LARGE_WORKERS', '1'))
+    try:
+        KB_PRIORITIES = json.loads(os.getenv('KB_PRIORITIES', '') or '{}')
+    except json.JSONDecodeError:
+        KB_PRIORITIES = {}
+    UPLOAD_SPOOL_MB = float(os.getenv('UPLOAD_SPOOL_MB', '8'))
+    OPENWEBUI_TIMEOUT = float(os.getenv('OPENWEBUI_TIMEOUT', '30'))
+    OPENWEBUI_MAX_RETRIES = int(os.getenv('OPENWEBUI_MAX_RETRIES', '3'))
+    OPENWEBUI_POOL_SIZE = int(os.getenv('OPENWEBUI_POOL_SIZE', '16'))
+    OPENWEBUI_KB_CACHE_SECONDS = float(os.getenv('OPENWEBUI_KB_CACHE_SECONDS', '60'))
+    OPENWEBUI_ADAPTIVE_CONCURRENCY = os.getenv('OPENWEBUI_ADAPTIVE_CONCURRENCY', 'true').lower() == 'true'
+    OPENWEBUI_LATENCY_TARGET = float(os.getenv('OPENWEBUI_LATENCY_TARGET', '20'))
+    OPENWEBUI_MAX_REQUESTS_PER_SECOND = float(os.getenv('OPENWEBUI_MAX_REQUESTS_PER_SECOND', '0'))
+    OPENWEBUI_MAX_MB_PER_SECOND = float(os.getenv('OPENWEBUI_MAX_MB_PER_SECOND', '0'))
+    OPENWEBUI_MIN_MB_PER_SECOND = float(os.getenv('OPENWEBUI_MIN_MB_PER_SECOND', '1'))
+
 
+# Supported content hash algorithms ('xxhash' requires the xxhash package)
+HASH_ALGORITHMS = ('md5', 'sha256', 'blake2b', 'xxhash')
 
 # Global dict to store SSH file metadata (local_path -> remote_info)
 SSH_FILE_METADATA = {}
 
+# Global dict to cache stat results collected during discovery (path -> os.stat_result)
+FILE_STAT_CACHE = {}
+
+# Global set of directories (relative to FILES_DIR) skipped as unchanged by the directory manifest
+UNCHANGED_DIRECTORIES = set()
+
+# Shard handled by this process (1-based) and number of shards; set by configure_shard()
+SHARD_INDEX = 1
+SHARD_COUNT = 1
+# State file of the unsharded sync, which seeds the state of a shard's first run
+UNSHARDED_STATE_FILE = None
+
+# Adaptive limiter of upload requests, see get_upload_limiter()
+UPLOAD_LIMITER = None
+
+# Store of the sync state (JSON file and journal, or SQLite database), see get_state_store()
+STATE_STORE = None
+
+# Upload throughput in bytes per second observed on files of at least 1 MB, see get_upload_timeout()
+UPLOAD_THROUGHPUT = None
+UPLOAD_THROUGHPUT_LOCK = threading.Lock()
+
 def log(message):
     """Log with timestamp"""
     timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -620,81 +735,107 @@ def convert_toml_to_markdown(toml_data, filename):
 
 
 
-def add_file_metadata_header(filepath, source_info, original_path=None, created_time=None, modified_time=None):
-    """Add metadata header to file content
+def build_metadata_header(filepath, source_info, original_path=None, created_time=None, modified_time=None):
+    """Build the metadata header added in front of file content
+    
+    Args:
+        filepath: Path to the file the header describes
+        source_info: Dict with source information (type, name, host)
+        original_path: Original path of the file (if different from current)
+        created_time: Original creation timestamp (epoch seconds)
+        modified_time: Original modification timestamp (epoch seconds)
+    
+    Returns:
+        Header string, ending with a blank line
+    """
+    # Use provided timestamps or get from file stats
+    if created_time:
+        created = datetime.fromtimestamp(created_time).strftime('%Y-%m-%d %H:%M:%S')
+    else:
+        created = datetime.fromtimestamp(filepath.stat().st_ctime).strftime('%Y-%m-%d %H:%M:%S')
+    
+    if modified_time:
+        modified = datetime.fromtimestamp(modified_time).strftime('%Y-%m-%d %H:%M:%S')
+    else:
+        modified = datetime.fromtimestamp(filepath.stat().st_mtime).strftime('%Y-%m-%d %H:%M:%S')
+    # Build metadata header
+    metadata_lines = [
+        "<!-- File Metadata",
+        f"Source: {source_info.get('name', 'Unknown')}",
+        f"Source Type: {source_info.get('type', 'unknown')}",
+    ]
+    
+    if source_info.get('type') == 'ssh':
+        metadata_lines.append(f"SSH Host: {source_info.get('host', 'unknown')}")
+    
+    if original_path:
+        metadata_lines.append(f"Original Path: {original_path}")
+    
+    metadata_lines.extend([
+        f"Original Filename: {filepath.name}",
+        f"Created: {created}",
+        f"Modified: {modified}",
+        f"Synced: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+        "-->",
+        ""
+    ])
+    
+    return "\n".join(metadata_lines) + "\n"
+
+# Characters copied at a time from a text file into its upload content
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+def open_upload_content(filepath, source_info, original_path=None, created_time=None, modified_time=None):
+    """Build the content to upload: metadata header followed by the converted or original content
+    
+    The content is kept in memory and only spilled to a temporary file when it
+    grows beyond UPLOAD_SPOOL_MB. Files that cannot get a header (not UTF-8
+    text) are uploaded as they are.
     
     Args:
-        filepath: Path to the file to add metadata to
+        filepath: Path to the file
         source_info: Dict with source information (type, name, host)
-        original_path: Original path of the file (if different from current) (if different from current)
+        original_path: Original path of the file (if different from current)
         created_time: Original creation timestamp (epoch seconds)
         modified_time: Original modification timestamp (epoch seconds)
     
     Returns:
-        Tuple of (success: bool, new_filepath: Path or None, is_temp: bool)
+        Tuple of (success: bool, content: file object or None, converted: bool)
+        - success: False if the file could not be converted
+        - content: Readable file object positioned at the start; the caller closes it
+        - converted: True if the content was converted or a header was added
     """
+    conversion_success, markdown_content = convert_file_to_markdown(filepath)
+    if not conversion_success:
+        return False, None, False
+    
+    content = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MB * 1024 * 1024)
     try:
-        # Read original content
-        with open(filepath, 'r', encoding='utf-8') as f:
-            original_content = f.read()
-        
-        # Get file stats
-        # Use provided timestamps or get from file stats
-        from datetime import datetime
-        if created_time:
-            created = datetime.fromtimestamp(created_time).strftime('%Y-%m-%d %H:%M:%S')
+        header = build_metadata_header(filepath, source_info, original_path, created_time, modified_time)
+        content.write(header.encode('utf-8'))
+        if markdown_content is not None:
+            content.write(markdown_content.encode('utf-8'))
         else:
-            created = datetime.fromtimestamp(filepath.stat().st_ctime).strftime('%Y-%m-%d %H:%M:%S')
-        
-        if modified_time:
-            modified = datetime.fromtimestamp(modified_time).strftime('%Y-%m-%d %H:%M:%S')
-        else:
-            modified = datetime.fromtimestamp(filepath.stat().st_mtime).strftime('%Y-%m-%d %H:%M:%S')
-        # Build metadata header
-        metadata_lines = [
-            "<!-- File Metadata",
-            f"Source: {source_info.get('name', 'Unknown')}",
-            f"Source Type: {source_info.get('type', 'unknown')}",
-        ]
-        
-        if source_info.get('type') == 'ssh':
-            metadata_lines.append(f"SSH Host: {source_info.get('host', 'unknown')}")
-        
-        if original_path:
-            metadata_lines.append(f"Original Path: {original_path}")
-        
-        metadata_lines.extend([
-            f"Original Filename: {filepath.name}",
-            f"Created: {created}",
-            f"Modified: {modified}",
-            f"Synced: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
-            "-->",
-            ""
-        ])
-        
-        # Combine metadata and content
-        new_content = "\n".join(metadata_lines) + "\n" + original_content
-        
-        # Create temp file with metadata
-        import tempfile
-        temp_fd, temp_path = tempfile.mkstemp(suffix=filepath.suffix, prefix=f"{filepath.stem}_meta_")
-        try:
-            with os.fdopen(temp_fd, 'w', encoding='utf-8') as temp_file:
-                temp_file.write(new_content)
-            log(f"  ✓ Added metadata header to {filepath.name}")
-            return True, Path(temp_path), True
-        except Exception as e:
-            log(f"  ✗ Error writing file with metadata: {e}")
-            os.close(temp_fd)
-            try:
-                os.unlink(temp_path)
-            except:
-                pass
-            return False, None, False
-            
+            with open(filepath, 'r', encoding='utf-8') as f:
+                for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), ''):
+                    content.write(chunk.encode('utf-8'))
+        log(f"  ✓ Added metadata header to {filepath.name}")
     except Exception as e:
+        # Continue with the content without metadata
         log(f"  ✗ Error adding metadata to {filepath.name}: {e}")
-        return False, None, False
+        content.seek(0)
+        content.truncate()
+        if markdown_content is None:
+            content.close()
+            try:
+                return True, open(filepath, 'rb'), False
+            except OSError as e:
+                log(f"✗ Error reading {filepath.name}: {e}")
+                return False, None, False
+        content.write(markdown_content.encode('utf-8'))
+    
+    content.seek(0)
+    return True, content, True
 
 
 def generate_unique_filename(filepath, source_info):
@@ -804,21 +945,20 @@ def convert_file_to_markdown(filepath):
         filepath: Path to the file
     
     Returns:
-        Tuple of (success: bool, converted_filepath: Path or None, is_temp: bool)
+        Tuple of (success: bool, markdown_content: str or None)
         - success: Whether conversion was successful or not needed
-        - converted_filepath: Path to the converted file (temp file) or original if no conversion
-        - is_temp: True if a temporary file was created that needs cleanup
+        - markdown_content: Converted content, or None if the file is uploaded as-is
     """
     ext = filepath.suffix.lower()
     
     # Skip conversion for markdown files - upload as-is
     if ext in ['.md', '.markdown']:
-        return True, filepath, False
+        return True, None
     
     # Check if file is text
     if not is_text_file(filepath):
         # Not a text file, return as-is (e.g., PDF, images, etc.)
-        return True, filepath, False
+        return True, None
     
     try:
         with open(filepath, 'r', encoding='utf-8') as f:
@@ -878,25 +1018,12 @@ def convert_file_to_markdown(filepath):
             # Generic text file conversion
             markdown_content = convert_text_to_markdown(content, filepath.name)
         
-        # Create temporary markdown file
-        temp_fd, temp_path = tempfile.mkstemp(suffix='.md', prefix=f"{filepath.stem}_")
-        try:
-            with os.fdopen(temp_fd, 'w', encoding='utf-8') as temp_file:
-                temp_file.write(markdown_content)
-            log(f"✓ Converted {filepath.name} to Markdown")
-            return True, Path(temp_path), True
-        except Exception as e:
-            log(f"✗ Error writing converted file: {e}")
-            os.close(temp_fd)
-            try:
-                os.unlink(temp_path)
-            except:
-                pass
-            return False, None, False
+        log(f"✓ Converted {filepath.name} to Markdown")
+        return True, markdown_content
             
     except Exception as e:
         log(f"✗ Error converting {filepath.name}: {e}")
-        return False, None, False
+        return False, None
 
 def verify_state_file_access():
     """Verify that the state file directory exists and is writable
@@ -925,6 +1052,16 @@ def verify_state_file_access():
         log(f"  Please ensure the container has write permissions to this location")
         return False
     
+    if STATE_BACKEND == 'sqlite':
+        try:
+            store = get_state_store()
+        except sqlite3.Error as e:
+            log(f"✗ ERROR: Cannot open state database {get_state_db_file(STATE_FILE)}: {e}")
+            log(f"  Please ensure the container has write permissions to this location")
+            return False
+        log(f"✓ State database is accessible: {store.path}")
+        return True
+    
     # Check if state file exists
     if not os.path.exists(STATE_FILE):
         log(f"State file does not exist: {STATE_FILE}")
@@ -935,8 +1072,10 @@ def verify_state_file_access():
                 'files': {},
                 'knowledge_bases': {}
             }
+            # A shard's first run starts from its entries in the unsharded state
+            seed_shard_state(initial_state)
             with open(STATE_FILE, 'w') as f:
-                json.dump(initial_state, f, indent=2)
+                json.dump(initial_state, f, indent=2, default=json_default)
             log(f"✓ Created initial state file: {STATE_FILE}")
         except Exception as e:
             log(f"✗ ERROR: Cannot create state file {STATE_FILE}: {e}")
@@ -1068,426 +1207,2220 @@ def get_knowledge_base_for_file(filepath, kb_mapping, kb_filters):
     
     return None, {}, None
 
-def load_state():
-    """Load previous sync state"""
-    if os.path.exists(STATE_FILE):
-        try:
-            with open(STATE_FILE, 'r') as f:
-                state = json.load(f)
-                
-                # Check if this is the old format (flat dict with file_path: hash)
-                # Old format: {"path/to/file.txt": "hash123", ...}
-                # New format: {"files": {...}, "knowledge_bases": {...}}
-                if 'files' not in state and 'knowledge_bases' not in state:
-                    # Migrate old format to new format
-                    log("Migrating old state format to new format...")
-                    old_state = state.copy()
-                    state = {
-                        'files': {},
-                        'knowledge_bases': {}
-                    }
-                    # Convert old entries to new format
-                    for file_key, file_hash in old_state.items():
-                        if isinstance(file_hash, str):  # Ensure it's a simple hash string
-                            state['files'][file_key] = {
-                                'hash': file_hash,
-                                'status': 'uploaded',
-                                'retry_count': 0
-                            }
-                    log(f"Migrated {len(state['files'])} file entries")
-                
-                # Ensure both keys exist
-                if 'files' not in state:
-                    state['files'] = {}
-                if 'knowledge_bases' not in state:
-                    state['knowledge_bases'] = {}
-                
-                return state
-        except Exception as e:
-            log(f"Error loading state file: {e}")
+def get_state_store():
+    """Get the store of the sync state, opened on first use
     
-    return {
-        'files': {},  # file_key -> {hash, status, last_attempt, retry_count, knowledge_base}
-        'knowledge_bases': {}  # kb_name -> {id, created_at}
-    }
-
-def save_state(state):
-    """Save sync state"""
-    try:
-        os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
-        with open(STATE_FILE, 'w') as f:
-            json.dump(state, f, indent=2)
-    except Exception as e:
-        log(f"Error saving state file: {e}")
+    Returns:
+        SQLiteStateStore with the SQLite backend, otherwise JSONStateStore
+    """
+    global STATE_STORE
+    if STATE_STORE is None:
+        if STATE_BACKEND == 'sqlite':
+            STATE_STORE = SQLiteStateStore(get_state_db_file(STATE_FILE), records=STATE_COMPACT_RECORDS)
+        else:
+            STATE_STORE = JSONStateStore(STATE_FILE, compact_percent=STATE_COMPACT_PERCENT, records=STATE_COMPACT_RECORDS)
+    return STATE_STORE
 
-def get_file_hash(filepath):
-    """Calculate MD5 hash of file"""
-    hash_md5 = hashlib.md5()
-    try:
-        with open(filepath, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
-    except Exception as e:
-        log(f"Error hashing file {filepath}: {e}")
-        return None
+def close_state_store():
+    """Close the state store; call after the final save_state() of a sync"""
+    global STATE_STORE
+    if STATE_STORE:
+        STATE_STORE.close()
+        STATE_STORE = None
 
-def get_files_to_sync():
-    """Get list of files to sync"""
-    files = []
-    files_dir = Path(FILES_DIR)
+def load_state():
+    """Load previous sync state
     
-    if not files_dir.exists():
-        log(f"Files directory does not exist: {FILES_DIR}")
-        return files
+    The state file is read together with the changes journaled since it
+    was last compacted, including those of an interrupted sync, and the
+    edits made in the web interface that no save of a sync contains yet.
+    With the SQLite backend, a new database is first filled from an
+    existing JSON state file, or for a shard from the unsharded state.
     
-    for ext in ALLOWED_EXTENSIONS:
-        ext = ext.strip()
-        pattern = f"**/*{ext}"
-        for filepath in files_dir.glob(pattern):
-            if filepath.is_file():
-                files.append(filepath)
+    Raises:
+        RuntimeError: If the JSON state file to import cannot be read
+    """
+    if STATE_BACKEND == 'sqlite':
+        store = get_state_store()
+        if store.created:
+            if os.path.exists(STATE_FILE):
+                try:
+                    state = read_state_file()
+                except Exception as e:
+                    # Left unmarked, so the import is tried again on the next sync
+                    raise RuntimeError(f"Cannot import state file {STATE_FILE} into {store.path}: {e}")
+                store.save(state)
+                log(f"✓ Imported {len(state['files'])} file entries from {STATE_FILE} into {store.path}")
+            else:
+                state = migrate_state({})
+                if seed_shard_state(state):
+                    store.save(state)
+            store.mark_initialized()
+        state = store.load()
+    else:
+        store = get_state_store()
+        try:
+            state = store.load(migrate_state)
+        except Exception as e:
+            log(f"Error loading state file: {e}")
+            return migrate_state({})
+    if store.merged_edits:
+        log(f"↻ Merged {store.merged_edits} state edit(s) made in the web interface")
+    return state
+
+def read_state_file():
+    """Read the state file and its journal, migrating old formats
     
-    return files
+    Raises:
+        Exception: If the state file cannot be read or parsed
+    """
+    return JSONStateStore(STATE_FILE, records=STATE_COMPACT_RECORDS).load(migrate_state)
 
-def create_or_get_knowledge_base(kb_name, state):
-    """Create or get a knowledge base by name
+def migrate_state(state):
+    """Bring a state read from the state file up to the current format
     
     Args:
-        kb_name: Name of the knowledge base
-        state: Current state dict
+        state: State dict as read from the file (empty if there is none)
     
     Returns:
-        Knowledge base ID or None if failed
+        State dict with 'files' and 'knowledge_bases' sections
     """
-    # Check if we already have this knowledge base in state
-    if 'knowledge_bases' not in state:
-        state['knowledge_bases'] = {}
+    # Check if this is the old format (flat dict with file_path: hash)
+    # Old format: {"path/to/file.txt": "hash123", ...}
+    # New format: {"files": {...}, "knowledge_bases": {...}}
+    if state and 'files' not in state and 'knowledge_bases' not in state:
+        # Migrate old format to new format
+        log("Migrating old state format to new format...")
+        old_state = state.copy()
+        state = {
+            'files': {},
+            'knowledge_bases': {}
+        }
+        # Convert old entries to new format
+        for file_key, file_hash in old_state.items():
+            if isinstance(file_hash, str):  # Ensure it's a simple hash string
+                state['files'][file_key] = {
+                    'hash': file_hash,
+                    'hash_algorithm': 'md5',
+                    'status': 'uploaded',
+                    'retry_count': 0
+                }
+        log(f"Migrated {len(state['files'])} file entries")
     
-    if kb_name in state['knowledge_bases']:
-        kb_id = state['knowledge_bases'][kb_name].get('id')
-        if kb_id:
-            log(f"Using existing knowledge base: {kb_name} (ID: {kb_id})")
-            return kb_id
+    # Ensure both keys exist
+    state.setdefault('files', {})  # file_key -> {hash, status, last_attempt, retry_count, knowledge_base}
+    state.setdefault('knowledge_bases', {})  # kb_name -> {id, created_at}
     
-    # Try to create or get the knowledge base
-    url = f"{OPENWEBUI_URL.rstrip('/')}/api/v1/knowledge/"
-    headers = {
-        'Authorization': f'Bearer {OPENWEBUI_API_KEY}',
-        'Content-Type': 'application/json'
-    }
+    # Entries written before hash algorithms were configurable use MD5.
+    # They are re-keyed to HASH_ALGORITHM as each file is next seen.
+    for file_state in state['files'].values():
+        if file_state.get('hash') and 'hash_algorithm' not in file_state:
+            file_state['hash_algorithm'] = 'md5'
     
+    return state
+
+def save_state(state):
+    """Save sync state
+    
+    Edits made in the web interface since the state was loaded are merged
+    into it first, so the save does not undo them. Only the entries that
+    changed since the last save are written: to the journal of the state
+    file, which is compacted into the file atomically once it has grown to
+    STATE_COMPACT_PERCENT of the file, or to their rows with the SQLite
+    backend.
+    """
     try:
-        # First try to list existing knowledge bases
-        response = requests.get(url, headers=headers, timeout=30)
-        if response.status_code == 200:
-            kbs = response.json()
-            # Look for existing knowledge base with this name
-            if isinstance(kbs, list):
-                for kb in kbs:
-                    if kb.get('name') == kb_name:
-                        kb_id = kb.get('id')
-                        log(f"Found existing knowledge base: {kb_name} (ID: {kb_id})")
-                        state['knowledge_bases'][kb_name] = {
-                            'id': kb_id,
-                            'created_at': datetime.now().isoformat()
-                        }
-                        return kb_id
-        
-        # If not found, try to create it
-        data = {
-            'name': kb_name,
-            'description': f'Auto-created knowledge base for {kb_name}'
-        }
-        response = requests.post(url, headers=headers, json=data, timeout=30)
-        
-        if response.status_code in [200, 201]:
-            result = response.json()
-            kb_id = result.get('id')
-            log(f"Created new knowledge base: {kb_name} (ID: {kb_id})")
-            state['knowledge_bases'][kb_name] = {
-                'id': kb_id,
-                'created_at': datetime.now().isoformat()
-            }
-            return kb_id
-        else:
-            log(f"Failed to create knowledge base {kb_name}: {response.status_code} - {response.text}")
-            return None
-    except Exception as e:
-        log(f"Error creating/getting knowledge base {kb_name}: {e}")
-        return None
+        os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+        store = get_state_store()
+        store.save(state)
+        if store.merged_edits:
+            log(f"↻ Merged {store.merged_edits} state edit(s) made in the web interface")
+    except (OSError, sqlite3.Error) as e:
+        log(f"Error saving state: {e}")
 
-def upload_file_to_openwebui(filepath, file_hash, kb_id=None, upload_filename=None):
-    """Upload a file to Open WebUI Knowledge Base
+def journal_state_change(state, key, section='files'):
+    """Journal the current value of a state entry (removed if missing)
+    
+    With the SQLite backend, the entry's row is written instead.
     
     Args:
-        filepath: Path to the file to upload
-        file_hash: MD5 hash of the file
-        kb_id: Optional knowledge base ID to associate file with (not used during upload)
-        upload_filename: Optional custom filename to use for upload (if different from filepath.name)
+        state: Current state dict
+        key: File key (or knowledge base name)
+        section: 'files' or 'knowledge_bases'
+    """
+    if STATE_STORE:
+        STATE_STORE.put(section, key, state[section].get(key))
+
+def new_hasher(algorithm):
+    """Create a hash object for a supported algorithm
+    
+    Args:
+        algorithm: One of HASH_ALGORITHMS
     
     Returns:
-        Tuple of (success: bool, file_id: str or None)
+        Object with update() and hexdigest() methods
     """
-    url = f"{OPENWEBUI_URL.rstrip('/')}/api/v1/files/"
-    
-    headers = {
-        'Authorization': f'Bearer {OPENWEBUI_API_KEY}'
-    }
+    if algorithm == 'md5':
+        return hashlib.md5()
+    elif algorithm == 'sha256':
+        return hashlib.sha256()
+    elif algorithm == 'blake2b':
+        return hashlib.blake2b(digest_size=32)
+    elif algorithm == 'xxhash' and xxhash is not None:
+        return xxhash.xxh3_128()
+    raise ValueError(f"Unsupported hash algorithm: {algorithm}")
+
+def get_hash_algorithm():
+    """Get the configured hash algorithm, falling back to MD5 if it is unavailable"""
+    if HASH_ALGORITHM == 'xxhash' and xxhash is None:
+        log("⚠ xxhash library not installed, using md5 for file hashes")
+        return 'md5'
+    if HASH_ALGORITHM not in HASH_ALGORITHMS:
+        log(f"⚠ Unknown HASH_ALGORITHM '{HASH_ALGORITHM}', using md5 for file hashes")
+        return 'md5'
+    return HASH_ALGORITHM
+
+def get_file_hashes(filepath, algorithms, buffer_size=None):
+    """Calculate one or more hashes of a file in a single read
     
-    # Use custom filename if provided, otherwise use original
-    filename_to_use = upload_filename if upload_filename else filepath.name
+    Args:
+        filepath: Path to the file
+        algorithms: Iterable of algorithm names (see HASH_ALGORITHMS)
+        buffer_size: Read size in bytes, defaults to HASH_BUFFER_SIZE
     
+    Returns:
+        Dict of algorithm -> hex digest, or None if the file could not be read
+    """
     try:
-        with open(filepath, 'rb') as f:
-            files = {
-                'file': (filename_to_use, f, 'application/octet-stream')
-            }
-            
-            # Note: knowledge_base_id is not passed during upload
-            # Files must be added to knowledge base after upload using add_file_to_knowledge_base()
-            response = requests.post(url, headers=headers, files=files, timeout=30)
-            
-            if response.status_code in [200, 201]:
-                result = response.json()
-                file_id = result.get('id')
-                log(f"✓ Uploaded: {filename_to_use}")
-                return True, file_id
-            else:
-                log(f"✗ Failed to upload {filename_to_use}: {response.status_code} - {response.text}")
-                return False, None
+        hashers = {algorithm: new_hasher(algorithm) for algorithm in algorithms}
+        buffer = bytearray(buffer_size or HASH_BUFFER_SIZE)
+        view = memoryview(buffer)
+        with open(filepath, "rb", buffering=0) as f:
+            while True:
+                size = f.readinto(buffer)
+                if not size:
+                    break
+                for hasher in hashers.values():
+                    hasher.update(view[:size])
+        return {algorithm: hasher.hexdigest() for algorithm, hasher in hashers.items()}
     except Exception as e:
-        log(f"✗ Error uploading {filename_to_use}: {e}")
-        return False, None
+        log(f"Error hashing file {filepath}: {e}")
+        return None
 
-def add_file_to_knowledge_base(kb_id, file_id):
-    """Add an uploaded file to a knowledge base collection
+def get_file_hash(filepath, buffer_size=None, algorithm=None):
+    """Calculate the content hash of a file
     
     Args:
-        kb_id: Knowledge base ID
-        file_id: ID of the uploaded file
+        filepath: Path to the file
+        buffer_size: Read size in bytes, defaults to HASH_BUFFER_SIZE
+        algorithm: Hash algorithm, defaults to the configured one (see get_hash_algorithm)
     
     Returns:
-        True if successfully added, False otherwise
+        Hex digest string or None if the file could not be read
     """
-    if not kb_id or not file_id:
-        return False
-    
-    url = f"{OPENWEBUI_URL.rstrip('/')}/api/v1/knowledge/{kb_id}/file/add"
-    headers = {
-        'Authorization': f'Bearer {OPENWEBUI_API_KEY}',
-        'Content-Type': 'application/json'
-    }
+    algorithm = algorithm or get_hash_algorithm()
+    hashes = get_file_hashes(filepath, (algorithm,), buffer_size)
+    return hashes[algorithm] if hashes else None
+
+def hash_files(filepaths, workers=None, stats=None, algorithms=None):
+    """Hash files on a thread pool, yielding results in completion order
     
-    data = {
-        'file_id': file_id
-    }
+    hashlib releases the GIL while hashing large buffers, so reads and
+    hashing of different files overlap across threads. Only a few files
+    per worker are queued at a time, so filepaths may be a lazy iterable.
     
-    try:
-        response = requests.post(url, headers=headers, json=data, timeout=30)
-        
-        if response.status_code in [200, 201]:
-            log(f"✓ Added file {file_id} to knowledge base {kb_id}")
-            return True
-        else:
-            log(f"✗ Failed to add file {file_id} to knowledge base {kb_id}: {response.status_code} - {response.text}")
-            return False
-    except Exception as e:
-        log(f"✗ Error adding file {file_id} to knowledge base {kb_id}: {e}")
-        return False
+    Args:
+        filepaths: Iterable of Path objects to hash
+        workers: Number of worker threads, defaults to HASH_WORKERS (0 = CPU count)
+        stats: Optional dict updated with 'files', 'bytes' and 'seconds'
+        algorithms: Optional dict of filepath -> algorithms to compute,
+            defaults to the configured algorithm only (see get_hash_algorithm)
+    
+    Yields:
+        Tuple of (filepath, dict of algorithm -> hash, or None)
+    """
+    if stats is None:
+        stats = {}
+    stats.setdefault('files', 0)
+    stats.setdefault('bytes', 0)
+    stats.setdefault('seconds', 0.0)
+    
+    workers = workers or HASH_WORKERS or os.cpu_count() or 1
+    default_algorithms = (get_hash_algorithm(),)
+    remaining = iter(filepaths)
+    in_flight = {}
+    
+    # Throughput is measured over the time at least one file was being hashed,
+    # so time spent uploading between results does not count
+    busy = {'active': 0, 'since': 0.0}
+    busy_lock = threading.Lock()
+    
+    def hash_one(filepath):
+        with busy_lock:
+            if busy['active'] == 0:
+                busy['since'] = time.monotonic()
+            busy['active'] += 1
+        try:
+            return get_file_hashes(filepath, (algorithms or {}).get(filepath, default_algorithms))
+        finally:
+            with busy_lock:
+                busy['active'] -= 1
+                if busy['active'] == 0:
+                    stats['seconds'] += time.monotonic() - busy['since']
+    
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hash') as executor:
+        try:
+            while True:
+                # Keep every worker busy without queueing the whole file list
+                while len(in_flight) < workers * 4:
+                    filepath = next(remaining, None)
+                    if filepath is None:
+                        break
+                    in_flight[executor.submit(hash_one, filepath)] = filepath
+                
+                if not in_flight:
+                    break
+                
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    filepath = in_flight.pop(future)
+                    hashes = future.result()
+                    if hashes is not None:
+                        stats['files'] += 1
+                        try:
+                            stats['bytes'] += get_file_stat(filepath).st_size
+                        except OSError:
+                            pass
+                    yield filepath, hashes
+        finally:
+            for future in in_flight:
+                future.cancel()
 
-def get_knowledge_base_files(kb_id):
-    """Get list of files in a knowledge base
+def get_file_stat(filepath):
+    """Get stat result for a file, reusing the result cached during discovery
     
     Args:
-        kb_id: Knowledge base ID
+        filepath: Path object of the file
     
     Returns:
-        List of file dicts with 'id', 'filename', 'hash' etc., or empty list if failed
+        os.stat_result for the file
     """
-    if not kb_id:
-        return []
-    
-    url = f"{OPENWEBUI_URL.rstrip('/')}/api/v1/knowledge/{kb_id}"
-    headers = {
-        'Authorization': f'Bearer {OPENWEBUI_API_KEY}'
-    }
-    
-    try:
-        response = requests.get(url, headers=headers, timeout=30)
-        
-        if response.status_code == 200:
-            result = response.json()
-            # The knowledge base response may have a 'files' field with file details
-            files = result.get('files', [])
-            return files if isinstance(files, list) else []
-        else:
-            log(f"Could not get files for knowledge base {kb_id}: {response.status_code}")
-            return []
-    except Exception as e:
-        log(f"Error getting files for knowledge base {kb_id}: {e}")
-        return []
+    cached = FILE_STAT_CACHE.get(str(filepath))
+    if cached is not None:
+        return cached
+    return filepath.stat()
 
-def backfill_state_from_knowledge_base(kb_name, kb_id, local_files, state):
-    """Backfill sync state by checking which local files already exist in the knowledge base
+def normalize_extensions(extensions, case_insensitive=False):
+    """Build a lookup set of allowed extensions
     
     Args:
-        kb_name: Name of the knowledge base
-        kb_id: Knowledge base ID
-        local_files: List of local file paths to check
-        state: Current state dict
+        extensions: List of extensions (e.g. ['.md', '.txt'])
+        case_insensitive: Lowercase extensions so '.PDF' matches '.pdf'
     
     Returns:
-        Number of files backfilled
+        frozenset of extensions
     """
-    if not kb_id or not local_files:
-        return 0
-    
-    log(f"Checking for existing files in knowledge base: {kb_name}")
+    normalized = set()
+    for ext in extensions:
+        ext = ext.strip()
+        if not ext:
+            continue
+        normalized.add(ext.lower() if case_insensitive else ext)
+    return frozenset(normalized)
+
+def walk_files(root, extensions, case_insensitive=False, prune_dir=None, manifest=None):
+    """Walk a directory tree in a single pass, yielding files with an allowed extension
     
-    # Get existing files from knowledge base
-    kb_files = get_knowledge_base_files(kb_id)
-    if not kb_files:
-        log(f"No existing files found in knowledge base {kb_name} or unable to retrieve")
-        return 0
+    Directories are listed with os.scandir so file type checks come from the
+    directory listing. Symlinked directories are not followed (same as glob).
+    The stat result of every yielded file is cached in FILE_STAT_CACHE.
     
-    # Create a mapping of filename to file info for quick lookup
-    kb_files_map = {}
-    for kb_file in kb_files:
-        if isinstance(kb_file, dict):
-            filename = kb_file.get('filename') or kb_file.get('name')
-            if filename:
-                kb_files_map[filename] = kb_file
+    With a manifest, a directory whose mtime is unchanged and which the
+    manifest trusts is not listed: its files are skipped and its subdirectories
+    are taken from the manifest. A directory's mtime only changes when entries
+    are added, removed or renamed, so each subdirectory is still checked.
     
-    backfilled_count = 0
+    Args:
+        root: Path object of the directory to walk
+        extensions: Set of allowed extensions (see normalize_extensions)
+        case_insensitive: Match extensions case-insensitively
+        prune_dir: Optional callable(Path) returning True for directories to skip entirely
+        manifest: Optional dict with 'previous' (relative dir -> manifest entry),
+            'is_trusted' (callable(relative dir, entry) -> bool), and 'current' and
+            'unchanged', which are filled with this walk's entries and skipped directories
+    
+    Yields:
+        Path objects of matching files
+    """
+    pending_dirs = [str(root)]
     
-    for filepath in local_files:
-        file_key = str(filepath.relative_to(FILES_DIR))
+    while pending_dirs:
+        current_dir = pending_dirs.pop()
         
-        # Skip if already in state
-        if file_key in state['files']:
-            file_state = state['files'][file_key]
-            # Only skip if status is uploaded - if failed, we may want to retry
-            if file_state.get('status') == 'uploaded':
+        if manifest is not None:
+            rel_dir = os.path.relpath(current_dir, root)
+            try:
+                # Taken before listing, so a change during the listing is seen next run
+                dir_mtime_ns = os.stat(current_dir).st_mtime_ns
+            except OSError as e:
+                log(f"⚠ Could not read directory {current_dir}: {e}")
                 continue
-        
-        # Check if file exists in knowledge base by filename
-        filename = filepath.name
-        if filename in kb_files_map:
-            kb_file = kb_files_map[filename]
-            file_id = kb_file.get('id')
             
-            # Only backfill if we have a valid file ID
-            if not file_id:
+            previous = manifest['previous'].get(rel_dir)
+            if previous and previous.get('mtime_ns') == dir_mtime_ns and manifest['is_trusted'](rel_dir, previous):
+                manifest['current'][rel_dir] = previous
+                manifest['unchanged'].add(rel_dir)
+                for name in previous.get('subdirs', []):
+                    subdir = os.path.join(current_dir, name)
+                    if prune_dir and prune_dir(Path(subdir)):
+                        continue
+                    pending_dirs.append(subdir)
                 continue
-            
-            # Get local file hash to store in state
-            file_hash = get_file_hash(filepath)
-            if file_hash is None:
+        
+        subdirs = []
+        try:
+            with os.scandir(current_dir) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.name)
+                            if prune_dir and prune_dir(Path(entry.path)):
+                                continue
+                            pending_dirs.append(entry.path)
+                            continue
+                        
+                        name = entry.name.lower() if case_insensitive else entry.name
+                        if os.path.splitext(name)[1] not in extensions:
+                            continue
+                        if not entry.is_file():
+                            continue
+                        
+                        FILE_STAT_CACHE[entry.path] = entry.stat()
+                    except OSError as e:
+                        log(f"⚠ Could not read {entry.path}: {e}")
+                        continue
+                    
+                    yield Path(entry.path)
+        except OSError as e:
+            log(f"⚠ Could not list directory {current_dir}: {e}")
+            continue
+        
+        if manifest is not None:
+            manifest['current'][rel_dir] = {
+                'mtime_ns': dir_mtime_ns,
+                'subdirs': subdirs,
+                'checked_at': datetime.now().isoformat()
+            }
+
+def should_skip_directory(dirpath, kb_mapping, kb_filters):
+    """Check if a whole directory can be skipped because of exclude filters
+    
+    Only substring exclude patterns are used, because every file below the
+    directory contains the directory's relative path. Glob patterns and
+    mappings with include overrides are always evaluated per file.
+    
+    Args:
+        dirpath: Path object of the directory
+        kb_mapping: Dict mapping paths to knowledge base names, or None for single KB mode
+        kb_filters: Dict mapping paths to filter configurations
+    
+    Returns:
+        True if no file below the directory would pass the filters
+    """
+    if not kb_mapping or not kb_filters:
+        return False
+    
+    # A mapping nested inside this directory may apply different filters
+    for mapped_path in kb_mapping:
+        if dirpath in mapped_path.parents:
+            return False
+    
+    kb_name, filters, mapped_path = get_knowledge_base_for_file(dirpath, kb_mapping, kb_filters)
+    if not filters or filters.get('include'):
+        return False
+    
+    try:
+        rel_path = str(dirpath.relative_to(mapped_path)) if mapped_path else str(dirpath.relative_to(FILES_DIR))
+    except ValueError:
+        return False
+    
+    for pattern in filters.get('exclude', []):
+        if '*' in pattern or '?' in pattern:
+            continue
+        if pattern in rel_path + os.sep:
+            return True
+    
+    return False
+
+def get_stat_signature(file_stat):
+    """Build the stat signature stored with a file's state entry
+    
+    Args:
+        file_stat: os.stat_result of the file
+    
+    Returns:
+        Dict with size, mtime_ns, inode and dev
+    """
+    return {
+        'size': file_stat.st_size,
+        'mtime_ns': file_stat.st_mtime_ns,
+        'inode': file_stat.st_ino,
+        'dev': file_stat.st_dev
+    }
+
+def is_unchanged_since_hash(file_state, file_stat):
+    """Check if a file's stored hash can be trusted without reading the file
+    
+    The hash is trusted when size, mtime_ns, inode and dev all match the
+    values recorded when it was computed, and the last full hash is not
+    older than REHASH_INTERVAL_DAYS (0 disables the periodic rehash).
+    
+    Args:
+        file_state: State entry of the file
+        file_stat: Current os.stat_result of the file
+    
+    Returns:
+        True if the file can be skipped without hashing
+    """
+    signature = get_stat_signature(file_stat)
+    for field, value in signature.items():
+        if file_state.get(field) != value:
+            return False
+    
+    if REHASH_INTERVAL_DAYS > 0:
+        try:
+            hashed_at = get_entry_datetime(file_state, 'hashed_at')
+        except ValueError:
+            return False
+        if not hashed_at:
+            return False
+        elapsed = (datetime.now() - hashed_at).total_seconds()
+        if elapsed >= REHASH_INTERVAL_DAYS * 86400:
+            return False
+    
+    return True
+
+def get_manifest_fingerprint(kb_mapping, kb_filters):
+    """Fingerprint the settings that decide which files a directory walk yields
+    
+    A directory manifest recorded under different settings is not reused.
+    """
+    settings = {
+        'files_dir': str(FILES_DIR),
+        'extensions': sorted(normalize_extensions(ALLOWED_EXTENSIONS, CASE_INSENSITIVE_EXTENSIONS)),
+        'case_insensitive': CASE_INSENSITIVE_EXTENSIONS,
+        'mapping': sorted((str(path), kb) for path, kb in (kb_mapping or {}).items()),
+        'filters': sorted((str(path), json.dumps(filters, sort_keys=True)) for path, filters in (kb_filters or {}).items())
+    }
+    return hashlib.md5(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+def group_tracked_files_by_directory(state):
+    """Group the uploaded local state entries by directory (relative to FILES_DIR)
+    
+    Args:
+        state: Current state dict
+    
+    Returns:
+        Tuple of (dict of relative dir -> list of (relative path, entry) of its
+        uploaded files, set of relative dirs holding entries that are not uploaded)
+    """
+    tracked = {}
+    dirty = set()
+    for file_key, file_state in state['files'].items():
+        if not file_key.startswith('local/'):
+            continue
+        relative_path = file_key[len('local/'):]
+        rel_dir = os.path.dirname(relative_path) or '.'
+        if file_state.get('status') == 'uploaded':
+            tracked.setdefault(rel_dir, []).append((relative_path, file_state))
+        else:
+            dirty.add(rel_dir)
+    return tracked, dirty
+
+def update_directory_manifest(state):
+    """Record how many uploaded entries each directory of the manifest has
+    
+    Called before saving, so the next run can tell whether entries were
+    removed from the state (e.g. from the web interface) since the walk.
+    
+    Args:
+        state: Current state dict
+    """
+    directories = state.get('directory_manifest', {}).get('directories')
+    if not directories:
+        return
+    tracked, _ = group_tracked_files_by_directory(state)
+    for rel_dir, entry in directories.items():
+        entry['tracked'] = len(tracked.get(rel_dir, ()))
+
+def parse_shard(value):
+    """Parse a shard specification like '2/4'
+    
+    Args:
+        value: String 'i/N' with 1 <= i <= N
+    
+    Returns:
+        Tuple of (shard index, shard count)
+    
+    Raises:
+        ValueError: If the specification is invalid
+    """
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise ValueError(f"invalid shard '{value}', expected 'i/N' (e.g. '2/4')")
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError(f"invalid shard '{value}', index must be between 1 and {count}")
+    return index, count
+
+def get_shard_state_file(state_file, shard_index, shard_count):
+    """Get the state file of one worker of a sharded sync
+    
+    Example: /app/sync_state.json -> /app/sync_state.shard-2-of-4.json
+    """
+    path = Path(state_file)
+    return str(path.with_name(f"{path.stem}.shard-{shard_index}-of-{shard_count}{path.suffix}"))
+
+def configure_shard(value):
+    """Make this process handle one shard of the files
+    
+    Each shard keeps its own state file, so several processes or containers
+    can sync the same FILES_DIR side by side.
+    
+    Args:
+        value: Shard specification 'i/N', or empty for no sharding
+    """
+    global SHARD_INDEX, SHARD_COUNT, STATE_FILE, UNSHARDED_STATE_FILE
+    
+    if not value:
+        return
+    
+    SHARD_INDEX, SHARD_COUNT = parse_shard(value)
+    if SHARD_COUNT > 1:
+        UNSHARDED_STATE_FILE = STATE_FILE
+        STATE_FILE = get_shard_state_file(STATE_FILE, SHARD_INDEX, SHARD_COUNT)
+        log(f"Sharded sync: handling shard {SHARD_INDEX} of {SHARD_COUNT} (state file: {STATE_FILE})")
+
+def get_shard(shard_key):
+    """Get the shard (1-based) a file key belongs to
+    
+    Uses a hash that is stable across processes and Python versions, so every
+    worker assigns each file to the same shard.
+    
+    Args:
+        shard_key: File key, or 'ssh:<host>' for all files of an SSH source
+    """
+    return int(hashlib.md5(shard_key.encode('utf-8')).hexdigest()[:8], 16) % SHARD_COUNT + 1
+
+def get_entry_shard(file_key):
+    """Get the shard a state entry belongs to: SSH entries by their host, like their SSH source"""
+    if file_key.startswith('ssh:'):
+        return get_shard(file_key.split('/', 1)[0])
+    return get_shard(file_key)
+
+def seed_shard_state(state):
+    """Copy this shard's entries from the state of the unsharded sync
+    
+    Called when the state file (or database) of a shard is created. When
+    sharding is turned on for an existing deployment, each shard so starts
+    from the entries of its own files (and all knowledge bases), and no
+    file is uploaded again. The unsharded state is left as it is.
+    
+    Args:
+        state: Empty state of this shard, changed in place
+    
+    Returns:
+        Number of file entries copied
+    """
+    if SHARD_COUNT <= 1 or not UNSHARDED_STATE_FILE:
+        return 0
+    unsharded_db = get_state_db_file(UNSHARDED_STATE_FILE)
+    if STATE_BACKEND == 'sqlite' and os.path.exists(unsharded_db):
+        source = unsharded_db
+        store = SQLiteStateStore(unsharded_db, records=STATE_COMPACT_RECORDS)
+        try:
+            unsharded = store.load()
+        finally:
+            store.close()
+    elif os.path.exists(UNSHARDED_STATE_FILE) or os.path.exists(get_journal_file(UNSHARDED_STATE_FILE)):
+        source = UNSHARDED_STATE_FILE
+        unsharded = JSONStateStore(UNSHARDED_STATE_FILE, records=STATE_COMPACT_RECORDS).load(migrate_state)
+    else:
+        return 0
+    
+    copied = 0
+    for file_key, entry in unsharded.get('files', {}).items():
+        if get_entry_shard(file_key) == SHARD_INDEX:
+            state['files'][file_key] = entry
+            copied += 1
+    for kb_name, kb_entry in unsharded.get('knowledge_bases', {}).items():
+        state['knowledge_bases'].setdefault(kb_name, kb_entry)
+    if copied:
+        log(f"✓ Seeded shard {SHARD_INDEX} of {SHARD_COUNT} with {copied} file entries from {source}")
+    return copied
+
+def filter_files_for_shard(files, ssh_temp_dirs, ssh_hosts):
+    """Keep the local files that belong to this shard
+    
+    Files downloaded from SSH sources are kept: each SSH source is fetched
+    only by the shard it belongs to. Other workers' SSH downloads, which also
+    land in FILES_DIR, are dropped.
+    
+    Args:
+        files: Iterable of Path objects from get_files_to_sync()
+        ssh_temp_dirs: Temporary directories of this run's SSH downloads
+        ssh_hosts: Hosts of all configured SSH sources
+    
+    Yields:
+        Path objects
+    """
+    files_dir = Path(FILES_DIR)
+    own_downloads = {temp_dir.name for temp_dir in ssh_temp_dirs}
+    download_prefixes = tuple(f"ssh_{host}_" for host in ssh_hosts)
+    
+    for filepath in files:
+        try:
+            relative_path = filepath.relative_to(files_dir)
+        except ValueError:
+            continue
+        top_dir = relative_path.parts[0] if len(relative_path.parts) > 1 else ''
+        if top_dir in own_downloads:
+            yield filepath
+        elif download_prefixes and top_dir.startswith(download_prefixes):
+            continue
+        elif get_shard(f"local/{relative_path}") == SHARD_INDEX:
+            yield filepath
+
+def get_files_to_sync(kb_mapping=None, kb_filters=None, paths=None, state=None):
+    """Get the files to sync, walking FILES_DIR as they are consumed
+    
+    The tree is walked lazily, so a large tree is never held in memory as a
+    whole. With a manifest, it is saved to the state once the walk is
+    complete.
+    
+    Args:
+        kb_mapping: Optional knowledge base mapping used to skip excluded directories
+        kb_filters: Optional filters for the mapped paths
+        paths: Optional set of file paths to check instead of walking FILES_DIR
+        state: Optional state dict; with DIRECTORY_MANIFEST_HOURS set, directories
+            unchanged since the last walk are skipped and the manifest is updated
+    
+    Yields:
+        Path objects
+    """
+    files_dir = Path(FILES_DIR)
+    
+    if not files_dir.exists():
+        log(f"Files directory does not exist: {FILES_DIR}")
+        return
+    
+    extensions = normalize_extensions(ALLOWED_EXTENSIONS, CASE_INSENSITIVE_EXTENSIONS)
+    
+    if paths is not None:
+        import stat as stat_module
+        
+        for filepath in sorted(paths):
+            name = filepath.name.lower() if CASE_INSENSITIVE_EXTENSIONS else filepath.name
+            if os.path.splitext(name)[1] not in extensions:
                 continue
-            
-            # Backfill the state
-            state['files'][file_key] = {
-                'hash': file_hash,
-                'status': 'uploaded',
-                'file_id': file_id,
-                'last_attempt': datetime.now().isoformat(),
-                'retry_count': 0,
-                'knowledge_base': kb_name
+            try:
+                filepath.relative_to(files_dir)
+                file_stat = filepath.stat()
+            except (ValueError, OSError):
+                # Outside FILES_DIR, or removed again since it changed
+                continue
+            if stat_module.S_ISREG(file_stat.st_mode):
+                FILE_STAT_CACHE[str(filepath)] = file_stat
+                yield filepath
+        return
+    
+    def prune_dir(dirpath):
+        if should_skip_directory(dirpath, kb_mapping, kb_filters or {}):
+            log(f"⊗ Filtered directory: {dirpath.relative_to(files_dir)}")
+            return True
+        return False
+    
+    if state is None or DIRECTORY_MANIFEST_HOURS <= 0:
+        yield from walk_files(files_dir, extensions, CASE_INSENSITIVE_EXTENSIONS, prune_dir)
+        return
+    
+    # Directories are trusted for DIRECTORY_MANIFEST_HOURS after they were last listed,
+    # unless their state entries need work or were removed since, or a file was edited
+    fingerprint = get_manifest_fingerprint(kb_mapping, kb_filters)
+    previous_manifest = state.get('directory_manifest', {})
+    if previous_manifest.get('fingerprint') != fingerprint:
+        previous_manifest = {}
+    tracked_files, dirty_dirs = group_tracked_files_by_directory(state)
+    now = datetime.now()
+    
+    def is_trusted(rel_dir, entry):
+        files = tracked_files.get(rel_dir, ())
+        if rel_dir in dirty_dirs or entry.get('tracked') != len(files):
+            return False
+        try:
+            checked_at = datetime.fromisoformat(entry['checked_at'])
+        except (KeyError, TypeError, ValueError):
+            return False
+        if (now - checked_at).total_seconds() >= DIRECTORY_MANIFEST_HOURS * 3600:
+            return False
+        # Editing a file in place does not change the directory's mtime, so each
+        # file it holds is checked against the stat signature of its entry
+        for relative_path, file_state in files:
+            try:
+                file_stat = os.stat(os.path.join(FILES_DIR, relative_path))
+            except OSError:
+                return False
+            if any(file_state.get(field) != value for field, value in get_stat_signature(file_stat).items()):
+                return False
+        return True
+    
+    manifest = {
+        'previous': previous_manifest.get('directories', {}),
+        'is_trusted': is_trusted,
+        'current': {},
+        'unchanged': UNCHANGED_DIRECTORIES
+    }
+    yield from walk_files(files_dir, extensions, CASE_INSENSITIVE_EXTENSIONS, prune_dir, manifest)
+    
+    state['directory_manifest'] = {
+        'fingerprint': fingerprint,
+        'directories': manifest['current']
+    }
+    if UNCHANGED_DIRECTORIES:
+        log(f"Skipped {len(UNCHANGED_DIRECTORIES)} unchanged directories")
+
+def get_openwebui_client():
+    """Get the shared Open WebUI API client
+    
+    The connection pool is sized for the upload pipeline and deletion workers.
+    """
+    pool_size = max(OPENWEBUI_POOL_SIZE, UPLOAD_WORKERS + UPLOAD_LARGE_WORKERS + PROCESSING_WORKERS + KB_ATTACH_WORKERS, DELETE_WORKERS)
+    return get_client(OPENWEBUI_URL, OPENWEBUI_API_KEY, timeout=OPENWEBUI_TIMEOUT, max_retries=OPENWEBUI_MAX_RETRIES,
+                      pool_size=pool_size, kb_cache_seconds=OPENWEBUI_KB_CACHE_SECONDS)
+
+def get_upload_limiter():
+    """Get the limiter of upload requests, created on first use
+    
+    The limit learned in one sync carries over to the next in watch mode.
+    """
+    global UPLOAD_LIMITER
+    if UPLOAD_LIMITER is None:
+        UPLOAD_LIMITER = AdaptiveLimiter(
+            UPLOAD_WORKERS + (UPLOAD_LARGE_WORKERS if UPLOAD_LARGE_FILE_MB else 0),
+            adaptive=OPENWEBUI_ADAPTIVE_CONCURRENCY,
+            latency_target=OPENWEBUI_LATENCY_TARGET,
+            requests_per_second=OPENWEBUI_MAX_REQUESTS_PER_SECOND,
+            bytes_per_second=OPENWEBUI_MAX_MB_PER_SECOND * 1024 * 1024
+        )
+    return UPLOAD_LIMITER
+
+def log_upload_limits():
+    """Log the upload limits and how they were adjusted during the sync"""
+    stats = get_upload_limiter().get_stats()
+    rate = f"{stats['requests_per_second']:g} req/s" if stats['requests_per_second'] else "no request rate limit"
+    bandwidth = f"{stats['bytes_per_second'] / (1024 * 1024):g} MB/s" if stats['bytes_per_second'] else "no bandwidth limit"
+    log(f"Upload limits: concurrency {stats['limit']:.1f} of {stats['max_concurrency']} (lowest {stats['lowest']:.1f}, "
+        f"{stats['reductions']} reduction(s)), {rate}, {bandwidth}, {stats['wait_seconds']:.1f}s waited")
+
+def log_api_stats():
+    """Log request counts and latency per Open WebUI endpoint"""
+    for endpoint, stats in sorted(get_openwebui_client().get_stats().items()):
+        average_ms = stats['total_seconds'] / stats['requests'] * 1000
+        log(f"API {endpoint}: {stats['requests']} request(s), avg {average_ms:.0f} ms, max {stats['max_seconds'] * 1000:.0f} ms, "
+            f"{stats['retries']} retried, {stats['errors']} error(s)")
+
+def create_or_get_knowledge_base(kb_name, state):
+    """Create or get a knowledge base by name
+    
+    Args:
+        kb_name: Name of the knowledge base
+        state: Current state dict
+    
+    Returns:
+        Knowledge base ID or None if failed
+    """
+    # Check if we already have this knowledge base in state
+    if 'knowledge_bases' not in state:
+        state['knowledge_bases'] = {}
+    
+    if kb_name in state['knowledge_bases']:
+        kb_id = state['knowledge_bases'][kb_name].get('id')
+        if kb_id:
+            log(f"Using existing knowledge base: {kb_name} (ID: {kb_id})")
+            return kb_id
+    
+    # Try to create or get the knowledge base
+    client = get_openwebui_client()
+    
+    try:
+        # First try to list existing knowledge bases (cached for a short time)
+        try:
+            kbs = client.list_knowledge_bases()
+        except requests.HTTPError:
+            kbs = []
+        
+        # Look for existing knowledge base with this name
+        for kb in kbs:
+            if kb.get('name') == kb_name:
+                kb_id = kb.get('id')
+                log(f"Found existing knowledge base: {kb_name} (ID: {kb_id})")
+                state['knowledge_bases'][kb_name] = {
+                    'id': kb_id,
+                    'created_at': datetime.now().isoformat()
+                }
+                journal_state_change(state, kb_name, 'knowledge_bases')
+                return kb_id
+        
+        # If not found, try to create it
+        response = client.create_knowledge_base(kb_name, f'Auto-created knowledge base for {kb_name}')
+        
+        if response.status_code in [200, 201]:
+            result = response.json()
+            kb_id = result.get('id')
+            log(f"Created new knowledge base: {kb_name} (ID: {kb_id})")
+            state['knowledge_bases'][kb_name] = {
+                'id': kb_id,
+                'created_at': datetime.now().isoformat()
             }
-            backfilled_count += 1
-            log(f"↻ Backfilled state for existing file: {filename}")
+            journal_state_change(state, kb_name, 'knowledge_bases')
+            return kb_id
+        else:
+            log(f"Failed to create knowledge base {kb_name}: {response.status_code} - {response.text}")
+            return None
+    except Exception as e:
+        log(f"Error creating/getting knowledge base {kb_name}: {e}")
+        return None
+
+def get_upload_timeout(size):
+    """Seconds to wait for Open WebUI's answer to an upload of size bytes
+    
+    Open WebUI answers once it has stored the whole file, so the time
+    allowed grows with the size: OPENWEBUI_TIMEOUT plus the time the file
+    takes at OPENWEBUI_MIN_MB_PER_SECOND, or at half the throughput
+    observed on earlier uploads if that is slower.
+    
+    Args:
+        size: Upload size in bytes
+    
+    Returns:
+        Timeout in seconds
+    """
+    rate = OPENWEBUI_MIN_MB_PER_SECOND * 1024 * 1024
+    if not rate:
+        return OPENWEBUI_TIMEOUT
+    with UPLOAD_THROUGHPUT_LOCK:
+        if UPLOAD_THROUGHPUT:
+            rate = min(rate, UPLOAD_THROUGHPUT / 2)
+    return OPENWEBUI_TIMEOUT + size / rate
+
+def record_upload_throughput(size, elapsed):
+    """Update the observed upload throughput with a finished upload
+    
+    Args:
+        size: Upload size in bytes
+        elapsed: Seconds from the start of the upload to Open WebUI's answer
+    """
+    global UPLOAD_THROUGHPUT
+    # Small uploads mostly measure latency
+    if size < 1024 * 1024 or elapsed <= 0:
+        return
+    with UPLOAD_THROUGHPUT_LOCK:
+        if UPLOAD_THROUGHPUT is None:
+            UPLOAD_THROUGHPUT = size / elapsed
+        else:
+            UPLOAD_THROUGHPUT = 0.7 * UPLOAD_THROUGHPUT + 0.3 * size / elapsed
+
+def get_upload_progress(filename):
+    """Progress callback logging every quarter of uploads of UPLOAD_LARGE_FILE_MB and larger
+    
+    Args:
+        filename: Filename shown in the log
+    
+    Returns:
+        Callable(sent, total) for MultipartUpload
+    """
+    progress_state = {'started': None, 'next_quarter': 1}
+    
+    def progress(sent, total):
+        if not UPLOAD_LARGE_FILE_MB or total < UPLOAD_LARGE_FILE_MB * 1024 * 1024:
+            return
+        if progress_state['started'] is None:
+            progress_state['started'] = time.monotonic()
+        if sent * 4 < progress_state['next_quarter'] * total or progress_state['next_quarter'] > 3:
+            return
+        progress_state['next_quarter'] = sent * 4 // total + 1
+        rate = sent / max(time.monotonic() - progress_state['started'], 0.001) / (1024 * 1024)
+        log(f"  ⇡ {filename}: {sent * 100 // total}% of {total / (1024 * 1024):.1f} MB sent ({rate:.1f} MB/s)")
+    return progress
+
+def upload_file_to_openwebui(filepath, file_hash, kb_id=None, upload_filename=None, content=None):
+    """Upload a file to Open WebUI Knowledge Base
+    
+    The file is streamed with a timeout scaled to its size (see
+    get_upload_timeout). If the answer times out after the whole file was
+    sent, the copy Open WebUI stored is looked up and used instead of
+    sending the file again.
+    
+    Args:
+        filepath: Path to the file to upload
+        file_hash: Content hash of the file
+        kb_id: Optional knowledge base ID to associate file with (not used during upload)
+        upload_filename: Optional custom filename to use for upload (if different from filepath.name)
+        content: Optional file object to upload instead of the file's content
+            (see open_upload_content); left open for the caller
+    
+    Returns:
+        Tuple of (success: bool, file_id: str or None)
+    """
+    # Use custom filename if provided, otherwise use original
+    filename_to_use = upload_filename if upload_filename else filepath.name
+    
+    try:
+        with (nullcontext(content) if content is not None else open(filepath, 'rb')) as f:
+            body = MultipartUpload(f, filename_to_use, progress=get_upload_progress(filename_to_use))
+            client = get_openwebui_client()
+            started_at = time.time()
+            start = time.monotonic()
+            
+            # Note: knowledge_base_id is not passed during upload
+            # Files must be added to knowledge base after upload using add_files_to_knowledge_base()
+            try:
+                response = client.post('/api/v1/files/', data=body, headers={'Content-Type': body.content_type},
+                                       timeout=(OPENWEBUI_TIMEOUT, get_upload_timeout(len(body))), limiter=get_upload_limiter())
+            except requests.Timeout:
+                if body.finished_at is None:
+                    raise
+                # Open WebUI received the whole file; it may have stored it before the answer was lost
+                file_id = client.find_uploaded_file(filename_to_use, body.size, started_at)
+                if not file_id:
+                    raise
+                log(f"↻ Upload of {filename_to_use} timed out after it was sent, using the copy Open WebUI stored (ID: {file_id})")
+                return True, file_id
+            
+            if response.status_code in (502, 504) and body.finished_at is not None:
+                # A proxy gave up waiting; Open WebUI may still have stored the file
+                file_id = client.find_uploaded_file(filename_to_use, body.size, started_at)
+                if file_id:
+                    log(f"↻ Upload of {filename_to_use} got {response.status_code} after it was sent, using the copy Open WebUI stored (ID: {file_id})")
+                    return True, file_id
+            
+            if response.status_code in [200, 201]:
+                record_upload_throughput(len(body), time.monotonic() - start)
+                result = response.json()
+                file_id = result.get('id')
+                log(f"✓ Uploaded: {filename_to_use}")
+                return True, file_id
+            else:
+                log(f"✗ Failed to upload {filename_to_use}: {response.status_code} - {response.text}")
+                return False, None
+    except Exception as e:
+        log(f"✗ Error uploading {filename_to_use}: {e}")
+        return False, None
+
+def add_files_to_knowledge_base(kb_id, file_ids):
+    """Add uploaded files to a knowledge base collection
+    
+    Files are added in batches of KB_ATTACH_BATCH_SIZE where Open WebUI
+    supports it, otherwise one at a time.
+    
+    Args:
+        kb_id: Knowledge base ID
+        file_ids: IDs of the uploaded files
     
-    return backfilled_count
+    Returns:
+        Dict of file ID -> None if added, or an error message
+    """
+    try:
+        results = get_openwebui_client().add_files_to_knowledge_base(kb_id, file_ids, KB_ATTACH_BATCH_SIZE)
+    except Exception as e:
+        log(f"✗ Error adding {len(file_ids)} file(s) to knowledge base {kb_id}: {e}")
+        return {file_id: str(e) for file_id in file_ids}
+    
+    added = [file_id for file_id, error in results.items() if error is None]
+    if len(added) == 1:
+        log(f"✓ Added file {added[0]} to knowledge base {kb_id}")
+    elif added:
+        log(f"✓ Added {len(added)} files to knowledge base {kb_id}")
+    for file_id, error in results.items():
+        if error is not None:
+            log(f"✗ Failed to add file {file_id} to knowledge base {kb_id}: {error}")
+    return results
+
+def get_knowledge_base_files(kb_id):
+    """Get list of files in a knowledge base
+    
+    Args:
+        kb_id: Knowledge base ID
+    
+    Returns:
+        List of file dicts with 'id', 'filename', 'hash' etc., or empty list if failed
+    """
+    if not kb_id:
+        return []
+    
+    try:
+        response = get_openwebui_client().get(f"/api/v1/knowledge/{kb_id}")
+        
+        if response.status_code == 200:
+            result = response.json()
+            # The knowledge base response may have a 'files' field with file details
+            files = result.get('files', [])
+            return files if isinstance(files, list) else []
+        else:
+            log(f"Could not get files for knowledge base {kb_id}: {response.status_code}")
+            return []
+    except Exception as e:
+        log(f"Error getting files for knowledge base {kb_id}: {e}")
+        return []
+
+def get_knowledge_base_backfill_index(kb_name, kb_id):
+    """Map the files already in a knowledge base by filename, to backfill the sync state
+    
+    Args:
+        kb_name: Name of the knowledge base
+        kb_id: Knowledge base ID
+    
+    Returns:
+        Dict of filename -> knowledge base file dict, empty if there are none
+    """
+    if not kb_id:
+        return {}
+    
+    log(f"Checking for existing files in knowledge base: {kb_name}")
+    
+    # Get existing files from knowledge base
+    kb_files = get_knowledge_base_files(kb_id)
+    if not kb_files:
+        log(f"No existing files found in knowledge base {kb_name} or unable to retrieve")
+        return {}
+    
+    # Create a mapping of filename to file info for quick lookup
+    kb_files_map = {}
+    for kb_file in kb_files:
+        if isinstance(kb_file, dict):
+            filename = kb_file.get('filename') or kb_file.get('name')
+            if filename:
+                kb_files_map[filename] = kb_file
+    return kb_files_map
+
+def backfill_file_from_knowledge_base(kb_name, filepath, kb_files_map, state):
+    """Backfill the sync state of a local file that already exists in the knowledge base
+    
+    Args:
+        kb_name: Name of the knowledge base
+        filepath: Path object of the local file
+        kb_files_map: Files of the knowledge base (see get_knowledge_base_backfill_index)
+        state: Current state dict
+    
+    Returns:
+        True if the file was backfilled
+    """
+    file_key = str(filepath.relative_to(FILES_DIR))
+    
+    # Skip if already in state
+    if file_key in state['files']:
+        file_state = state['files'][file_key]
+        # Only skip if status is uploaded - if failed, we may want to retry
+        if file_state.get('status') == 'uploaded':
+            return False
+    
+    # Check if file exists in knowledge base by filename
+    filename = filepath.name
+    kb_file = kb_files_map.get(filename)
+    if kb_file is None:
+        return False
+    file_id = kb_file.get('id')
+    
+    # Only backfill if we have a valid file ID
+    if not file_id:
+        return False
+    
+    # Get local file hash to store in state
+    file_hash = get_file_hash(filepath)
+    if file_hash is None:
+        return False
+    
+    try:
+        file_signature = get_stat_signature(get_file_stat(filepath))
+        file_signature['hashed_at'] = datetime.now().isoformat()
+    except OSError:
+        file_signature = {}
+    file_signature['hash_algorithm'] = HASH_ALGORITHM
+    
+    # Backfill the state
+    state['files'][file_key] = new_file_entry({
+        'hash': file_hash,
+        **file_signature,
+        'status': 'uploaded',
+        'file_id': file_id,
+        'last_attempt': datetime.now().isoformat(),
+        'retry_count': 0,
+        'knowledge_base': kb_name
+    })
+    log(f"↻ Backfilled state for existing file: {filename}")
+    return True
+
+# Poll interval of the processing tracker: starts short and doubles while nothing completes
+PROCESSING_POLL_MIN_SECONDS = 1
+PROCESSING_POLL_MAX_SECONDS = 30
+# The listing of all files is downloaded whole, so it is only used while the
+# files waiting for processing are at least this fraction of the last listing
+PROCESSING_LISTING_MIN_FRACTION = 0.1
+
+def map_processing_status(file_data):
+    """Map the processing status of an Open WebUI file record
+    
+    Args:
+        file_data: File dict returned by /api/v1/files/
+    
+    Returns:
+        Status string: 'processed', 'processing', 'failed', or 'unknown'
+    """
+    status = file_data.get('status') or (file_data.get('data') or {}).get('status')
+    if status is None:
+        # Open WebUI versions without a processing status process files during the upload
+        return 'processed'
+    # Map possible status values
+    if status in ['completed', 'processed', 'ready']:
+        return 'processed'
+    elif status in ['processing', 'pending', 'uploading']:
+        return 'processing'
+    elif status in ['failed', 'error']:
+        return 'failed'
+    else:
+        return 'unknown'
 
 def check_upload_status(file_id):
     """Check if an uploaded file has been processed successfully
     
     Args:
-        file_id: ID of the uploaded file
+        file_id: ID of the uploaded file
+    
+    Returns:
+        Status string: 'processed', 'processing', 'failed', or 'unknown'
+        ('unknown' when the status could not be read)
+    """
+    if not file_id:
+        return 'unknown'
+    
+    try:
+        response = get_openwebui_client().get(f"/api/v1/files/{file_id}")
+        
+        if response.status_code == 200:
+            return map_processing_status(response.json())
+        elif response.status_code == 404:
+            log(f"Uploaded file ID {file_id} no longer exists in Open WebUI")
+            return 'failed'
+        else:
+            log(f"Could not check status for file ID {file_id}: {response.status_code}")
+            return 'unknown'
+    except Exception as e:
+        log(f"Error checking upload status for file ID {file_id}: {e}")
+        return 'unknown'
+
+def list_processing_status(file_ids):
+    """Get the processing status of many files from one listing of all files
+    
+    Args:
+        file_ids: Set of file IDs
+    
+    Returns:
+        Tuple of (dict of file ID -> status for the listed files, number of
+        files listed), or None if the listing is unavailable or does not
+        include processing statuses
+    """
+    try:
+        response = get_openwebui_client().get('/api/v1/files/', params={'content': 'false'})
+        if response.status_code != 200:
+            return None
+        files = response.json()
+    except Exception as e:
+        log(f"Could not list files to check processing status: {e}")
+        return None
+    
+    if not isinstance(files, list):
+        return None
+    if files and not any('status' in item or 'status' in (item.get('data') or {}) for item in files):
+        return None
+    
+    return {item['id']: map_processing_status(item) for item in files if item.get('id') in file_ids}, len(files)
+
+def poll_processing_status(file_ids, delay, use_listing, listing_size, executor):
+    """Wait, then get the processing status of uploaded files (tracker worker)
+    
+    Many files are checked with one listing of all files; a few (or all, when
+    the listing has no statuses) with concurrent requests per file. Once the
+    listing is known to be large, it is only requested again while the files
+    checked are at least PROCESSING_LISTING_MIN_FRACTION of it.
+    
+    Args:
+        file_ids: List of file IDs
+        delay: Seconds to wait before checking
+        use_listing: Whether the file listing may be used
+        listing_size: Number of files in the last listing, None before the first
+        executor: Thread pool for the per-file requests
+    
+    Returns:
+        Tuple of (dict of file ID -> status, whether the listing is usable,
+        number of files in the last listing)
+    """
+    time.sleep(delay)
+    
+    statuses = {}
+    if (use_listing and len(file_ids) >= max(1, PROCESSING_WORKERS) * 4
+            and (listing_size is None or len(file_ids) >= listing_size * PROCESSING_LISTING_MIN_FRACTION)):
+        listed = list_processing_status(set(file_ids))
+        if listed is None:
+            use_listing = False
+        else:
+            listed_statuses, listing_size = listed
+            statuses.update(listed_statuses)
+    
+    remaining = [file_id for file_id in file_ids if file_id not in statuses]
+    for file_id, status in zip(remaining, executor.map(check_upload_status, remaining)):
+        statuses[file_id] = status
+    
+    return statuses, use_listing, listing_size
+
+def delete_file_from_openwebui(file_id, kb_ids=(), delete_file=True):
+    """Remove an uploaded file from knowledge bases and delete it from Open WebUI
+    
+    Args:
+        file_id: ID of the uploaded file
+        kb_ids: IDs of the knowledge bases to remove the file from
+        delete_file: Also delete the file itself (False while other files still share it)
+    
+    Returns:
+        True if the file is gone (including when it was already deleted), or with
+        delete_file=False, if it was removed from all knowledge bases; False otherwise
+    """
+    client = get_openwebui_client()
+    
+    try:
+        removed = True
+        for kb_id in kb_ids:
+            response = client.post(f"/api/v1/knowledge/{kb_id}/file/remove", json={'file_id': file_id})
+            if response.status_code not in [200, 201, 404]:
+                # Deleting the file below also drops it from the knowledge base
+                log(f"{'⚠' if delete_file else '✗'} Could not remove file {file_id} from knowledge base {kb_id}: {response.status_code} - {response.text}")
+                removed = False
+        
+        if not delete_file:
+            return removed
+        
+        response = client.delete(f"/api/v1/files/{file_id}")
+        if response.status_code in [200, 204, 404]:
+            return True
+        log(f"✗ Failed to delete file {file_id}: {response.status_code} - {response.text}")
+        return False
+    except Exception as e:
+        log(f"✗ Error deleting file {file_id}: {e}")
+        return False
+
+def find_missing_files(state, seen_keys, sources, paths=None):
+    """Find state entries whose source file no longer exists
+    
+    Args:
+        state: Current state dict
+        seen_keys: Set of file keys found by this run
+        sources: Dict of file key prefix (e.g. 'local/') -> directory it maps to,
+            for each source walked completely by this run
+        paths: Optional set of changed file paths (watch mode); only these are
+            checked, and a path that is gone and was not a file stands for a
+            directory moved away or deleted, whose entries are all checked
+    
+    Returns:
+        Dict of file key prefix -> list of missing file keys
+    """
+    missing = {}
+    
+    if paths is not None:
+        files_dir = Path(FILES_DIR)
+        removed_dirs = []
+        for filepath in paths:
+            try:
+                file_key = f"local/{Path(filepath).relative_to(files_dir)}"
+            except ValueError:
+                continue
+            if os.path.lexists(filepath) or file_key in seen_keys:
+                continue
+            if file_key in state['files']:
+                missing.setdefault('local/', []).append(file_key)
+            else:
+                removed_dirs.append(file_key + '/')
+        if removed_dirs:
+            removed_dirs = tuple(removed_dirs)
+            for file_key in state['files']:
+                if (file_key.startswith(removed_dirs) and file_key not in seen_keys
+                        and not os.path.lexists(files_dir / file_key[len('local/'):])):
+                    missing.setdefault('local/', []).append(file_key)
+        return missing
+    
+    for file_key in state['files']:
+        if file_key in seen_keys:
+            continue
+        prefix = file_key.split('/', 1)[0] + '/'
+        if prefix not in sources:
+            continue
+        relative_path = file_key[len(prefix):]
+        # Directories skipped by the directory manifest still hold their files
+        if prefix == 'local/' and (os.path.dirname(relative_path) or '.') in UNCHANGED_DIRECTORIES:
+            continue
+        # Files that exist but were not synced (filtered, excluded directories) are kept
+        if os.path.lexists(os.path.join(sources[prefix], relative_path)):
+            continue
+        missing.setdefault(prefix, []).append(file_key)
+    
+    return missing
+
+def build_hash_index(state):
+    """Index uploaded state entries by content hash, to recognise moved files
+    
+    Args:
+        state: Current state dict
+    
+    Returns:
+        Dict of (hash algorithm, hash) -> list of file keys
+    """
+    hash_index = {}
+    for file_key, file_state in state['files'].items():
+        if file_state.get('status') != 'uploaded' or not file_state.get('file_id') or not file_state.get('hash'):
+            continue
+        index_key = (file_state.get('hash_algorithm', 'md5'), file_state['hash'])
+        hash_index.setdefault(index_key, []).append(file_key)
+    return hash_index
+
+def find_uploaded_copy(hash_index, file_hash, file_key, state):
+    """Find another file whose identical content is already uploaded and processed
+    
+    Args:
+        hash_index: Index from build_hash_index()
+        file_hash: Content hash of the file (HASH_ALGORITHM)
+        file_key: Key of the file itself, which is never returned
+        state: Current state dict
+    
+    Returns:
+        File key of an uploaded entry with the same content, or None
+    """
+    for other_key in hash_index.get((HASH_ALGORITHM, file_hash), []):
+        other_state = state['files'].get(other_key, {})
+        if (other_key != file_key and other_state.get('status') == 'uploaded' and other_state.get('file_id')
+                and other_state.get('hash') == file_hash and other_state.get('hash_algorithm', 'md5') == HASH_ALGORITHM):
+            return other_key
+    return None
+
+def find_moved_file(hash_index, missing_keys, file_hash, kb_name, state):
+    """Find the missing state entry a new file was moved or renamed from
+    
+    Args:
+        hash_index: Index from build_hash_index()
+        missing_keys: Set of file keys whose source disappeared in this run
+        file_hash: Content hash of the new file (HASH_ALGORITHM)
+        kb_name: Knowledge base of the new file
+        state: Current state dict
+    
+    Returns:
+        File key of a missing entry with the same content and knowledge base, or None
+    """
+    for file_key in hash_index.get((HASH_ALGORITHM, file_hash), []):
+        if file_key in missing_keys and state['files'][file_key].get('knowledge_base') == kb_name:
+            return file_key
+    return None
+
+def delete_missing_files(state, missing):
+    """Delete files whose source disappeared from Open WebUI and from the state
+    
+    Nothing is deleted for a source when more than DELETE_MAX_PERCENT of its
+    tracked files are missing: an unmounted volume or an empty SSH download
+    looks exactly like every file having been deleted.
+    
+    Args:
+        state: Current state dict
+        missing: Dict of file key prefix -> list of missing file keys (see find_missing_files)
+    
+    Returns:
+        Number of state entries removed
+    """
+    tracked = {}
+    for file_key in state['files']:
+        prefix = file_key.split('/', 1)[0] + '/'
+        tracked[prefix] = tracked.get(prefix, 0) + 1
+    
+    to_delete = []
+    for prefix, file_keys in missing.items():
+        percent = len(file_keys) * 100 / tracked[prefix]
+        if percent > DELETE_MAX_PERCENT:
+            log(f"⚠ {len(file_keys)} of {tracked[prefix]} files from {prefix.rstrip('/')} are missing ({percent:.0f}%), "
+                f"more than DELETE_MAX_PERCENT ({DELETE_MAX_PERCENT:g}%). Not deleting them; check that the source is available")
+            continue
+        to_delete.extend(file_keys)
+    
+    # Uploads can be shared by several files with identical content: an upload
+    # is only deleted once no file references it, and only removed from a
+    # knowledge base once no file in that knowledge base references it
+    file_refs = {}
+    kb_refs = {}
+    for file_state in state['files'].values():
+        file_id = file_state.get('file_id')
+        if file_id:
+            file_refs[file_id] = file_refs.get(file_id, 0) + 1
+            kb_ref = (file_id, file_state.get('knowledge_base'))
+            kb_refs[kb_ref] = kb_refs.get(kb_ref, 0) + 1
+    
+    deleted = 0
+    uploads = {}  # file_id -> list of missing file keys using it
+    
+    for file_key in to_delete:
+        file_state = state['files'][file_key]
+        file_id = file_state.get('file_id')
+        if not file_id:
+            # Never uploaded, only the state entry has to go
+            del state['files'][file_key]
+            journal_state_change(state, file_key)
+            log(f"⊗ Removed state for missing file: {file_key}")
+            deleted += 1
+            continue
+        
+        file_refs[file_id] -= 1
+        kb_refs[(file_id, file_state.get('knowledge_base'))] -= 1
+        uploads.setdefault(file_id, []).append(file_key)
+    
+    remote_deletes = {}  # file_id -> (knowledge base IDs, delete the file)
+    
+    for file_id, file_keys in uploads.items():
+        kb_ids = []
+        for file_key in file_keys:
+            file_state = state['files'][file_key]
+            kb_name = file_state.get('knowledge_base')
+            if kb_refs[(file_id, kb_name)] > 0:
+                continue
+            kb_id = file_state.get('knowledge_base_id')
+            if not kb_id and kb_name:
+                kb_id = state['knowledge_bases'].get(kb_name, {}).get('id')
+            if kb_id and kb_id not in kb_ids:
+                kb_ids.append(kb_id)
+        
+        delete_file = file_refs[file_id] == 0
+        if not delete_file and not kb_ids:
+            # Still used by other files in the same knowledge bases
+            for file_key in file_keys:
+                del state['files'][file_key]
+                journal_state_change(state, file_key)
+                log(f"⊗ Removed state for missing file: {file_key} (upload still used by other files)")
+                deleted += 1
+            continue
+        
+        remote_deletes[file_id] = (kb_ids, delete_file)
+    
+    if not remote_deletes:
+        return deleted
+    
+    log(f"Deleting {len(remote_deletes)} upload(s) whose source disappeared...")
+    with ThreadPoolExecutor(max_workers=max(1, DELETE_WORKERS)) as executor:
+        futures = {
+            executor.submit(delete_file_from_openwebui, file_id, kb_ids, delete_file): file_id
+            for file_id, (kb_ids, delete_file) in remote_deletes.items()
+        }
+        for future in as_completed(futures):
+            file_id = futures[future]
+            if not future.result():
+                continue
+            # State is only changed here, on the calling thread
+            for file_key in uploads[file_id]:
+                del state['files'][file_key]
+                journal_state_change(state, file_key)
+                log(f"⊗ Deleted missing file: {file_key}")
+                deleted += 1
+    
+    return deleted
+
+def new_file_entry(fields):
+    """State entry of a file: a FileRecord with STATE_COMPACT_RECORDS, otherwise the dict itself"""
+    return FileRecord(fields) if STATE_COMPACT_RECORDS else fields
+
+def build_upload_state(upload, status, **fields):
+    """Build the state entry of a file that went through the upload pipeline
+    
+    Args:
+        upload: Upload dict (see queue_upload)
+        status: 'uploaded', 'processing' or 'failed'
+        **fields: Additional fields, e.g. file_id or error
+    
+    Returns:
+        State entry (see new_file_entry)
+    """
+    file_stat = upload['file_stat']
+    file_state = upload['file_state']
+    return new_file_entry({
+        'hash': upload['file_hash'],
+        **upload['file_signature'],
+        'status': status,
+        **fields,
+        'last_attempt': datetime.now().isoformat(),
+        'retry_count': {'uploaded': 0, 'processing': file_state.get('retry_count', 0)}.get(status, file_state.get('retry_count', 0) + 1),
+        'knowledge_base': upload['kb_name'],
+        'source_type': upload['source_info']['type'],
+        'source_name': upload['source_info']['name'],
+        'file_size': file_stat.st_size,
+        'created_at': datetime.fromtimestamp(file_stat.st_ctime).isoformat(),
+        'modified_at': datetime.fromtimestamp(file_stat.st_mtime).isoformat(),
+        'filename': upload['filepath'].name
+    })
+
+def run_upload(upload):
+    """Convert a file, add its metadata header and upload it (upload stage)
+    
+    Runs on an upload worker thread, so it must not touch the state.
+    
+    Args:
+        upload: Upload dict (see queue_upload)
+    
+    Returns:
+        Dict with 'conversion_success', 'converted', 'success' and 'file_id'
+    """
+    filepath = upload['filepath']
+    source_info = upload['source_info']
+    ssh_temp_parent = upload['ssh_temp_parent']
+    
+    # Get original path and timestamps from SSH metadata or file
+    original_path = None
+    created_time = None
+    modified_time = None
+    
+    file_key_str = str(filepath.resolve())
+    if file_key_str in SSH_FILE_METADATA:
+        # Use SSH metadata for remote files
+        ssh_meta = SSH_FILE_METADATA[file_key_str]
+        original_path = ssh_meta['remote_path']
+        modified_time = ssh_meta['mtime']
+        # For SSH files, created time is same as modified (no ctime in SFTP)
+        created_time = ssh_meta['mtime']
+    elif source_info['type'] == 'local':
+        # For local files, use full resolved path
+        original_path = str(filepath.resolve())
+    elif source_info['type'] == 'ssh' and ssh_temp_parent:
+        # Fallback if SSH metadata not available
+        original_path = str(filepath.relative_to(ssh_temp_parent))
+    else:
+        # Other sources - use relative to FILES_DIR
+        original_path = str(filepath.relative_to(FILES_DIR))
+    
+    # Convert JSON/YAML to Markdown if needed and add the metadata header
+    conversion_success, content, converted = open_upload_content(
+        filepath, source_info, original_path, created_time, modified_time
+    )
+    if not conversion_success:
+        return {'conversion_success': False, 'converted': False, 'success': False, 'file_id': None}
+    
+    # Generate unique filename based on source
+    upload_filename = generate_unique_filename(filepath, source_info)
+    
+    try:
+        success, file_id = upload_file_to_openwebui(filepath, upload['file_hash'], upload['kb_id'], upload_filename, content=content)
+    finally:
+        content.close()
+    
+    return {'conversion_success': True, 'converted': converted, 'success': success, 'file_id': file_id}
+
+def run_kb_attach(kb_id, uploads):
+    """Add processed files to their knowledge base in one batch (knowledge base stage)"""
+    return add_files_to_knowledge_base(kb_id, [upload['file_id'] for upload in uploads])
+
+def get_upload_priority(kb_name, file_stat):
+    """Sort key of a file waiting to be hashed and uploaded (lowest first)
+    
+    Files of knowledge bases with a higher KB_PRIORITIES weight go first,
+    then the most recently modified files.
+    """
+    return (-KB_PRIORITIES.get(kb_name, 0), -file_stat.st_mtime)
+
+def get_upload_lane(file_stat):
+    """Upload lane of a file: 'large' at UPLOAD_LARGE_FILE_MB and above, otherwise 'small'"""
+    if UPLOAD_LARGE_FILE_MB and file_stat.st_size >= UPLOAD_LARGE_FILE_MB * 1024 * 1024:
+        return 'large'
+    return 'small'
+
+def start_upload_pipeline():
+    """Create the worker pools of the upload pipeline
+    
+    Each file passes through up to three stages: upload (conversion,
+    metadata header, upload), processing, and knowledge base attach.
+    Uploads wait in two lanes, small and large files, each with its own
+    workers, so large files never hold up small ones. Within a lane,
+    files are uploaded in get_upload_priority() order. Each lane admits
+    its own number of files (see iter_admitted_files), so a full large lane
+    does not stop small files from being hashed and queued.
+    Uploaded files wait for Open WebUI to process them in the processing
+    tracker, which checks all of them together in one poll round at a time.
+    Only the thread driving the pipeline (see advance_upload_pipeline)
+    changes the state.
+    
+    Returns:
+        Pipeline dict
+    """
+    upload_workers = max(1, UPLOAD_WORKERS)
+    large_workers = max(1, UPLOAD_LARGE_WORKERS) if UPLOAD_LARGE_FILE_MB else 0
+    processing_workers = max(1, PROCESSING_WORKERS)
+    attach_workers = max(1, KB_ATTACH_WORKERS)
+    lanes = {'small': upload_workers}
+    if large_workers:
+        lanes['large'] = large_workers
+    return {
+        'upload': ThreadPoolExecutor(max_workers=upload_workers + large_workers),
+        # lane -> workers, uploads running, heap of (priority, sequence, upload dict), and uploads admitted at once
+        'lanes': {lane: {'workers': workers, 'running': 0, 'queue': [], 'budget': workers * 2}
+                  for lane, workers in lanes.items()},
+        'queued': 0,  # Sequence number keeping equal priorities in arrival order
+        'processing': ThreadPoolExecutor(max_workers=processing_workers),
+        'poller': ThreadPoolExecutor(max_workers=1),
+        'attach': ThreadPoolExecutor(max_workers=attach_workers),
+        # Files past the upload stage in flight, so uploads do not run far ahead of processing
+        'max_in_flight': (upload_workers + large_workers + processing_workers + attach_workers) * 2,
+        'futures': {},  # future -> (stage, upload dict)
+        'waiting': {},  # (hash algorithm, hash) -> uploads of the same content waiting for the first one
+        'pending': {},  # file ID -> upload dict of files Open WebUI is still processing
+        'attach_queue': {},  # knowledge base ID -> processed uploads waiting to be added
+        'attaching': set(),  # knowledge base IDs with a batch being added
+        'poll_interval': PROCESSING_POLL_MIN_SECONDS,
+        'poll_listing': True,  # Whether the file listing reports processing statuses
+        'listing_size': None,  # Number of files in the last listing
+        'deadline': None,  # time.monotonic() after which files still processing are left for the next run
+        'counts': {'uploaded': 0, 'failed': 0, 'converted': 0, 'deduplicated': 0, 'processing': 0}
+    }
+
+def submit_stage(pipeline, stage, upload):
+    """Run the next stage of an upload on its worker pool"""
+    if stage == 'attach':
+        # Added in batches per knowledge base, see flush_kb_attach()
+        pipeline['attach_queue'].setdefault(upload['kb_id'], []).append(upload)
+        return
+    lane = get_upload_lane(upload['file_stat'])
+    upload['lane'] = lane
+    pipeline['queued'] += 1
+    heapq.heappush(pipeline['lanes'][lane]['queue'], (get_upload_priority(upload['kb_name'], upload['file_stat']), pipeline['queued'], upload))
+    dispatch_uploads(pipeline)
+
+def lane_has_room(pipeline, lane):
+    """Whether an upload lane admits another file (uploads waiting or running are below its budget)"""
+    lane = pipeline['lanes'][lane]
+    return len(lane['queue']) + lane['running'] < lane['budget']
+
+def iter_admitted_files(pipeline, state, hash_index, hash_order, hash_jobs):
+    """Yield the files to hash in hash_order, as their upload lane has room
+    
+    Files are split by upload lane. The next file is the first in
+    hash_order among the lanes with room, so while the large lane is full
+    the small files behind it are hashed and uploaded ahead of it. When no
+    lane with files left has room, waits for uploads to finish.
+    
+    Args:
+        pipeline: Pipeline dict from start_upload_pipeline()
+        state: Current state dict
+        hash_index: Index from build_hash_index()
+        hash_order: Paths to hash, in priority order
+        hash_jobs: Dict of path -> job with its 'file_stat'
+    
+    Yields:
+        Path objects
+    """
+    remaining = {}
+    for position, filepath in enumerate(hash_order):
+        remaining.setdefault(get_upload_lane(hash_jobs[filepath]['file_stat']), deque()).append((position, filepath))
+    
+    while remaining:
+        open_lanes = [lane for lane in remaining if lane_has_room(pipeline, lane)]
+        if not open_lanes:
+            advance_upload_pipeline(pipeline, state, hash_index, wait_upload=True)
+            continue
+        lane = min(open_lanes, key=lambda lane: remaining[lane][0][0])
+        _, filepath = remaining[lane].popleft()
+        if not remaining[lane]:
+            del remaining[lane]
+        yield filepath
+
+def dispatch_uploads(pipeline):
+    """Start the highest priority waiting upload of each lane with a free worker"""
+    for lane in pipeline['lanes'].values():
+        while lane['queue'] and lane['running'] < lane['workers']:
+            _, _, upload = heapq.heappop(lane['queue'])
+            lane['running'] += 1
+            future = pipeline['upload'].submit(run_upload, upload)
+            pipeline['futures'][future] = ('upload', upload)
+
+def flush_kb_attach(pipeline):
+    """Add the queued files of each knowledge base without a batch in progress
+    
+    Files processed while a batch is being added are queued and go in the
+    next batch of their knowledge base.
+    """
+    for kb_id, uploads in list(pipeline['attach_queue'].items()):
+        if kb_id in pipeline['attaching']:
+            continue
+        batch = uploads[:max(1, KB_ATTACH_BATCH_SIZE)]
+        del uploads[:len(batch)]
+        if not uploads:
+            del pipeline['attach_queue'][kb_id]
+        future = pipeline['attach'].submit(run_kb_attach, kb_id, batch)
+        pipeline['futures'][future] = ('attach', batch)
+        pipeline['attaching'].add(kb_id)
+
+def schedule_processing_poll(pipeline):
+    """Start the next poll round of the processing tracker, unless one is running"""
+    if not pipeline['pending'] or any(stage == 'poll' for stage, _ in pipeline['futures'].values()):
+        return
+    future = pipeline['poller'].submit(
+        poll_processing_status, list(pipeline['pending']), pipeline['poll_interval'],
+        pipeline['poll_listing'], pipeline['listing_size'], pipeline['processing']
+    )
+    pipeline['futures'][future] = ('poll', None)
+
+def track_processing(pipeline, state, upload):
+    """Hand an uploaded file to the processing tracker (pipeline thread only)
+    
+    The file is recorded with status 'processing' and its file ID, so a run
+    that ends before Open WebUI has processed it resumes tracking it instead
+    of uploading it again.
+    """
+    if not upload.get('resumed'):
+        upload['processing_since'] = datetime.now().isoformat()
+        state['files'][upload['file_key']] = build_upload_state(
+            upload, 'processing', file_id=upload['file_id'], processing_since=upload['processing_since']
+        )
+        journal_state_change(state, upload['file_key'])
+    upload['tracked_at'] = time.monotonic()
+    pipeline['pending'][upload['file_id']] = upload
+    schedule_processing_poll(pipeline)
+
+def resume_processing_uploads(pipeline, state):
+    """Resume tracking files a previous run left in processing
+    
+    Args:
+        pipeline: Pipeline dict from start_upload_pipeline()
+        state: Current state dict
     
     Returns:
-        Status string: 'processed', 'processing', 'failed', or 'unknown'
+        Number of files tracked again
     """
-    if not file_id:
-        return 'unknown'
+    resumed = 0
+    for file_key, file_state in state['files'].items():
+        if file_state.get('status') != 'processing' or not file_state.get('file_id'):
+            continue
+        kb_name = file_state.get('knowledge_base')
+        kb_id = create_or_get_knowledge_base(kb_name, state) if kb_name else None
+        if kb_name and not kb_id:
+            continue
+        upload = {
+            'filepath': Path(file_state.get('filename') or file_key),
+            'file_key': file_key,
+            'file_id': file_state['file_id'],
+            'file_hash': file_state.get('hash'),
+            'kb_name': kb_name,
+            'kb_id': kb_id,
+            'resumed': True
+        }
+        if file_state.get('processed_at') and kb_id:
+            submit_stage(pipeline, 'attach', upload)
+        else:
+            track_processing(pipeline, state, upload)
+        resumed += 1
     
-    url = f"{OPENWEBUI_URL.rstrip('/')}/api/v1/files/{file_id}"
-    headers = {
-        'Authorization': f'Bearer {OPENWEBUI_API_KEY}'
-    }
+    if resumed:
+        log(f"⏳ Resuming processing checks for {resumed} file(s) uploaded by a previous run")
+    return resumed
+
+def handle_processing_statuses(pipeline, state, hash_index, statuses):
+    """Move files the tracker found processed on to the next stage
     
-    try:
-        response = requests.get(url, headers=headers, timeout=30)
+    Args:
+        pipeline: Pipeline dict from start_upload_pipeline()
+        state: Current state dict
+        hash_index: Index from build_hash_index()
+        statuses: Dict of file ID -> processing status from poll_processing_status()
+    """
+    completed = 0
+    for file_id, status in statuses.items():
+        upload = pipeline['pending'].get(file_id)
+        if not upload:
+            # Replaced by a newer upload of a changed file
+            continue
         
-        if response.status_code == 200:
-            result = response.json()
-            status = result.get('status', 'unknown')
-            # Map possible status values
-            if status in ['completed', 'processed', 'ready']:
-                return 'processed'
-            elif status in ['processing', 'pending', 'uploading']:
-                return 'processing'
-            elif status in ['failed', 'error']:
-                return 'failed'
+        if status == 'processed':
+            del pipeline['pending'][file_id]
+            completed += 1
+            file_state = state['files'].get(upload['file_key'])
+            if file_state and file_state.get('file_id') == file_id:
+                # A sync interrupted before the file is in its knowledge base adds it right away
+                file_state['processed_at'] = datetime.now().isoformat()
+                journal_state_change(state, upload['file_key'])
+            if upload['kb_id']:
+                # Add file to knowledge base collection
+                submit_stage(pipeline, 'attach', upload)
             else:
-                return 'unknown'
-        else:
-            log(f"Could not check status for file ID {file_id}: {response.status_code}")
-            return 'unknown'
-    except Exception as e:
-        log(f"Error checking upload status for file ID {file_id}: {e}")
-        return 'unknown'
+                finish_upload(pipeline, state, hash_index, upload, 'uploaded')
+        elif status == 'failed':
+            del pipeline['pending'][file_id]
+            completed += 1
+            log(f"File processing failed for {upload['filepath'].name} (ID: {file_id})")
+            finish_upload(pipeline, state, hash_index, upload, 'failed', 'Processing failed')
+        elif (time.monotonic() - upload['tracked_at'] >= UPLOAD_TIMEOUT
+              or (pipeline['deadline'] and time.monotonic() >= pipeline['deadline'])):
+            # Left in processing; the next run checks it again
+            del pipeline['pending'][file_id]
+            log(f"⏳ {upload['filepath'].name} is still being processed after {int(time.monotonic() - upload['tracked_at'])}s, checking again next run")
+            pipeline['counts']['processing'] += 1
+            release_waiting_uploads(pipeline, state, hash_index, upload)
+    
+    # Poll quickly while files complete, back off while Open WebUI is busy
+    if completed:
+        pipeline['poll_interval'] = PROCESSING_POLL_MIN_SECONDS
+    else:
+        pipeline['poll_interval'] = min(PROCESSING_POLL_MAX_SECONDS, pipeline['poll_interval'] * 2)
 
-def wait_for_upload_processing(file_id, timeout=UPLOAD_TIMEOUT):
-    """Wait for an uploaded file to be processed
+def share_uploaded_copy(pipeline, state, hash_index, upload):
+    """Reference an existing upload with identical content instead of uploading again
     
     Args:
-        file_id: ID of the uploaded file
-        timeout: Maximum time to wait in seconds
+        pipeline: Pipeline dict from start_upload_pipeline()
+        state: Current state dict
+        hash_index: Index from build_hash_index()
+        upload: Upload dict (see queue_upload)
     
     Returns:
-        True if processed successfully, False otherwise
+        True if the file was handled by sharing an upload, False if it must be uploaded
     """
-    if not file_id:
+    file_key = upload['file_key']
+    kb_name = upload['kb_name']
+    shared_from = find_uploaded_copy(hash_index, upload['file_hash'], file_key, state)
+    if not shared_from:
         return False
     
-    start_time = time.time()
-    check_interval = 5  # Check every 5 seconds
+    file_id = state['files'][shared_from]['file_id']
+    kb_id = create_or_get_knowledge_base(kb_name, state) if kb_name else None
+    if kb_name and not kb_id:
+        # The regular upload reports the error
+        return False
     
-    while time.time() - start_time < timeout:
-        status = check_upload_status(file_id)
-        
-        if status == 'processed':
-            return True
-        elif status == 'failed':
-            log(f"File processing failed for ID: {file_id}")
-            return False
-        elif status == 'processing':
-            time.sleep(check_interval)
+    upload.update(file_id=file_id, kb_id=kb_id, shared_from=shared_from)
+    in_kb = any(
+        other_key != file_key
+        and state['files'].get(other_key, {}).get('file_id') == file_id
+        and state['files'][other_key].get('knowledge_base') == kb_name
+        for other_key in hash_index[(HASH_ALGORITHM, upload['file_hash'])]
+    )
+    if kb_id and not in_kb:
+        submit_stage(pipeline, 'attach', upload)
+    else:
+        finish_upload(pipeline, state, hash_index, upload, 'uploaded')
+    return True
+
+def queue_upload(pipeline, state, hash_index, upload):
+    """Start uploading a new or changed file
+    
+    Args:
+        pipeline: Pipeline dict from start_upload_pipeline()
+        state: Current state dict
+        hash_index: Index from build_hash_index()
+        upload: Dict with the file's 'filepath', 'file_key', 'file_hash',
+            'file_signature', 'file_state', 'file_stat', 'source_info',
+            'ssh_temp_parent' and 'kb_name'
+    """
+    # A file changed while a previous upload of it was still being processed
+    for file_id, pending in list(pipeline['pending'].items()):
+        if pending['file_key'] == upload['file_key']:
+            del pipeline['pending'][file_id]
+    
+    if DEDUPLICATE_UPLOADS:
+        # Identical content already uploaded for another file
+        if share_uploaded_copy(pipeline, state, hash_index, upload):
+            return
+        # Identical content being uploaded right now: decide once that upload finishes
+        index_key = (HASH_ALGORITHM, upload['file_hash'])
+        if index_key in pipeline['waiting']:
+            pipeline['waiting'][index_key].append(upload)
+            return
+        pipeline['waiting'][index_key] = []
+    
+    filepath = upload['filepath']
+    kb_name = upload['kb_name']
+    upload['kb_id'] = None
+    
+    if kb_name:
+        upload['kb_id'] = create_or_get_knowledge_base(kb_name, state)
+        if not upload['kb_id']:
+            log(f"✗ Could not create/get knowledge base {kb_name} for {filepath.name}")
+            # Update state to track failure
+            state['files'][upload['file_key']] = new_file_entry({
+                'hash': upload['file_hash'],
+                **upload['file_signature'],
+                'status': 'failed',
+                'last_attempt': datetime.now().isoformat(),
+                'retry_count': upload['file_state'].get('retry_count', 0) + 1,
+                'knowledge_base': kb_name,
+                'error': 'Failed to create/get knowledge base'
+            })
+            journal_state_change(state, upload['file_key'])
+            pipeline['counts']['failed'] += 1
+            release_waiting_uploads(pipeline, state, hash_index, upload)
+            return
+    
+    submit_stage(pipeline, 'upload', upload)
+
+def release_waiting_uploads(pipeline, state, hash_index, upload):
+    """Continue the uploads that waited for an upload of the same content to finish"""
+    index_key = (HASH_ALGORITHM, upload['file_hash'])
+    if upload.get('shared_from') or index_key not in pipeline['waiting']:
+        return
+    waiting = pipeline['waiting'].pop(index_key)
+    for waiting_upload in waiting:
+        queue_upload(pipeline, state, hash_index, waiting_upload)
+
+def finish_upload(pipeline, state, hash_index, upload, status, error=None):
+    """Record the outcome of an upload in the state (pipeline thread only)
+    
+    Args:
+        pipeline: Pipeline dict from start_upload_pipeline()
+        state: Current state dict
+        hash_index: Index from build_hash_index()
+        upload: Upload dict
+        status: 'uploaded' or 'failed'
+        error: Error message for failed uploads
+    """
+    file_key = upload['file_key']
+    if upload.get('resumed'):
+        # Uploaded by a previous run: only the outcome changes
+        file_state = state['files'].get(file_key)
+        if not file_state:
+            return
+        file_state.pop('processing_since', None)
+        file_state.pop('processed_at', None)
+        file_state.update(
+            status=status,
+            last_attempt=datetime.now().isoformat(),
+            retry_count=0 if status == 'uploaded' else file_state.get('retry_count', 0) + 1
+        )
+        if error:
+            file_state['error'] = error
         else:
-            # Unknown status, assume it's done
-            return True
+            file_state.pop('error', None)
+    else:
+        fields = {}
+        if upload.get('file_id'):
+            fields['file_id'] = upload['file_id']
+        if error:
+            fields['error'] = error
+        state['files'][file_key] = build_upload_state(upload, status, **fields)
+    
+    if status == 'uploaded':
+        if upload.get('shared_from'):
+            log(f"↻ Reusing upload of {upload['shared_from']} for {file_key}")
+            pipeline['counts']['deduplicated'] += 1
+        else:
+            pipeline['counts']['uploaded'] += 1
+        file_state = state['files'][file_key]
+        if upload.get('file_id') and file_state.get('hash'):
+            copies = hash_index.setdefault((file_state.get('hash_algorithm', 'md5'), file_state['hash']), [])
+            if file_key not in copies:
+                copies.append(file_key)
+    else:
+        pipeline['counts']['failed'] += 1
     
-    log(f"Timeout waiting for file processing (ID: {file_id})")
-    return False
+    journal_state_change(state, file_key)
+    release_waiting_uploads(pipeline, state, hash_index, upload)
+
+def finish_kb_attach(pipeline, state, hash_index, uploads, future):
+    """Record the outcome of a knowledge base batch for each of its files
+    
+    Args:
+        pipeline: Pipeline dict from start_upload_pipeline()
+        state: Current state dict
+        hash_index: Index from build_hash_index()
+        uploads: Upload dicts of the batch
+        future: Finished future of run_kb_attach()
+    """
+    pipeline['attaching'].discard(uploads[0]['kb_id'])
+    try:
+        results = future.result()
+    except Exception as e:
+        log(f"✗ Error in attach stage for {len(uploads)} file(s): {e}")
+        results = {}
+    
+    for upload in uploads:
+        error = results.get(upload['file_id'], 'No result')
+        if error is None:
+            finish_upload(pipeline, state, hash_index, upload, 'uploaded')
+        elif upload.get('shared_from'):
+            # Could not add the shared upload to the knowledge base, upload a copy instead
+            for field in ('file_id', 'shared_from'):
+                upload.pop(field)
+            submit_stage(pipeline, 'upload', upload)
+        else:
+            # Failed to add to knowledge base
+            finish_upload(pipeline, state, hash_index, upload, 'failed', f'Failed to add to knowledge base collection: {error}')
+
+def advance_upload_pipeline(pipeline, state, hash_index, drain=False, wait_upload=False):
+    """Hand finished stages on to the next stage and record finished files
+    
+    Blocks while more files past the upload stage than the pipeline allows
+    are in flight (including files waiting in the processing tracker).
+    Uploads are admitted by their lane instead, see iter_admitted_files().
+    
+    Args:
+        pipeline: Pipeline dict from start_upload_pipeline()
+        state: Current state dict
+        hash_index: Index from build_hash_index()
+        drain: Wait until every file has finished
+        wait_upload: Wait until at least one upload has finished
+    """
+    futures = pipeline['futures']
+    flush_kb_attach(pipeline)
+    
+    while futures:
+        uploading = sum(lane['running'] for lane in pipeline['lanes'].values())
+        queued = sum(len(uploads) for uploads in pipeline['attach_queue'].values())
+        block = drain or wait_upload or len(futures) - uploading + len(pipeline['pending']) + queued >= pipeline['max_in_flight']
+        done, _ = wait(list(futures), timeout=None if block else 0, return_when=FIRST_COMPLETED)
+        if not done:
+            return
+        
+        for future in done:
+            stage, upload = futures.pop(future)
+            if stage == 'poll':
+                try:
+                    statuses, pipeline['poll_listing'], pipeline['listing_size'] = future.result()
+                except Exception as e:
+                    log(f"✗ Error checking processing status: {e}")
+                    statuses = {}
+                handle_processing_statuses(pipeline, state, hash_index, statuses)
+                schedule_processing_poll(pipeline)
+                continue
+            
+            if stage == 'attach':
+                finish_kb_attach(pipeline, state, hash_index, upload, future)
+                continue
+            
+            pipeline['lanes'][upload['lane']]['running'] -= 1
+            dispatch_uploads(pipeline)
+            wait_upload = False
+            filepath = upload['filepath']
+            try:
+                result = future.result()
+            except Exception as e:
+                log(f"✗ Error in {stage} stage for {filepath.name}: {e}")
+                result = {'conversion_success': True, 'converted': False, 'success': False, 'file_id': None}
+            
+            if result['converted']:
+                pipeline['counts']['converted'] += 1
+            if not result['conversion_success']:
+                log(f"✗ Failed to convert {filepath.name}, skipping")
+                finish_upload(pipeline, state, hash_index, upload, 'failed', 'Conversion failed')
+                # Keep the knowledge base ID for display
+                state['files'][upload['file_key']]['knowledge_base_id'] = upload['kb_id']
+                journal_state_change(state, upload['file_key'])
+            elif not result['success']:
+                finish_upload(pipeline, state, hash_index, upload, 'failed', 'Upload failed')
+            elif result['file_id']:
+                upload['file_id'] = result['file_id']
+                track_processing(pipeline, state, upload)
+            else:
+                # No file ID returned, assume success
+                finish_upload(pipeline, state, hash_index, upload, 'uploaded')
+        
+        flush_kb_attach(pipeline)
+
+def stop_upload_pipeline(pipeline, state, hash_index):
+    """Wait for all files in flight, then shut the worker pools down"""
+    advance_upload_pipeline(pipeline, state, hash_index, drain=True)
+    for stage in ('upload', 'processing', 'poller', 'attach'):
+        pipeline[stage].shutdown()
+
+def get_exceeded_budget(run_started, files_queued, bytes_queued, file_size):
+    """Check the run budgets before another file is uploaded
+    
+    Args:
+        run_started: time.monotonic() at the start of the sync
+        files_queued: Files queued for upload so far
+        bytes_queued: Bytes queued for upload so far
+        file_size: Size of the next file
+    
+    Returns:
+        Description of the budget that would be exceeded, or None
+    """
+    if MAX_RUN_SECONDS and time.monotonic() - run_started >= MAX_RUN_SECONDS:
+        return f"MAX_RUN_SECONDS={MAX_RUN_SECONDS:g}"
+    if MAX_FILES and files_queued >= MAX_FILES:
+        return f"MAX_FILES={MAX_FILES}"
+    # A single file larger than the budget is still uploaded in a run of its own
+    if MAX_BYTES and bytes_queued and bytes_queued + file_size > MAX_BYTES:
+        return f"MAX_BYTES={MAX_BYTES}"
+    return None
+
+def get_backlog_paths(state):
+    """Paths of the local files a previous sync left unprocessed when it ran out of budget
+    
+    Args:
+        state: Current state dict
+    
+    Returns:
+        Tuple of (set of paths, dict of path -> position in the backlog), or
+        (None, None) if there is no backlog
+    """
+    backlog = state.get('backlog', {}).get('file_keys', [])
+    order = {}
+    for file_key in backlog:
+        # Remote files are downloaded again by the next full sync
+        if file_key.startswith('local/'):
+            order.setdefault(Path(FILES_DIR) / file_key[len('local/'):], len(order))
+    if not order:
+        return None, None
+    return set(order), order
 
-def sync_files():
-    """Main sync function"""
-    log("Starting file sync...")
+def sync_files(paths=None):
+    """Main sync function
+    
+    Args:
+        paths: Optional set of changed file paths (watch mode). When given, only
+            these files are checked, and SSH sources and backfill are skipped.
+    
+    Raises:
+        RuntimeError: If the API key is not set or the state file cannot be accessed
+    """
+    global HASH_ALGORITHM
+    
+    if paths is None:
+        log("Starting file sync...")
+    else:
+        log(f"Starting file sync for {len(paths)} changed path(s)...")
     
     if not OPENWEBUI_API_KEY:
-        log("ERROR: OPENWEBUI_API_KEY not set")
-        sys.exit(1)
+        raise RuntimeError("OPENWEBUI_API_KEY not set")
+    
+    HASH_ALGORITHM = get_hash_algorithm()
+    get_openwebui_client().reset_stats()
+    get_upload_limiter().reset_stats()
     
     # Verify state file access before proceeding
     if not verify_state_file_access():
-        log("ERROR: Cannot access state file. Sync cannot proceed.")
         log(f"Please check that the volume mount for state directory is correct")
         log(f"Expected state file location: {STATE_FILE}")
-        sys.exit(1)
+        raise RuntimeError("Cannot access state file. Sync cannot proceed.")
     
+    run_started = time.monotonic()
     state = load_state()
+    hash_index = build_hash_index(state)
+    
+    # Work left by a sync that ran out of budget is done before the next full scan
+    backlog_order = None
+    previous_backlog = []
+    if paths is None:
+        paths, backlog_order = get_backlog_paths(state)
+        if paths:
+            log(f"Resuming backlog of {len(paths)} file(s) left by the previous sync")
+    else:
+        previous_backlog = state.get('backlog', {}).get('file_keys', [])
+    
+    # Stat results from a previous run in the same process are stale
+    FILE_STAT_CACHE.clear()
+    UNCHANGED_DIRECTORIES.clear()
     
     # Ensure state structure exists
     if 'files' not in state:
@@ -1503,9 +3436,17 @@ def sync_files():
         log(f"Knowledge base mapping configured: {len(kb_mapping)} paths")
     
     # Fetch files from SSH remote sources if configured
-    ssh_sources = parse_ssh_remote_sources()
+    # (remote files cannot be watched, so targeted runs leave them to full syncs)
+    ssh_sources = parse_ssh_remote_sources() if paths is None or SHARD_COUNT > 1 else []
+    ssh_hosts = [ssh_source.get('host', 'unknown') for ssh_source in ssh_sources]
+    if SHARD_COUNT > 1:
+        # Each SSH source is fetched by one shard only
+        ssh_sources = [ssh_source for ssh_source in ssh_sources
+                       if paths is None and get_shard(f"ssh:{ssh_source.get('host', 'unknown')}") == SHARD_INDEX]
     ssh_temp_dirs = []  # Keep track of temp directories to clean up later
     ssh_source_map = {}  # Map temp_dir to SSH source info for tracking
+    # Sources walked completely (file key prefix -> directory), checked for deleted files
+    walked_sources = {'local/': FILES_DIR} if paths is None else {}
     
     if ssh_sources:
         log(f"Found {len(ssh_sources)} SSH remote source(s) configured")
@@ -1527,6 +3468,8 @@ def sync_files():
             
             # Fetch files from SSH
             success, downloaded_files, ssh_kb_name = fetch_files_from_ssh(ssh_source, temp_dir)
+            if success:
+                walked_sources[f"ssh:{host}/"] = temp_dir
             
             if success and downloaded_files:
                 log(f"✓ Successfully fetched {len(downloaded_files)} files from {host}")
@@ -1542,37 +3485,18 @@ def sync_files():
             elif not success:
                 log(f"✗ Failed to fetch files from {host}")
     
-    files = get_files_to_sync()
-    log(f"Found {len(files)} files to check")
+    # The files are walked as the loop below consumes them, so the tree is never held whole
+    files = get_files_to_sync(kb_mapping, kb_filters, paths, state)
+    if SHARD_COUNT > 1:
+        files = filter_files_for_shard(files, ssh_temp_dirs, ssh_hosts)
     
     # Backfill state from existing knowledge base files
     # This handles the case where state was not persisted but files already exist
+    # (targeted runs only see a few files, so backfill is left to full syncs).
+    # Each knowledge base is read once, when its first file is found.
+    backfill_indexes = {}
     backfilled_total = 0
-    if kb_mapping is None and KNOWLEDGE_BASE_NAME:
-        # Single KB mode - backfill from the single knowledge base
-        kb_id = create_or_get_knowledge_base(KNOWLEDGE_BASE_NAME, state)
-        if kb_id:
-            backfilled_total = backfill_state_from_knowledge_base(KNOWLEDGE_BASE_NAME, kb_id, files, state)
-    elif kb_mapping:
-        # Multiple KB mode - backfill from each knowledge base
-        kb_groups = {}
-        for filepath in files:
-            kb_name, file_filters, kb_mapped_path = get_knowledge_base_for_file(filepath, kb_mapping, kb_filters)
-            if kb_name:
-                if kb_name not in kb_groups:
-                    kb_groups[kb_name] = []
-                kb_groups[kb_name].append(filepath)
-        
-        for kb_name, kb_files in kb_groups.items():
-            kb_id = create_or_get_knowledge_base(kb_name, state)
-            if kb_id:
-                backfilled_count = backfill_state_from_knowledge_base(kb_name, kb_id, kb_files, state)
-                backfilled_total += backfilled_count
-    
-    if backfilled_total > 0:
-        log(f"Backfilled state for {backfilled_total} existing files")
-        # Save state after backfilling
-        save_state(state)
+    found = 0
     
     uploaded = 0
     skipped = 0
@@ -1581,7 +3505,15 @@ def sync_files():
     filtered = 0
     converted = 0
     
+    # Resolve source, key and knowledge base for each file, and skip
+    # unchanged files before any content is read
+    hash_jobs = {}
+    hash_algorithms = {}
+    seen_keys = set()
+    
     for filepath in files:
+        found += 1
+        
         # Determine if this is an SSH file and get source info
         source_info = {'type': 'local', 'name': 'Local Files'}
         ssh_temp_parent = None
@@ -1605,52 +3537,147 @@ def sync_files():
         # Create normalized file_key
         # For SSH files: use ssh:<host>/<relative_path_from_temp_dir>
         # For local files: use local/<relative_path_from_FILES_DIR>
-        # Get original path and timestamps from SSH metadata or file
-        original_path = None
-        created_time = None
-        modified_time = None
-        
-        file_key_str = str(filepath.resolve())
-        if file_key_str in SSH_FILE_METADATA:
-            # Use SSH metadata for remote files
-            ssh_meta = SSH_FILE_METADATA[file_key_str]
-            original_path = ssh_meta['remote_path']
-            modified_time = ssh_meta['mtime']
-            # For SSH files, created time is same as modified (no ctime in SFTP)
-            created_time = ssh_meta['mtime']
-        elif source_info['type'] == 'local':
-            # For local files, use full resolved path
-            original_path = file_key_str
-        
         if source_info['type'] == 'ssh' and ssh_temp_parent:
             relative_path = filepath.relative_to(ssh_temp_parent)
             file_key = f"ssh:{source_info['host']}/{relative_path}"
         else:
             file_key = f"local/{filepath.relative_to(FILES_DIR)}"
+        seen_keys.add(file_key)
         
         # Determine knowledge base and filters for this file
         kb_name, file_filters, kb_mapped_path = get_knowledge_base_for_file(filepath, kb_mapping, kb_filters)
         
+        if paths is None and kb_name:
+            if kb_name not in backfill_indexes:
+                kb_id = create_or_get_knowledge_base(kb_name, state)
+                backfill_indexes[kb_name] = get_knowledge_base_backfill_index(kb_name, kb_id)
+            if backfill_indexes[kb_name] and backfill_file_from_knowledge_base(kb_name, filepath, backfill_indexes[kb_name], state):
+                backfilled_total += 1
+        
         # Check if file should be processed based on filters
         if not should_process_file(filepath, file_filters, kb_mapped_path):
             log(f"⊗ Filtered: {filepath.name}")
             filtered += 1
             continue
         
-        file_hash = get_file_hash(filepath)
+        # Get file state
+        file_state = state['files'].get(file_key, {})
         
-        if file_hash is None:
+        try:
+            file_stat = get_file_stat(filepath)
+        except OSError as e:
+            log(f"Error reading file {filepath}: {e}")
             failed += 1
             continue
         
-        # Get file state
-        file_state = state['files'].get(file_key, {})
+        # Skip without hashing if the stat signature is unchanged since the last hash.
+        # Unchanged files hashed with another algorithm are re-keyed without uploading.
+        # Files still being processed are left to the processing tracker.
+        rekey = False
+        if file_state.get('status') in ('uploaded', 'processing') and is_unchanged_since_hash(file_state, file_stat):
+            if file_state.get('hash_algorithm') == HASH_ALGORITHM:
+                if file_state['status'] == 'uploaded':
+                    skipped += 1
+                continue
+            rekey = file_state['status'] == 'uploaded'
+        
+        # A changed file is also hashed with its previous algorithm to detect identical content
+        algorithms = {HASH_ALGORITHM}
+        if not rekey and file_state.get('hash'):
+            algorithms.add(file_state.get('hash_algorithm', HASH_ALGORITHM))
+        hash_algorithms[filepath] = tuple(algorithms)
+        
+        hash_jobs[filepath] = {
+            'file_key': file_key,
+            'source_info': source_info,
+            'ssh_temp_parent': ssh_temp_parent,
+            'kb_name': kb_name,
+            'file_state': file_state,
+            'file_stat': file_stat,
+            'rekey': rekey
+        }
+    
+    log(f"Found {found} files to check")
+    if backfilled_total > 0:
+        log(f"Backfilled state for {backfilled_total} existing files")
+        # Save state after backfilling
+        save_state(state)
+    
+    # Files whose source disappeared, either moved (matched by content below) or deleted
+    missing = find_missing_files(state, seen_keys, walked_sources, paths)
+    missing_keys = {file_key for file_keys in missing.values() for file_key in file_keys}
+    
+    # Hash the remaining files in parallel and handle them as they complete;
+    # new and changed files are handed to the upload pipeline
+    hash_stats = {}
+    rekeyed = 0
+    moved = 0
+    pipeline = start_upload_pipeline()
+    if MAX_RUN_SECONDS:
+        # Files still processing when the time budget runs out are checked again next run
+        pipeline['deadline'] = run_started + MAX_RUN_SECONDS
+    resume_processing_uploads(pipeline, state)
+    files_queued = 0
+    bytes_queued = 0
+    backlog = []
+    
+    if backlog_order:
+        # Keep the order the backlog was saved in
+        hash_order = sorted(hash_jobs, key=lambda path: backlog_order.get(path, len(backlog_order)))
+    else:
+        hash_order = sorted(hash_jobs, key=lambda path: get_upload_priority(hash_jobs[path]['kb_name'], hash_jobs[path]['file_stat']))
+    admitted = iter_admitted_files(pipeline, state, hash_index, hash_order, hash_jobs)
+    for filepath, hashes in hash_files(admitted, stats=hash_stats, algorithms=hash_algorithms):
+        job = hash_jobs.pop(filepath)
+        file_key = job['file_key']
+        source_info = job['source_info']
+        ssh_temp_parent = job['ssh_temp_parent']
+        kb_name = job['kb_name']
+        file_state = job['file_state']
+        file_stat = job['file_stat']
+        
+        if hashes is None:
+            failed += 1
+            continue
+        
+        file_hash = hashes[HASH_ALGORITHM]
+        previous_hash = hashes.get(file_state.get('hash_algorithm', HASH_ALGORITHM))
+        
+        file_signature = get_stat_signature(file_stat)
+        signature_unchanged = all(file_state.get(field) == value for field, value in file_signature.items())
+        file_signature['hashed_at'] = datetime.now().isoformat()
+        file_signature['hash_algorithm'] = HASH_ALGORITHM
+        
+        # A new file with the content of a file that disappeared in this run was moved
+        # or renamed: keep the uploaded copy instead of uploading and embedding it again
+        moved_from = find_moved_file(hash_index, missing_keys, file_hash, kb_name, state) if not file_state and missing_keys else None
+        if moved_from:
+            missing_keys.discard(moved_from)
+            moved_state = state['files'].pop(moved_from)
+            moved_state.update(file_signature)
+            moved_state['filename'] = filepath.name
+            moved_state['modified_at'] = datetime.fromtimestamp(file_stat.st_mtime).isoformat()
+            state['files'][file_key] = moved_state
+            journal_state_change(state, moved_from)
+            journal_state_change(state, file_key)
+            log(f"↻ Moved: {moved_from} → {file_key}")
+            moved += 1
+            continue
         
         # Check if file has changed
-        if file_state.get('hash') == file_hash and file_state.get('status') == 'uploaded':
-            skipped += 1
+        if (job['rekey'] or file_state.get('hash') == previous_hash) and file_state.get('status') in ('uploaded', 'processing'):
+            # Record the current hash and signature so the next run can skip hashing
+            if file_state.get('hash_algorithm') != HASH_ALGORITHM:
+                rekeyed += 1
+            file_state['hash'] = file_hash
+            file_state.update(file_signature)
+            if file_state['status'] == 'uploaded':
+                skipped += 1
             continue
         
+        if signature_unchanged and file_state.get('status') == 'uploaded':
+            log(f"⚠ Content of {filepath.name} changed without a size or timestamp change")
+        
         # Check if we need to retry a failed upload
         if file_state.get('status') == 'failed':
             retry_count = file_state.get('retry_count', 0)
@@ -1673,226 +3700,65 @@ def sync_files():
                 except Exception:
                     pass  # If we can't parse time, just proceed with retry
             
-            retried += 1
-            log(f"Retrying upload ({retry_count + 1}/{MAX_RETRY_ATTEMPTS}): {filepath.name}")
-        
-        # Convert JSON/YAML to Markdown if needed
-        conversion_success, upload_filepath, is_temp = convert_file_to_markdown(filepath)
-        
-        # Add metadata header to file (creates temp file)
-        if conversion_success:
-            # Determine original path for metadata
-            # Get original path and timestamps from SSH metadata or file
-            original_path = None
-            created_time = None
-            modified_time = None
-            
-            file_key_str = str(filepath.resolve())
-            if file_key_str in SSH_FILE_METADATA:
-                # Use SSH metadata for remote files
-                ssh_meta = SSH_FILE_METADATA[file_key_str]
-                original_path = ssh_meta['remote_path']
-                modified_time = ssh_meta['mtime']
-                # For SSH files, created time is same as modified (no ctime in SFTP)
-                created_time = ssh_meta['mtime']
-            elif source_info['type'] == 'local':
-                # For local files, use full resolved path
-                original_path = str(filepath.resolve())
-            elif source_info['type'] == 'ssh' and ssh_temp_parent:
-                # Fallback if SSH metadata not available
-                original_path = str(filepath.relative_to(ssh_temp_parent))
-            else:
-                # Other sources - use relative to FILES_DIR
-                original_path = str(filepath.relative_to(FILES_DIR))
-            
-            metadata_success, metadata_filepath, metadata_is_temp = add_file_metadata_header(
-                upload_filepath, source_info, original_path, created_time, modified_time
-            )
-            
-            if metadata_success:
-                # Clean up previous temp file if it was created during conversion
-                if is_temp:
-                    try:
-                        upload_filepath.unlink()
-                    except:
-                        pass
-                # Use the new file with metadata
-                upload_filepath = metadata_filepath
-                is_temp = metadata_is_temp
-            # If metadata addition fails, continue with the file without metadata
-        
-        # Generate unique filename based on source
-        upload_filename = generate_unique_filename(filepath, source_info)
-        
-        # Get file metadata
-        try:
-            file_stat = filepath.stat()
-            file_size = file_stat.st_size
-            file_created = datetime.fromtimestamp(file_stat.st_ctime).isoformat()
-            file_modified = datetime.fromtimestamp(file_stat.st_mtime).isoformat()
-        except Exception:
-            file_size = 0
-            file_created = datetime.now().isoformat()
-            file_modified = datetime.now().isoformat()
-        
-        if not conversion_success:
-            log(f"✗ Failed to convert {filepath.name}, skipping")
-            state['files'][file_key] = {
-                'hash': file_hash,
-                'status': 'failed',
-                'last_attempt': datetime.now().isoformat(),
-                'retry_count': file_state.get('retry_count', 0) + 1,
-                'knowledge_base': kb_name,
-                'knowledge_base_id': kb_id,  # Add KB ID for display
-                'error': 'Conversion failed',
-                'source_type': source_info['type'],
-                'source_name': source_info['name'],
-                'file_size': file_size,
-                'created_at': file_created,
-                'modified_at': file_modified,
-                'filename': filepath.name
-            }
-            failed += 1
-            continue
-        
-        if is_temp:
-            converted += 1
-        
-        # Determine knowledge base for this file (kb_name already determined above)
-        kb_id = None
-        
-        if kb_name:
-            kb_id = create_or_get_knowledge_base(kb_name, state)
-            if not kb_id:
-                log(f"✗ Could not create/get knowledge base {kb_name} for {filepath.name}")
-                # Update state to track failure
-                state['files'][file_key] = {
-                    'hash': file_hash,
-                    'status': 'failed',
-                    'last_attempt': datetime.now().isoformat(),
-                    'retry_count': file_state.get('retry_count', 0) + 1,
-                    'knowledge_base': kb_name,
-                    'error': 'Failed to create/get knowledge base'
-                }
-                failed += 1
-                # Clean up temp file if created
-                if is_temp:
-                    try:
-                        upload_filepath.unlink()
-                    except:
-                        pass
-                continue
-        
-        # Upload file (use converted file if available)
-        success, file_id = upload_file_to_openwebui(upload_filepath, file_hash, kb_id, upload_filename)
+        exceeded = get_exceeded_budget(run_started, files_queued, bytes_queued, file_stat.st_size)
+        if exceeded:
+            # Stop here; this file and the ones not hashed yet are left for the next sync
+            backlog = [file_key] + [hash_jobs[path]['file_key'] for path in hash_order if path in hash_jobs]
+            log(f"⏳ Run budget {exceeded} reached, {len(backlog)} file(s) left for the next sync")
+            break
         
-        # Clean up temp file after upload
-        if is_temp:
-            try:
-                upload_filepath.unlink()
-            except Exception as e:
-                log(f"⚠ Could not clean up temp file: {e}")
+        if file_state.get('status') == 'failed':
+            retried += 1
+            log(f"Retrying upload ({file_state.get('retry_count', 0) + 1}/{MAX_RETRY_ATTEMPTS}): {filepath.name}")
+        files_queued += 1
+        bytes_queued += file_stat.st_size
         
-        if success:
-            # Wait for processing if we got a file ID
-            if file_id:
-                log(f"⏳ Waiting for {filepath.name} to be processed...")
-                processing_success = wait_for_upload_processing(file_id)
-                
-                if processing_success:
-                    # Add file to knowledge base collection if kb_id is present
-                    kb_add_success = True
-                    if kb_id:
-                        kb_add_success = add_file_to_knowledge_base(kb_id, file_id)
-                    
-                    if kb_add_success:
-                        state['files'][file_key] = {
-                            'hash': file_hash,
-                            'status': 'uploaded',
-                            'file_id': file_id,
-                            'last_attempt': datetime.now().isoformat(),
-                            'retry_count': 0,
-                            'knowledge_base': kb_name,
-                            'source_type': source_info['type'],
-                            'source_name': source_info['name'],
-                            'file_size': file_size,
-                            'created_at': file_created,
-                            'modified_at': file_modified,
-                            'filename': filepath.name
-                        }
-                        uploaded += 1
-                    else:
-                        # Failed to add to knowledge base
-                        state['files'][file_key] = {
-                            'hash': file_hash,
-                            'status': 'failed',
-                            'file_id': file_id,
-                            'last_attempt': datetime.now().isoformat(),
-                            'retry_count': file_state.get('retry_count', 0) + 1,
-                            'knowledge_base': kb_name,
-                            'error': 'Failed to add to knowledge base collection',
-                            'source_type': source_info['type'],
-                            'source_name': source_info['name'],
-                            'file_size': file_size,
-                            'created_at': file_created,
-                            'modified_at': file_modified,
-                            'filename': filepath.name
-                        }
-                        failed += 1
-                else:
-                    # Processing failed
-                    state['files'][file_key] = {
-                        'hash': file_hash,
-                        'status': 'failed',
-                        'file_id': file_id,
-                        'last_attempt': datetime.now().isoformat(),
-                        'retry_count': file_state.get('retry_count', 0) + 1,
-                        'knowledge_base': kb_name,
-                        'error': 'Processing failed',
-                        'source_type': source_info['type'],
-                        'source_name': source_info['name'],
-                        'file_size': file_size,
-                        'created_at': file_created,
-                        'modified_at': file_modified,
-                        'filename': filepath.name
-                    }
-                    failed += 1
-            else:
-                # No file ID returned, assume success
-                state['files'][file_key] = {
-                    'hash': file_hash,
-                    'status': 'uploaded',
-                    'last_attempt': datetime.now().isoformat(),
-                    'retry_count': 0,
-                    'knowledge_base': kb_name,
-                    'source_type': source_info['type'],
-                    'source_name': source_info['name'],
-                    'file_size': file_size,
-                    'created_at': file_created,
-                    'modified_at': file_modified,
-                    'filename': filepath.name
-                }
-                uploaded += 1
-        else:
-            # Upload failed
-            state['files'][file_key] = {
-                'hash': file_hash,
-                'status': 'failed',
-                'last_attempt': datetime.now().isoformat(),
-                'retry_count': file_state.get('retry_count', 0) + 1,
-                'knowledge_base': kb_name,
-                'error': 'Upload failed',
-                'source_type': source_info['type'],
-                'source_name': source_info['name'],
-                'file_size': file_size,
-                'created_at': file_created,
-                'modified_at': file_modified,
-                'filename': filepath.name
-            }
-            failed += 1
+        queue_upload(pipeline, state, hash_index, {
+            'filepath': filepath,
+            'file_key': file_key,
+            'file_hash': file_hash,
+            'file_signature': file_signature,
+            'file_state': file_state,
+            'file_stat': file_stat,
+            'source_info': source_info,
+            'ssh_temp_parent': ssh_temp_parent,
+            'kb_name': kb_name
+        })
+        advance_upload_pipeline(pipeline, state, hash_index)
+    
+    stop_upload_pipeline(pipeline, state, hash_index)
+    uploaded += pipeline['counts']['uploaded']
+    failed += pipeline['counts']['failed']
+    converted += pipeline['counts']['converted']
+    deduplicated = pipeline['counts']['deduplicated']
+    if pipeline['counts']['processing']:
+        log(f"⏳ {pipeline['counts']['processing']} file(s) still being processed by Open WebUI, checking again next run")
+    
+    if rekeyed:
+        log(f"↻ Re-keyed {rekeyed} unchanged file(s) to {HASH_ALGORITHM} hashes")
+    
+    if backlog:
+        # A missing file may have moved to a path in the backlog, so deletions wait for a complete sync
+        missing_keys = set()
+    backlog = list(dict.fromkeys(previous_backlog + backlog))
+    if backlog:
+        state['backlog'] = {'created_at': datetime.now().isoformat(), 'file_keys': backlog}
+    else:
+        state.pop('backlog', None)
+    
+    # Remove files whose source disappeared
+    deleted = 0
+    if DELETE_MISSING_FILES and missing_keys:
+        missing = {
+            prefix: [file_key for file_key in file_keys if file_key in missing_keys]
+            for prefix, file_keys in missing.items()
+        }
+        deleted = delete_missing_files(state, {prefix: file_keys for prefix, file_keys in missing.items() if file_keys})
     
     # Save updated state
+    update_directory_manifest(state)
     save_state(state)
+    close_state_store()
     
     # Clean up temporary SSH directories
     if ssh_temp_dirs:
@@ -1906,7 +3772,272 @@ def sync_files():
             except Exception as e:
                 log(f"⚠ Could not remove temp directory {temp_dir.name}: {e}")
     
-    log(f"Sync complete: {uploaded} uploaded, {skipped} skipped, {failed} failed, {retried} retried, {filtered} filtered, {converted} converted")
+    hash_rate = hash_stats['bytes'] / hash_stats['seconds'] / (1024 * 1024) if hash_stats['seconds'] else 0
+    log(f"Sync complete: {uploaded} uploaded, {skipped} skipped, {failed} failed, {retried} retried, {filtered} filtered, {converted} converted, {deleted} deleted, {moved} moved, {deduplicated} deduplicated, {len(backlog)} in backlog, "
+        f"{hash_stats['files']} hashed ({hash_stats['bytes'] / (1024 * 1024):.1f} MB at {hash_rate:.1f} MB/s)")
+    log_upload_limits()
+    log_api_stats()
+
+# inotify event flags (see inotify(7))
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+# Seconds after a failed sync in watch mode before a full sync is retried
+WATCH_RETRY_SECONDS = 60
+
+def create_inotify_watcher(roots):
+    """Create an inotify instance watching directory trees recursively
+    
+    Args:
+        roots: List of Path objects of directories to watch
+    
+    Returns:
+        Watcher dict with 'fd', 'libc' and 'dirs' (watch descriptor -> directory path),
+        or None if inotify is not available
+    """
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+    except (OSError, AttributeError) as e:
+        log(f"⚠ inotify is not available ({e}), relying on periodic full syncs")
+        return None
+    
+    watcher = {'fd': fd, 'libc': libc, 'dirs': {}}
+    for root in roots:
+        add_inotify_watches(watcher, root)
+    log(f"Watching {len(watcher['dirs'])} directories for changes")
+    return watcher
+
+def add_inotify_watches(watcher, root):
+    """Add inotify watches for a directory and all of its subdirectories
+    
+    Args:
+        watcher: Watcher dict from create_inotify_watcher()
+        root: Path object of the directory
+    """
+    import ctypes
+    
+    pending_dirs = [str(root)]
+    while pending_dirs:
+        current_dir = pending_dirs.pop()
+        wd = watcher['libc'].inotify_add_watch(watcher['fd'], os.fsencode(current_dir), IN_WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            if errno == 28:  # ENOSPC: fs.inotify.max_user_watches reached
+                log(f"⚠ inotify watch limit reached at {current_dir}, changes below it are picked up by full syncs")
+                return
+            continue
+        watcher['dirs'][wd] = current_dir
+        try:
+            with os.scandir(current_dir) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending_dirs.append(entry.path)
+        except OSError:
+            continue
+
+def remove_inotify_watches(watcher, root):
+    """Remove the inotify watches of a directory tree that moved away
+    
+    Args:
+        watcher: Watcher dict from create_inotify_watcher()
+        root: Path object of the directory
+    """
+    root = str(root)
+    for wd, dirpath in list(watcher['dirs'].items()):
+        if dirpath == root or dirpath.startswith(root + os.sep):
+            watcher['libc'].inotify_rm_watch(watcher['fd'], wd)
+            del watcher['dirs'][wd]
+
+def read_inotify_events(watcher, timeout):
+    """Wait for inotify events and return the affected paths
+    
+    Files are reported once they were written and closed, moved or deleted,
+    not when they are created, so a slow copy is not synced half-written.
+    New directories are watched as they appear and their files are reported,
+    so a directory moved into the tree is synced as a whole. A directory
+    moved away or deleted is reported as its own path.
+    
+    Args:
+        watcher: Watcher dict from create_inotify_watcher()
+        timeout: Maximum seconds to wait for events
+    
+    Returns:
+        Tuple of (set of changed Path objects, overflow: bool)
+    """
+    import select
+    import struct
+    
+    changed = set()
+    overflow = False
+    
+    readable, _, _ = select.select([watcher['fd']], [], [], timeout)
+    if not readable:
+        return changed, overflow
+    
+    while True:
+        try:
+            data = os.read(watcher['fd'], 64 * 1024)
+        except BlockingIOError:
+            break
+        if not data:
+            break
+        
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, name_len = struct.unpack_from('iIII', data, offset)
+            offset += 16
+            name = data[offset:offset + name_len].rstrip(b'\0')
+            offset += name_len
+            
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if mask & IN_IGNORED:
+                watcher['dirs'].pop(wd, None)
+                continue
+            
+            parent = watcher['dirs'].get(wd)
+            if parent is None or not name:
+                continue
+            path = Path(os.path.join(parent, os.fsdecode(name)))
+            
+            if mask & IN_ISDIR:
+                if mask & (IN_MOVED_FROM | IN_DELETE):
+                    # Reported as well, so the state entries below it are found missing
+                    remove_inotify_watches(watcher, path)
+                    changed.add(path)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    add_inotify_watches(watcher, path)
+                    changed.update(Path(entry) for entry in _list_files_below(path))
+                continue
+            
+            # A created file may still be being written; it is reported once it is closed
+            if mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE):
+                changed.add(path)
+    
+    return changed, overflow
+
+def _list_files_below(dirpath):
+    """List all file paths below a directory (used for directories moved into a watched tree)"""
+    files = []
+    for current_dir, dirnames, filenames in os.walk(dirpath):
+        files.extend(os.path.join(current_dir, filename) for filename in filenames)
+    return files
+
+def run_watched_sync(paths=None):
+    """Run sync_files() in watch mode, where a failed sync must not stop the watcher
+    
+    Args:
+        paths: Optional set of changed file paths, None for a full sync
+    
+    Returns:
+        bool: True if the sync completed
+    """
+    try:
+        sync_files(paths=paths)
+        return True
+    except Exception as e:
+        log(f"✗ Error during sync in watch mode: {e}, retrying with a full sync in {WATCH_RETRY_SECONDS}s")
+        return False
+
+def watch_and_sync():
+    """Run a full sync, then keep syncing files as inotify reports changes
+    
+    Bursts of events (editors writing temp files, rsync renames) are
+    debounced: a batch is synced once no event arrived for
+    WATCH_DEBOUNCE_SECONDS. A full sync still runs every
+    WATCH_RECONCILE_HOURS as a safety net, e.g. for SSH sources, network
+    filesystems that do not deliver inotify events, and overflowed queues.
+    A failed sync (e.g. an unreachable state volume) does not stop the
+    watcher: a full sync is retried after WATCH_RETRY_SECONDS, which also
+    picks up the files of a failed batch.
+    """
+    log("Starting watch mode...")
+    full_sync_retry = None if run_watched_sync() else time.monotonic() + WATCH_RETRY_SECONDS
+    
+    # Only FILES_DIR is synced, so mapped paths outside it are not watched either
+    watcher = create_inotify_watcher([Path(FILES_DIR)])
+    reconcile_interval = WATCH_RECONCILE_HOURS * 3600
+    # A steady stream of events must not postpone a batch forever
+    max_batch_delay = WATCH_DEBOUNCE_SECONDS * 10
+    last_reconcile = time.monotonic()
+    pending = set()
+    first_event = last_event = 0.0
+    
+    while True:
+        now = time.monotonic()
+        full_sync_times = [last_reconcile + reconcile_interval] if reconcile_interval > 0 else []
+        if full_sync_retry is not None:
+            full_sync_times.append(full_sync_retry)
+        next_full_sync = min(full_sync_times) if full_sync_times else None
+        reconcile_due = next_full_sync is not None and now >= next_full_sync
+        
+        if watcher is not None and not reconcile_due:
+            wait_time = WATCH_DEBOUNCE_SECONDS if pending else 60
+            if next_full_sync is not None:
+                wait_time = max(0, min(wait_time, next_full_sync - now))
+            changed, overflow = read_inotify_events(watcher, wait_time)
+            if changed:
+                if not pending:
+                    first_event = time.monotonic()
+                pending.update(changed)
+                last_event = time.monotonic()
+            if overflow:
+                log("⚠ inotify event queue overflowed, running a full sync")
+                reconcile_due = True
+        elif not reconcile_due:
+            time.sleep(max(0, min(60, next_full_sync - now)) if next_full_sync is not None else 60)
+            continue
+        
+        if reconcile_due:
+            log("Running periodic full sync..." if full_sync_retry is None else "Retrying full sync...")
+            pending.clear()
+            if run_watched_sync():
+                full_sync_retry = None
+                last_reconcile = time.monotonic()
+            else:
+                full_sync_retry = time.monotonic() + WATCH_RETRY_SECONDS
+        elif pending and (time.monotonic() - last_event >= WATCH_DEBOUNCE_SECONDS
+                          or time.monotonic() - first_event >= max_batch_delay):
+            batch = pending
+            pending = set()
+            if not run_watched_sync(batch) and full_sync_retry is None:
+                full_sync_retry = time.monotonic() + WATCH_RETRY_SECONDS
 
 if __name__ == '__main__':
-    sync_files()
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Sync local files to Open WebUI Knowledge Base')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running and sync files as they change (inotify)')
+    parser.add_argument('--shard', default=SYNC_SHARD, metavar='I/N',
+                        help='Only sync shard I of N, with its own state file (default: SYNC_SHARD)')
+    args = parser.parse_args()
+    
+    try:
+        configure_shard(args.shard)
+    except ValueError as e:
+        parser.error(str(e))
+    
+    if args.watch:
+        watch_and_sync()
+    else:
+        try:
+            sync_files()
+        except RuntimeError as e:
+            log(f"ERROR: {e}")
+            sys.exit(1)
@@ -4,8 +4,13 @@ Web interface for managing Open-WebUI-Local-FileSync configuration
 """
 import os
 import json
+import threading
 from flask import Flask, render_template_string, request, jsonify, redirect, url_for
-from config import get_config, save_config_to_file, export_env_to_config_file, DEFAULT_CONFIG_FILE
+import requests
+from config import get_config, save_config_to_file, export_env_to_config_file, get_state_files, DEFAULT_CONFIG_FILE
+from openwebui_client import get_client
+from state_store import (JSONStateStore, SQLiteStateStore, get_journal_file, get_state_db_file, get_state_stamp,
+                         replay_journal, summarize_files)
 from pathlib import Path
 
 # Version information
@@ -19,6 +24,17 @@ except ImportError:
 
 app = Flask(__name__)
 
+# Parsed sync state and values derived from it, shared by all routes until a state file changes; see refresh_state_cache()
+STATE_CACHE = {}
+STATE_CACHE_LOCK = threading.Lock()
+
+# State file path -> state last read from it, with the state file's stat and the journal offset read up to;
+# kept when STATE_CACHE is dropped, so that only new journal records are read (see read_state_shard)
+STATE_SHARDS = {}
+
+# Entry fields the state can be indexed by (see get_state_index), with the value of entries without the field
+STATE_INDEX_FIELDS = {'status': 'unknown', 'knowledge_base': '', 'source_name': 'Unknown', 'file_id': None}
+
 # HTML Template for the web interface
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -902,6 +918,7 @@ HTML_TEMPLATE = """
                             <option value="hourly" {% if config.sync.schedule == 'hourly' %}selected{% endif %}>Hourly</option>
                             <option value="daily" {% if config.sync.schedule == 'daily' %}selected{% endif %}>Daily</option>
                             <option value="weekly" {% if config.sync.schedule == 'weekly' %}selected{% endif %}>Weekly</option>
+                            <option value="watch" {% if config.sync.schedule == 'watch' %}selected{% endif %}>Watch (on change)</option>
                         </select>
                     </div>
                     <div class="form-group">
@@ -2604,6 +2621,15 @@ def save():
                 
                 config['ssh']['sources'].append(source)
         
+        # Keep settings that are not part of the form (e.g. performance tuning)
+        existing_config = get_config()
+        for section, values in existing_config.items():
+            if section not in config:
+                config[section] = values
+            elif isinstance(values, dict) and isinstance(config[section], dict):
+                for key, value in values.items():
+                    config[section].setdefault(key, value)
+        
         # Save to file
         if save_config_to_file(config):
             return redirect(url_for('index', message='Configuration saved successfully!'))
@@ -2649,23 +2675,249 @@ def migrate():
     else:
         return redirect(url_for('index', info='Failed to migrate environment variables.'))
 
-@app.route('/api/state', methods=['GET'])
-def get_state():
-    """API endpoint to get sync state"""
+def get_openwebui_client(config):
+    """Get the shared Open WebUI API client for the current configuration"""
+    openwebui = config['openwebui']
+    return get_client(openwebui['url'], openwebui['api_key'], timeout=openwebui['timeout'],
+                      max_retries=openwebui['max_retries'], pool_size=openwebui['pool_size'],
+                      kb_cache_seconds=openwebui['kb_cache_seconds'])
+
+def uses_state_db(config):
+    """Whether the sync keeps its state in SQLite databases instead of JSON files"""
+    return config['files']['state_backend'] == 'sqlite'
+
+def get_state_paths(config):
+    """List the existing state files, or state databases with the SQLite backend, including shards"""
+    state_file = config['files']['state_file']
+    # With SYNC_SHARD set here too, only the shards of that many workers are shown
     try:
-        config = get_config()
-        state_file = config['files']['state_file']
-        
-        if not os.path.exists(state_file):
-            return jsonify({'files': []})
-        
-        with open(state_file, 'r') as f:
-            state = json.load(f)
-        
-        # Convert state to list format for table display
-        files = []
+        shard_count = int(config.get('sync', {}).get('shard', '').split('/')[1])
+    except (IndexError, ValueError):
+        shard_count = None
+    return get_state_files(get_state_db_file(state_file) if uses_state_db(config) else state_file, shard_count)
+
+def open_state_store(config, path):
+    """Open the store of one state file, or database with the SQLite backend
+    
+    Args:
+        config: Current configuration
+        path: Path returned by get_state_paths()
+    
+    Returns:
+        SQLiteStateStore or JSONStateStore; close it when done
+    """
+    records = config['files']['state_compact_records']
+    if uses_state_db(config):
+        return SQLiteStateStore(path, records=records)
+    return JSONStateStore(path, compact_percent=config['files']['state_compact_percent'], records=records)
+
+def refresh_state_cache(config):
+    """Drop the cached state if a state file changed; call while holding STATE_CACHE_LOCK
+    
+    The state files are only stat'ed (see get_state_stamp). The dashboard
+    polls several routes at once, so they share one parse of the state
+    and of each value derived from it until the sync or an edit changes it.
+    When only a journal grew, the state is read again from the records
+    appended to it (see read_state_shard).
+    
+    Args:
+        config: Current configuration
+    
+    Returns:
+        True if a state file exists
+    """
+    state_paths = get_state_paths(config)
+    key = (uses_state_db(config), tuple(state_paths), tuple(get_state_stamp(path) for path in state_paths))
+    if STATE_CACHE.get('key') != key:
+        STATE_CACHE.clear()
+        STATE_CACHE['key'] = key
+        STATE_CACHE['derived'] = {}
+    return bool(state_paths)
+
+def derive_cached(name, compute):
+    """Get a value derived from the cached state, computed on first use
+    
+    Call while holding STATE_CACHE_LOCK, after refresh_state_cache().
+    
+    Args:
+        name: Name of the value, including the parameters it depends on
+        compute: Function without arguments computing the value
+    
+    Returns:
+        The value, shared by all routes; it must not be modified
+    """
+    derived = STATE_CACHE['derived']
+    if name not in derived:
+        derived[name] = compute()
+    return derived[name]
+
+def load_merged_state(config):
+    """Load the sync state, merging the state shards written by sharded syncs
+    
+    Changes journaled by a running (or interrupted) sync are included. The
+    state is cached until a state file changes; it must not be modified.
+    
+    Args:
+        config: Current configuration
+    
+    Returns:
+        State dict, or None if no state file exists
+    """
+    with STATE_CACHE_LOCK:
+        if not refresh_state_cache(config):
+            return None
+        return derive_cached('state', lambda: read_merged_state(config))
+
+def read_merged_state(config):
+    """Read the state shards and merge them into one state (see load_merged_state)"""
+    state_paths = get_state_paths(config)
+    states = [read_state_shard(config, path) for path in state_paths]
+    for path in STATE_SHARDS.keys() - set(state_paths):
+        del STATE_SHARDS[path]
+    if len(states) == 1:
+        return {'files': states[0].get('files', {}), 'knowledge_bases': states[0].get('knowledge_bases', {})}
+    
+    merged = {'files': {}, 'knowledge_bases': {}}
+    for state in states:
+        merged['files'].update(state.get('files', {}))
+        merged['knowledge_bases'].update(state.get('knowledge_bases', {}))
+    return merged
+
+def read_state_shard(config, path):
+    """Read one state file, or only the journal records appended since it was last read
+    
+    A running sync appends to the journal of its state file as each file
+    finishes, which changes the state stamp on every dashboard poll. As
+    long as the state file itself is unchanged (it is rewritten when the
+    journal is compacted), the new records are applied to a copy of the
+    state read before instead of parsing the whole file again. Call while
+    holding STATE_CACHE_LOCK.
+    
+    Args:
+        config: Current configuration
+        path: Path returned by get_state_paths()
+    
+    Returns:
+        State dict; it must not be modified
+    """
+    if uses_state_db(config):
+        store = open_state_store(config, path)
+        state = store.load()
+        store.close()
+        return state
+    
+    journal_path = get_journal_file(path)
+    file_stamp = get_file_stamp(path)
+    journal_stamp = get_file_stamp(journal_path)
+    journal_inode = journal_stamp[0] if journal_stamp else None
+    cached = STATE_SHARDS.get(path)
+    if cached and file_stamp and cached['file'] == file_stamp and cached['journal_inode'] == journal_inode:
+        journal_size = journal_stamp[2] if journal_stamp else 0
+        if journal_size == cached['offset']:
+            return cached['state']
+        if journal_size > cached['offset']:
+            # Entries are replaced rather than changed by the journal, so routes still using the old state are not affected
+            state = {**cached['state'], 'files': dict(cached['state'].get('files', {})),
+                     'knowledge_bases': dict(cached['state'].get('knowledge_bases', {}))}
+            _, offset = replay_journal(journal_path, state, cached['offset'],
+                                       records=config['files']['state_compact_records'])
+            # Unless the journal was compacted into the state file meanwhile
+            if get_file_stamp(path) == file_stamp:
+                cached.update(state=state, offset=offset)
+                return state
+    
+    store = open_state_store(config, path)
+    state = store.load()
+    store.close()
+    STATE_SHARDS[path] = {'file': file_stamp, 'journal_inode': journal_inode, 'offset': store.journal_offset, 'state': state}
+    return state
+
+def get_file_stamp(path):
+    """(inode, modification time, size) of a file, or None if it does not exist"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+def summarize_state(config):
+    """Count the files of all state shards by status, knowledge base and source
+    
+    With the SQLite backend, the counts come from indexed columns without
+    reading the entries. The counts are cached like the state.
+    
+    Args:
+        config: Current configuration
+    
+    Returns:
+        Tuple of (summary dict as returned by summarize_files, set of knowledge
+        base names in the knowledge_bases section), or (None, None) if no state exists
+    """
+    max_retries = config['retry']['max_attempts']
+    with STATE_CACHE_LOCK:
+        if not refresh_state_cache(config):
+            return None, None
+        if uses_state_db(config):
+            return derive_cached(('summary', max_retries), lambda: read_state_db_summary(config, max_retries))
+        state = derive_cached('state', lambda: read_merged_state(config))
+        return derive_cached(('summary', max_retries),
+                             lambda: (summarize_files(state['files'], max_retries), set(state['knowledge_bases'])))
+
+def read_state_db_summary(config, max_retries):
+    """Count the files of the state databases with SQL (see summarize_state)"""
+    summary = {}
+    kb_names = set()
+    for path in get_state_paths(config):
+        store = open_state_store(config, path)
+        for group_key, counts in store.summarize_files(max_retries).items():
+            group = summary.setdefault(group_key, {'files': 0, 'conversions': 0, 'pending_retries': 0, 'last_attempt': None})
+            group['files'] += counts['files']
+            group['conversions'] += counts['conversions']
+            group['pending_retries'] += counts['pending_retries']
+            if counts['last_attempt'] and (not group['last_attempt'] or counts['last_attempt'] > group['last_attempt']):
+                group['last_attempt'] = counts['last_attempt']
+        kb_names.update(store.get_knowledge_bases())
+        store.close()
+    return summary, kb_names
+
+def get_state_index(config, field):
+    """Get the file keys of the state by the value of an entry field
+    
+    Args:
+        config: Current configuration
+        field: One of STATE_INDEX_FIELDS
+    
+    Returns:
+        Dict of value -> list of file keys in state order, cached like the
+        state (it must not be modified), or None if no state file exists
+    """
+    default = STATE_INDEX_FIELDS[field]
+    
+    def build_index(state):
+        index = {}
+        for file_key, info in state['files'].items():
+            index.setdefault(info.get(field, default), []).append(file_key)
+        return index
+    
+    with STATE_CACHE_LOCK:
+        if not refresh_state_cache(config):
+            return None
+        state = derive_cached('state', lambda: read_merged_state(config))
+        return derive_cached(('index', field), lambda: build_index(state))
+
+def get_state_rows(config):
+    """Get the rows of the sync state table, by file key, cached like the state
+    
+    Args:
+        config: Current configuration
+    
+    Returns:
+        Dict of file key -> row dict (it must not be modified), or None if no state file exists
+    """
+    def build_rows(state):
+        rows = {}
         for path, info in state.get('files', {}).items():
-            files.append({
+            rows[path] = {
                 'path': path,
                 'status': info.get('status', 'unknown'),
                 'kb': info.get('knowledge_base', ''),
@@ -2677,9 +2929,41 @@ def get_state():
                 'modified_at': info.get('modified_at', ''),
                 'file_size': info.get('file_size', 0),
                 'filename': info.get('filename', os.path.basename(path))
-            })
+            }
+        return rows
+    
+    with STATE_CACHE_LOCK:
+        if not refresh_state_cache(config):
+            return None
+        state = derive_cached('state', lambda: read_merged_state(config))
+        return derive_cached('rows', lambda: build_rows(state))
+
+@app.route('/api/state', methods=['GET'])
+def get_state():
+    """API endpoint to get sync state
+    
+    The optional query parameters status, kb and source return only the
+    files with those values, looked up in the state indexes.
+    """
+    try:
+        config = get_config()
         
-        return jsonify({'files': files})
+        # Rows for table display
+        rows = get_state_rows(config)
+        if rows is None:
+            return jsonify({'files': []})
+        
+        filters = [(field, request.args[param]) for param, field in
+                   (('status', 'status'), ('kb', 'knowledge_base'), ('source', 'source_name')) if param in request.args]
+        if not filters:
+            return jsonify({'files': list(rows.values())})
+        
+        # Files in the index of the first filter that match the others
+        file_keys = get_state_index(config, filters[0][0]).get(filters[0][1], [])
+        for field, value in filters[1:]:
+            matching = set(get_state_index(config, field).get(value, []))
+            file_keys = [file_key for file_key in file_keys if file_key in matching]
+        return jsonify({'files': [rows[file_key] for file_key in file_keys]})
     except Exception as e:
         print(f"Error loading state: {e}")
         return jsonify({'error': 'Failed to load sync state'}), 500
@@ -2695,25 +2979,17 @@ def delete_state():
             return jsonify({'success': False, 'message': 'No paths provided'}), 400
         
         config = get_config()
-        state_file = config['files']['state_file']
+        state_files = get_state_paths(config)
         
-        if not os.path.exists(state_file):
+        if not state_files:
             return jsonify({'success': False, 'message': 'State file not found'}), 404
         
-        # Load state
-        with open(state_file, 'r') as f:
-            state = json.load(f)
-        
-        # Remove specified paths
         deleted_count = 0
-        for path in paths:
-            if path in state.get('files', {}):
-                del state['files'][path]
-                deleted_count += 1
-        
-        # Save updated state
-        with open(state_file, 'w') as f:
-            json.dump(state, f, indent=2)
+        for state_file in state_files:
+            # Remove specified paths (a running sync merges the removals before it saves)
+            store = open_state_store(config, state_file)
+            deleted_count += len(store.apply_edits([{'key': path, 'op': 'remove'} for path in paths]))
+            store.close()
         
         return jsonify({
             'success': True, 
@@ -2728,8 +3004,6 @@ def delete_state():
 def update_kb():
     """API endpoint to update knowledge base for multiple files"""
     try:
-        import requests
-        
         data = request.get_json()
         paths = data.get('paths', [])
         kb_name = data.get('kb_name', '')
@@ -2738,83 +3012,72 @@ def update_kb():
             return jsonify({'success': False, 'message': 'No paths provided'}), 400
         
         config = get_config()
-        state_file = config['files']['state_file']
+        state_files = get_state_paths(config)
         
-        if not os.path.exists(state_file):
+        if not state_files:
             return jsonify({'success': False, 'message': 'State file not found'}), 404
         
-        # Load state
-        with open(state_file, 'r') as f:
-            state = json.load(f)
-        
-        # Get Open WebUI URL and API key
-        openwebui_url = config['openwebui']['url'].rstrip('/')
-        api_key = config['openwebui']['api_key']
-        headers = {
-            'Authorization': f'Bearer {api_key}',
-            'Content-Type': 'application/json'
-        }
+        client = get_openwebui_client(config)
         
         # Get or create the target KB if specified
         target_kb_id = None
         if kb_name:
             # Try to find existing KB or create new one
             try:
-                kb_list_response = requests.get(f"{openwebui_url}/api/v1/knowledge/", headers=headers, timeout=30)
-                if kb_list_response.status_code == 200:
-                    kbs = kb_list_response.json()
-                    for kb in kbs:
-                        if kb.get('name') == kb_name:
-                            target_kb_id = kb.get('id')
-                            break
+                try:
+                    kbs = client.list_knowledge_bases()
+                except requests.HTTPError:
+                    kbs = []
+                for kb in kbs:
+                    if kb.get('name') == kb_name:
+                        target_kb_id = kb.get('id')
+                        break
                 
                 # Create KB if not found
                 if not target_kb_id:
-                    kb_create_response = requests.post(
-                        f"{openwebui_url}/api/v1/knowledge/",
-                        headers=headers,
-                        json={'name': kb_name, 'description': f'Knowledge base for {kb_name}'},
-                        timeout=30
-                    )
+                    kb_create_response = client.create_knowledge_base(kb_name, f'Knowledge base for {kb_name}')
                     if kb_create_response.status_code in [200, 201]:
                         target_kb_id = kb_create_response.json().get('id')
             except Exception as e:
                 print(f"Error getting/creating KB: {e}")
         
+        # Add the files that change knowledge base to the new one, in batches
+        files = (load_merged_state(config) or {}).get('files', {})
+        to_add = {}
+        for path in paths:
+            file_info = files.get(path)
+            if file_info and file_info.get('file_id') and target_kb_id and file_info.get('knowledge_base', '') != kb_name:
+                to_add[path] = file_info['file_id']
+        
+        add_errors = {}
+        if to_add:
+            try:
+                add_errors = client.add_files_to_knowledge_base(
+                    target_kb_id, list(to_add.values()), config['performance']['kb_attach_batch_size']
+                )
+            except Exception as e:
+                add_errors = {file_id: str(e) for file_id in to_add.values()}
+        
         # Update knowledge base for specified paths
         updated_count = 0
         errors = []
         
+        edits = []
         for path in paths:
-            if path in state.get('files', {}):
-                file_info = state['files'][path]
-                file_id = file_info.get('file_id')
-                old_kb = file_info.get('knowledge_base', '')
+            if path in files:
+                if path in to_add and add_errors.get(to_add[path]):
+                    errors.append(f"Failed to add {path} to KB: {add_errors[to_add[path]]}")
+                    continue
                 
-                # If file has a file_id and KB is changing, update in Open WebUI
-                if file_id and target_kb_id and old_kb != kb_name:
-                    try:
-                        # Add file to new KB
-                        add_response = requests.post(
-                            f"{openwebui_url}/api/v1/knowledge/{target_kb_id}/file/add",
-                            headers=headers,
-                            json={'file_id': file_id},
-                            timeout=30
-                        )
-                        if add_response.status_code not in [200, 201]:
-                            errors.append(f"Failed to add {path} to KB: {add_response.text}")
-                            continue
-                    except Exception as e:
-                        errors.append(f"Error updating {path}: {str(e)}")
-                        continue
-                
-                # Update state
-                state['files'][path]['knowledge_base'] = kb_name
+                edits.append({'key': path, 'op': 'update', 'fields': {'knowledge_base': kb_name}})
                 updated_count += 1
         
-        # Save updated state
-        with open(state_file, 'w') as f:
-            json.dump(state, f, indent=2)
+        # Update state; each state shard changes the files it has (a running sync merges the edits before it saves)
+        if edits:
+            for state_file in state_files:
+                store = open_state_store(config, state_file)
+                store.apply_edits(edits)
+                store.close()
         
         message = f'Updated {updated_count} item(s)'
         if errors:
@@ -2837,20 +3100,13 @@ def get_knowledge_bases():
     """API endpoint to get list of knowledge bases from state"""
     try:
         config = get_config()
-        state_file = config['files']['state_file']
         
-        if not os.path.exists(state_file):
+        summary, _ = summarize_state(config)
+        if summary is None:
             return jsonify({'knowledge_bases': []})
         
-        with open(state_file, 'r') as f:
-            state = json.load(f)
-        
         # Get unique knowledge bases from state
-        kb_set = set()
-        for path, info in state.get('files', {}).items():
-            kb = info.get('knowledge_base', '')
-            if kb:
-                kb_set.add(kb)
+        kb_set = {kb for _, kb, _ in summary if kb}
         
         # Also add knowledge bases from config
         if config['knowledge_bases']['single_kb_mode']:
@@ -2972,8 +3228,6 @@ def browse_ssh():
 def get_openwebui_files():
     """API endpoint to get all files from Open WebUI"""
     try:
-        import requests
-        
         config = get_config()
         openwebui_url = config['openwebui']['url']
         api_key = config['openwebui']['api_key']
@@ -2982,8 +3236,8 @@ def get_openwebui_files():
             return jsonify({'success': False, 'error': 'Open WebUI URL and API key required'}), 400
         
         # Get all files from Open WebUI
-        headers = {'Authorization': f'Bearer {api_key}'}
-        response = requests.get(f'{openwebui_url}/api/v1/files/', headers=headers)
+        client = get_openwebui_client(config)
+        response = client.get('/api/v1/files/')
         
         if response.status_code != 200:
             return jsonify({'success': False, 'error': f'Failed to fetch files: {response.status_code}'}), 500
@@ -2991,18 +3245,19 @@ def get_openwebui_files():
         files_data = response.json()
         
         # Get knowledge bases to map file IDs to KB names
-        kb_response = requests.get(f'{openwebui_url}/api/v1/knowledge/', headers=headers)
         kb_mapping = {}
-        
-        if kb_response.status_code == 200:
-            kb_data = kb_response.json()
-            # Create mapping of file_id to knowledge base name
-            for kb in kb_data:
-                kb_name = kb.get('name', '')
-                for file_id in kb.get('file_ids', []):
-                    if file_id not in kb_mapping:
-                        kb_mapping[file_id] = []
-                    kb_mapping[file_id].append(kb_name)
+        try:
+            kb_data = client.list_knowledge_bases()
+        except requests.HTTPError:
+            kb_data = []
+        
+        # Create mapping of file_id to knowledge base name
+        for kb in kb_data:
+            kb_name = kb.get('name', '')
+            for file_id in kb.get('file_ids', []):
+                if file_id not in kb_mapping:
+                    kb_mapping[file_id] = []
+                kb_mapping[file_id].append(kb_name)
         
         # Enhance files data with KB information
         enhanced_files = []
@@ -3025,8 +3280,6 @@ def get_openwebui_files():
 def delete_openwebui_files():
     """API endpoint to delete files from Open WebUI"""
     try:
-        import requests
-        
         data = request.get_json()
         file_ids = data.get('file_ids', [])
         
@@ -3040,22 +3293,26 @@ def delete_openwebui_files():
         if not openwebui_url or not api_key:
             return jsonify({'success': False, 'error': 'Open WebUI URL and API key required'}), 400
         
-        headers = {'Authorization': f'Bearer {api_key}'}
+        client = get_openwebui_client(config)
         deleted_count = 0
+        deleted_ids = []
         errors = []
         
         for file_id in file_ids:
             try:
-                response = requests.delete(f'{openwebui_url}/api/v1/files/{file_id}', headers=headers)
+                response = client.delete(f'/api/v1/files/{file_id}')
                 if response.status_code in [200, 204]:
                     deleted_count += 1
-                    # Update sync state to mark as deleted
-                    update_sync_state_on_delete(file_id)
+                    deleted_ids.append(file_id)
                 else:
                     errors.append(f'File {file_id}: {response.status_code}')
             except Exception as e:
                 errors.append(f'File {file_id}: Error deleting file')
         
+        # Update sync state to mark as deleted
+        if deleted_ids:
+            update_sync_state_on_delete(deleted_ids)
+        
         return jsonify({
             'success': True,
             'deleted_count': deleted_count,
@@ -3066,30 +3323,32 @@ def delete_openwebui_files():
         print(f"Error deleting Open WebUI files: {e}")
         return jsonify({'success': False, 'error': 'Failed to delete files'}), 500
 
-def update_sync_state_on_delete(file_id):
-    """Update sync state when a file is deleted from Open WebUI"""
+def update_sync_state_on_delete(file_ids):
+    """Update sync state when files are deleted from Open WebUI
+    
+    Args:
+        file_ids: IDs of the deleted files
+    """
     try:
         config = get_config()
-        state_file = config['files']['state_file']
-        
-        if not os.path.exists(state_file):
-            return
-        
-        with open(state_file, 'r') as f:
-            state = json.load(f)
+        file_id_index = None if uses_state_db(config) else get_state_index(config, 'file_id') or {}
         
-        # Find and remove entries with matching file_id
-        files_to_remove = []
-        for path, info in state.get('files', {}).items():
-            if info.get('file_id') == file_id:
-                files_to_remove.append(path)
-        
-        for path in files_to_remove:
-            del state['files'][path]
-        
-        # Save updated state
-        with open(state_file, 'w') as f:
-            json.dump(state, f, indent=2)
+        for state_file in get_state_paths(config):
+            store = open_state_store(config, state_file)
+            
+            # Find entries with matching file_id, unless they were uploaded again meanwhile
+            edits = []
+            for file_id in file_ids:
+                if file_id_index is None:
+                    # Entries are found through the index on file_id
+                    files_to_remove = store.find_file_keys('file_id', file_id)
+                else:
+                    files_to_remove = file_id_index.get(file_id, [])
+                edits.extend({'key': path, 'op': 'remove', 'file_id': file_id} for path in files_to_remove)
+            
+            if edits:
+                store.apply_edits(edits)
+            store.close()
     except Exception as e:
         print(f"Error updating sync state on delete: {e}")
 
@@ -3098,7 +3357,6 @@ def get_status():
     """API endpoint to get sync status dashboard data"""
     try:
         config = get_config()
-        state_file = config['files']['state_file']
         
         # Default stats
         stats = {
@@ -3116,68 +3374,47 @@ def get_status():
             'next_sync': None
         }
         
-        # Load state file
-        if os.path.exists(state_file):
-            with open(state_file, 'r') as f:
-                state = json.load(f)
-            
-            files_dict = state.get('files', {})
-            stats['total_files'] = len(files_dict)
-            
-            # Count by status and source
-            kb_file_counts = {}
-            source_file_counts = {}
-            source_conversions = {}
-            source_errors = {}
-            
-            for path, info in files_dict.items():
-                status = info.get('status', 'unknown')
+        # Count files by status, knowledge base and source
+        summary, kb_names = summarize_state(config)
+        kb_file_counts = {}
+        source_file_counts = {}
+        source_conversions = {}
+        source_errors = {}
+        if summary is not None:
+            for (status, kb_name, source_name), counts in summary.items():
+                stats['total_files'] += counts['files']
                 if status == 'uploaded':
-                    stats['synced_files'] += 1
+                    stats['synced_files'] += counts['files']
+                    # Count conversions (files with .json, .yaml, .yml, .conf extensions that were uploaded)
+                    stats['total_conversions'] += counts['conversions']
                 elif status == 'failed':
-                    stats['failed_files'] += 1
-                    retry_count = info.get('retry_count', 0)
-                    max_retries = config['retry']['max_attempts']
-                    if retry_count < max_retries:
-                        stats['pending_retries'] += 1
-                
-                # Count conversions (files with .json, .yaml, .yml, .conf extensions that were uploaded)
-                if status == 'uploaded':
-                    ext = os.path.splitext(path)[1].lower()
-                    if ext in ['.json', '.yaml', '.yml', '.conf']:
-                        stats['total_conversions'] += 1
+                    stats['failed_files'] += counts['files']
+                    stats['pending_retries'] += counts['pending_retries']
                 
                 # Count files per KB
-                kb_name = info.get('knowledge_base', '')
-                if kb_name:
-                    kb_file_counts[kb_name] = kb_file_counts.get(kb_name, 0) + 1
-                else:
-                    kb_file_counts['Unassigned'] = kb_file_counts.get('Unassigned', 0) + 1
+                kb_key = kb_name or 'Unassigned'
+                kb_file_counts[kb_key] = kb_file_counts.get(kb_key, 0) + counts['files']
                 
                 # Count files per source
-                source_name = info.get('source_name', 'Unknown')
                 if source_name not in source_file_counts:
                     source_file_counts[source_name] = 0
                     source_conversions[source_name] = 0
                     source_errors[source_name] = 0
                 
                 if status == 'uploaded':
-                    source_file_counts[source_name] += 1
-                    # Check if this was a conversion
-                    ext = os.path.splitext(path)[1].lower()
-                    if ext in ['.json', '.yaml', '.yml', '.conf']:
-                        source_conversions[source_name] += 1
+                    source_file_counts[source_name] += counts['files']
+                    source_conversions[source_name] += counts['conversions']
                 elif status == 'failed':
-                    source_errors[source_name] += 1
+                    source_errors[source_name] += counts['files']
                 
                 # Get last sync time (most recent last_attempt)
-                last_attempt = info.get('last_attempt')
+                last_attempt = counts['last_attempt']
                 if last_attempt:
                     if not stats['last_sync'] or last_attempt > stats['last_sync']:
                         stats['last_sync'] = last_attempt
             
             # KB stats
-            stats['total_kbs'] = len(state.get('knowledge_bases', {}))
+            stats['total_kbs'] = len(kb_names)
             stats['active_kbs'] = len([kb for kb in kb_file_counts.keys() if kb != 'Unassigned'])
             stats['kb_stats'] = [{'name': kb, 'file_count': count} for kb, count in sorted(kb_file_counts.items(), key=lambda x: x[1], reverse=True)]
         